@@ -0,0 +1,226 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Parse the metrics that Collectd posts through write_http in JSON format
+"""
+
+import logging
+import time
+
+# The TSDB name of the jobstats metrics of OST
+JOBSTATS_TSDB_NAME = "ost_jobstats_samples"
+# The TSDB tag of the filesystem name of the jobstats metrics
+JOBSTATS_FSNAME_TAG = "fs_name"
+# The metrics of a job that could be controlled
+METRIC_WRITE_BYTES = "write_bytes"
+METRIC_READ_BYTES = "read_bytes"
+METRIC_WRITE_OPS = "write_ops"
+METRIC_READ_OPS = "read_ops"
+# The operation types of the jobstats that LIME uses, and their metrics
+JOBSTATS_OPTYPES = {"sum_write_bytes": METRIC_WRITE_BYTES,
+                    "sum_read_bytes": METRIC_READ_BYTES,
+                    "write_samples": METRIC_WRITE_OPS,
+                    "read_samples": METRIC_READ_OPS}
+# The scale from the rate of a metric to the rate that policies use, the
+# bandwidth is in MB/s and the IOPS is as it is
+METRIC_SCALES = {METRIC_WRITE_BYTES: 1 / 1000000.0,
+                 METRIC_READ_BYTES: 1 / 1000000.0,
+                 METRIC_WRITE_OPS: 1.0,
+                 METRIC_READ_OPS: 1.0}
+# The metric combinations that could be chosen by name, the value is the
+# weight of each metric
+METRIC_PRESETS = {METRIC_WRITE_BYTES: {METRIC_WRITE_BYTES: 1.0},
+                  METRIC_READ_BYTES: {METRIC_READ_BYTES: 1.0},
+                  METRIC_WRITE_OPS: {METRIC_WRITE_OPS: 1.0},
+                  METRIC_READ_OPS: {METRIC_READ_OPS: 1.0},
+                  "bytes": {METRIC_WRITE_BYTES: 1.0,
+                            METRIC_READ_BYTES: 1.0},
+                  "ops": {METRIC_WRITE_OPS: 1.0, METRIC_READ_OPS: 1.0}}
+# The metric that the policies target if a job does not choose one
+DEFAULT_METRIC = METRIC_WRITE_BYTES
+# The metric that counts the RPCs of each metric, which are what TBF rules
+# limit
+RPC_METRICS = {METRIC_WRITE_BYTES: METRIC_WRITE_OPS,
+               METRIC_READ_BYTES: METRIC_READ_OPS,
+               METRIC_WRITE_OPS: METRIC_WRITE_OPS,
+               METRIC_READ_OPS: METRIC_READ_OPS}
+# The expected interval of the datapoints from Collectd
+COUNTER_INTERVAL = 1
+# A series without datapoint for this number of intervals is stale, its
+# rate is unknown
+COUNTER_STALE_INTERVALS = 3
+# A series without datapoint for this many seconds is dead, its rate is 0
+COUNTER_MAX_AGE = 30
+
+
+def tsdb_tags_parse(tsdb_tags, tag_dict):
+    """
+    Parse a TSDB tag string to dictionary
+    """
+    tags = tsdb_tags.split()
+    for tag in tags:
+        pair = tag.split("=")
+        if len(pair) != 2:
+            logging.error("tsdb tags [%s] is invalid", tsdb_tags)
+            return -1
+        tag_dict[pair[0]] = pair[1]
+    return 0
+
+
+def metric_weights_parse(config):
+    """
+    Parse the metric that a job chooses, which is either the name of a
+    preset or a dict of the weights of metrics, e.g.
+    {"write_bytes": 1, "read_ops": 0.5}. Return the dict of weights, None
+    if the config is invalid.
+    """
+    if config is None:
+        config = DEFAULT_METRIC
+    if isinstance(config, basestring):
+        if config not in METRIC_PRESETS:
+            logging.error("invalid metric [%s]", config)
+            return None
+        return dict(METRIC_PRESETS[config])
+    weights = {}
+    for metric, weight in config.iteritems():
+        if metric not in METRIC_SCALES:
+            logging.error("invalid metric [%s]", metric)
+            return None
+        weights[metric] = float(weight)
+    if len(weights) == 0:
+        logging.error("no metric is chosen")
+        return None
+    return weights
+
+
+class JobstatsDatapoint(object):
+    """
+    A datapoint of the jobstats of a job on an OST. The fsname is None if
+    the tags have no filesystem name.
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, hostname, fsname, service_id, job_id, metric,
+                 timestamp, value):
+        self.jd_hostname = hostname
+        self.jd_fsname = fsname
+        self.jd_service_id = service_id
+        self.jd_job_id = job_id
+        self.jd_metric = metric
+        self.jd_timestamp = timestamp
+        self.jd_value = value
+
+
+def jobstats_datapoint_parse(metric):
+    """
+    Parse a metric posted by Collectd, return None if the metric is not
+    the jobstats that LIME uses
+    """
+    meta = metric["meta"]
+    tsdb_name = meta["tsdb_name"]
+    if tsdb_name != JOBSTATS_TSDB_NAME:
+        return None
+    tsdb_tags = meta["tsdb_tags"]
+    tag_dict = {}
+    ret = tsdb_tags_parse(tsdb_tags, tag_dict)
+    if ret:
+        return None
+    logging.debug("tag_dict: %s", tag_dict)
+    optype = tag_dict["optype"]
+    if optype not in JOBSTATS_OPTYPES:
+        return None
+    return JobstatsDatapoint(metric.get("host"),
+                             tag_dict.get(JOBSTATS_FSNAME_TAG),
+                             tag_dict["ost_index"],
+                             tag_dict["job_id"], JOBSTATS_OPTYPES[optype],
+                             metric["time"], metric["values"][0])
+
+
+class CounterSeries(object):
+    """
+    The rate derived from the datapoints of a counter, e.g. the written
+    bytes of a job on an OST.
+
+    A series is new until its first datapoint, active while datapoints
+    arrive in time, stale when a few intervals are missed, and dead after
+    the max age. The rate of a stale series is unknown, and the rate of a
+    dead series is 0, so that a job stopped or a host lost does not keep
+    its last rate forever.
+    """
+    STATE_NEW = "new"
+    STATE_ACTIVE = "active"
+    STATE_STALE = "stale"
+    STATE_DEAD = "dead"
+
+    def __init__(self, interval=COUNTER_INTERVAL, max_age=COUNTER_MAX_AGE):
+        self.cs_interval = interval
+        self.cs_max_age = max_age
+        self.cs_value = None
+        # Timestamp of the datapoint, from the clock of the sender
+        self.cs_timestamp = None
+        # Local time when the last datapoint was received
+        self.cs_receive_time = None
+        # Per second
+        self.cs_rate = None
+        # How many times the counter has been reset, e.g. the jobstats is
+        # cleared or the OST restarted
+        self.cs_resets = 0
+
+    def cs_datapoint_add(self, timestamp, value, now=None):
+        """
+        A datapoint of the counter is received
+        """
+        if now is None:
+            now = time.time()
+        if self.cs_timestamp is not None:
+            if timestamp <= self.cs_timestamp:
+                # Duplicated or out of order
+                return
+            if value >= self.cs_value:
+                diff = value - self.cs_value
+            else:
+                # The counter restarted from zero sometime in the interval
+                self.cs_resets += 1
+                diff = value
+            # If datapoints are missing, the rate is the average over the
+            # gap, nothing is interpolated
+            self.cs_rate = diff / float(timestamp - self.cs_timestamp)
+        self.cs_timestamp = timestamp
+        self.cs_value = value
+        self.cs_receive_time = now
+
+    def cs_rate_set(self, timestamp, rate, now=None):
+        """
+        The rate is calculated by the sender, e.g. a relay
+        """
+        if now is None:
+            now = time.time()
+        self.cs_timestamp = timestamp
+        self.cs_rate = rate
+        self.cs_receive_time = now
+
+    def cs_state(self, now=None):
+        """
+        Return the state of the series
+        """
+        if self.cs_receive_time is None:
+            return CounterSeries.STATE_NEW
+        if now is None:
+            now = time.time()
+        age = now - self.cs_receive_time
+        if age > self.cs_max_age:
+            return CounterSeries.STATE_DEAD
+        if age > self.cs_interval * COUNTER_STALE_INTERVALS:
+            return CounterSeries.STATE_STALE
+        return CounterSeries.STATE_ACTIVE
+
+    def cs_rate_get(self, now=None):
+        """
+        Return the rate per second, None if unknown
+        """
+        state = self.cs_state(now)
+        if state == CounterSeries.STATE_DEAD:
+            return 0
+        if state == CounterSeries.STATE_STALE:
+            return None
+        return self.cs_rate
@@ -0,0 +1,172 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Discovery of the busiest jobs in the metric stream
+
+All the job IDs in the stream are counted by the space-saving algorithm,
+which keeps a fixed number of counters no matter how many transient jobs
+come and go. When a job without a counter arrives, the counter with the
+smallest count is taken over, and the new job inherits its count as the
+possible error. So every job with a share of the stream larger than
+1 / capacity is guaranteed to have a counter, and its count is
+overestimated by at most the error.
+
+The jobstats of Lustre are cumulative counters, so the weight of a job is
+the increase of its counters. The first value of a counter is only kept as
+the baseline, since the whole value is what the job did since it appeared
+in jobstats, not what it is doing now. The last values are kept in a
+bounded LRU table separate from the counters, so a job whose counter was
+taken over by transient jobs still gets its increase counted when it comes
+back. The counts decay every discovery interval, so that the jobs that
+became idle drop out.
+"""
+
+import collections
+import heapq
+import itertools
+
+# The default number of counters
+DISCOVERY_CAPACITY = 1000
+# The number of the last values of the counters that are kept per counter
+DISCOVERY_VALUES_PER_COUNTER = 16
+# The counts are multiplied by this factor every discovery interval
+DISCOVERY_DECAY = 0.5
+# The heap of counters is rebuilt if it has this many times more entries
+# than the counters because of the outdated entries
+HEAP_REBUILD_RATIO = 4
+
+
+class SpaceSaving(object):
+    """
+    Weighted space-saving counters of the heaviest items
+    """
+    def __init__(self, capacity=DISCOVERY_CAPACITY):
+        self.ss_capacity = capacity
+        # Key is item, value is [count, error, sequence]
+        self.ss_counters = {}
+        # Min heap of (count, sequence, item), entries whose count or
+        # sequence differ from the counter are outdated. The sequence makes
+        # the least recently updated counter go first among equal counts.
+        self.ss_heap = []
+        self.ss_sequence = itertools.count()
+
+    def ss_add(self, item, weight):
+        """
+        Add the weight to the count of an item. Return the item whose
+        counter was taken over, None if no counter was taken over.
+        """
+        evicted = None
+        counter = self.ss_counters.get(item)
+        if counter is None:
+            if len(self.ss_counters) < self.ss_capacity:
+                counter = [0, 0, 0]
+            else:
+                evicted, counter = self.ss_pop_min()
+                counter[1] = counter[0]
+            self.ss_counters[item] = counter
+        counter[0] += weight
+        counter[2] = self.ss_sequence.next()
+        heapq.heappush(self.ss_heap, (counter[0], counter[2], item))
+        if len(self.ss_heap) > HEAP_REBUILD_RATIO * self.ss_capacity:
+            self.ss_heap_rebuild()
+        return evicted
+
+    def ss_pop_min(self):
+        """
+        Remove the counter with the smallest count, return (item, counter)
+        """
+        while True:
+            count, sequence, item = heapq.heappop(self.ss_heap)
+            counter = self.ss_counters.get(item)
+            if (counter is not None and counter[0] == count and
+                    counter[2] == sequence):
+                del self.ss_counters[item]
+                return item, counter
+
+    def ss_heap_rebuild(self):
+        """
+        Rebuild the heap without the outdated entries
+        """
+        self.ss_heap = [(counter[0], counter[2], item)
+                        for item, counter in self.ss_counters.iteritems()]
+        heapq.heapify(self.ss_heap)
+
+    def ss_decay(self, factor=DISCOVERY_DECAY):
+        """
+        Multiply all the counts and errors by the factor
+        """
+        for counter in self.ss_counters.values():
+            counter[0] *= factor
+            counter[1] *= factor
+        self.ss_heap_rebuild()
+
+    def ss_top(self, number):
+        """
+        Return the items with the highest counts, a list of (item, count,
+        error) in descending order of the count
+        """
+        items = sorted(self.ss_counters.iteritems(),
+                       key=lambda entry: entry[1][0], reverse=True)
+        return [(item, counter[0], counter[1])
+                for item, counter in items[:number]]
+
+
+class JobDiscovery(object):
+    """
+    Find the heavy hitters among the jobs from their datapoints
+    """
+    def __init__(self, metric, capacity=DISCOVERY_CAPACITY):
+        # Only the datapoints of this metric are counted
+        self.hhd_metric = metric
+        self.hhd_sketch = SpaceSaving(capacity)
+        # LRU table, key is (job ID, service ID), value is the last value
+        # of the counter
+        self.hhd_values = collections.OrderedDict()
+        self.hhd_values_size = capacity * DISCOVERY_VALUES_PER_COUNTER
+
+    def hhd_count(self, job_id, weight):
+        """
+        Add the weight to the count of a job
+        """
+        self.hhd_sketch.ss_add(job_id, weight)
+
+    def hhd_datapoint_add(self, service_id, job_id, metric, value):
+        """
+        Count the increase of the counter of a job on a service
+        """
+        if metric != self.hhd_metric:
+            return
+        key = (job_id, service_id)
+        last_value = self.hhd_values.pop(key, None)
+        self.hhd_values[key] = value
+        if len(self.hhd_values) > self.hhd_values_size:
+            self.hhd_values.popitem(last=False)
+        # The first value is only the baseline, and a smaller value means
+        # the counter was reset
+        if last_value is None or value <= last_value:
+            return
+        self.hhd_count(job_id, value - last_value)
+
+    def hhd_summary_add(self, job_id, metric, rate, interval):
+        """
+        Count the rate of a job on a host from a relay
+        """
+        if metric != self.hhd_metric:
+            return
+        self.hhd_count(job_id, rate * interval)
+
+    def hhd_top(self, number):
+        """
+        Return the job IDs of the heaviest jobs, a job is only returned if
+        its count is higher than the possible error
+        """
+        top = self.hhd_sketch.ss_top(len(self.hhd_sketch.ss_counters))
+        return [job_id for job_id, count, error in top
+                if count > error][:number]
+
+    def hhd_decay(self, factor=DISCOVERY_DECAY):
+        """
+        Decay the counts at the end of a discovery interval
+        """
+        self.hhd_sketch.ss_decay(factor)
@@ -0,0 +1,193 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Microbenchmarks of LIME
+
+Usage: python lime_bench.py [--count N] [--host HOST] [--devices N]
+                            [spawn|parse|metrics]
+"""
+
+import optparse
+import sys
+import time
+
+# local libs
+import utils
+import ssh_host
+import lustre_config
+import lime_metrics
+
+
+def bench_report(name, count, elapsed):
+    """
+    Print the result of a benchmark
+    """
+    print ("%-32s %8d runs %8.3f s %10.1f runs/s" %
+           (name, count, elapsed, count / elapsed))
+
+
+def bench_command(name, command, count):
+    """
+    Run a command serially and report the rate
+    """
+    start = time.time()
+    for _ in range(count):
+        retval = utils.run(command)
+        if retval.cr_exit_status != 0:
+            print "command [%s] failed" % name
+            return -1
+    bench_report(name, count, time.time() - start)
+    return 0
+
+
+def bench_spawn(options):
+    """
+    Compare spawning a command through shell with executing it directly.
+    If a host is given, the sh_run() case is measured too.
+    """
+    # The quotes force the command to go through shell
+    ret = bench_command("shell: echo", "/bin/echo \"lime\"",
+                        options.count)
+    if ret:
+        return ret
+    ret = bench_command("argv: echo", "/bin/echo lime", options.count)
+    if ret:
+        return ret
+    if options.host is None:
+        return 0
+    host = ssh_host.SSHHost(options.host)
+    ret = bench_command("shell: ssh true",
+                        ssh_host.ssh_command(options.host, "true"),
+                        options.count)
+    if ret:
+        return ret
+    start = time.time()
+    for _ in range(options.count):
+        retval = host.sh_run("true", silent=True)
+        if retval.cr_exit_status != 0:
+            print "sh_run failed on host [%s]" % options.host
+            return -1
+    bench_report("sh_run: true", options.count, time.time() - start)
+    return 0
+
+
+def bench_devices(fsname, number):
+    """
+    Return synthetic output of "lctl dl" with the number of devices
+    """
+    lines = ["  0 UP osd-ldiskfs MGS-osd MGS-osd_UUID 5",
+             "  1 UP mgs MGS MGS 7"]
+    device_types = [("osc", "%s-OST%04x-osc-ffff8800b9a6c000"),
+                    ("obdfilter", "%s-OST%04x"),
+                    ("mdt", "%s-MDT%04x"),
+                    ("osp", "%s-OST%04x-osc-MDT0000")]
+    for index in range(number - len(lines)):
+        device_type, name = device_types[index % len(device_types)]
+        name = name % (fsname, index)
+        lines.append("%3d UP %s %s %s_UUID 5" %
+                     (index + 2, device_type, name, name))
+    return "\n".join(lines) + "\n"
+
+
+def bench_parse(options):
+    """
+    Compare matching each line of "lctl dl" with several patterns one by
+    one with classifying the lines in a single pass
+    """
+    cluster = lustre_config.LustreCluster("lustre", [])
+    output = bench_devices(cluster.lc_fsname, options.devices)
+
+    start = time.time()
+    for _ in range(options.count):
+        old_services = 0
+        for line in output.splitlines():
+            for regular in [cluster.lc_mdt_regular, cluster.lc_ost_regular,
+                            cluster.lc_mgs_regular]:
+                if regular.match(line):
+                    old_services += 1
+    bench_report("separate patterns: %d devices" % options.devices,
+                 options.count, time.time() - start)
+
+    start = time.time()
+    classifier = cluster.lc_device_classifier
+    for _ in range(options.count):
+        new_services = 0
+        for _ in classifier.lcl_iterate(output):
+            new_services += 1
+    bench_report("single pass: %d devices" % options.devices,
+                 options.count, time.time() - start)
+    if old_services != new_services:
+        print ("different results of parsing, [%d] vs. [%d]" %
+               (old_services, new_services))
+        return -1
+    return 0
+
+
+def bench_metrics(options):
+    """
+    Measure the cost of updating the metrics of LIME itself. The overhead
+    of the instrumentation in the ticks of lime_web.py is estimated from
+    the cost of a histogram update, see lime_instrumentation_overhead_ratio
+    of /metrics.
+    """
+    registry = lime_metrics.MetricRegistry()
+    counter = registry.mr_counter("bench_total", "", ("label",))
+    histogram = registry.mr_histogram("bench_seconds", "", ("label",))
+    count = options.count * 100
+
+    start = time.time()
+    for _ in range(count):
+        counter.mc_inc(("label",))
+    bench_report("counter increase", count, time.time() - start)
+
+    start = time.time()
+    for _ in range(count):
+        begin = time.time()
+        histogram.mh_observe(time.time() - begin, ("label",))
+    bench_report("timed histogram observe", count, time.time() - start)
+
+    start = time.time()
+    for _ in range(count):
+        lime_metrics.caller_operation()
+    bench_report("caller operation", count, time.time() - start)
+
+    start = time.time()
+    for _ in range(options.count):
+        lime_metrics.REGISTRY.mr_format()
+    bench_report("format", options.count, time.time() - start)
+    print ("calibrated update cost: %.3f us" %
+           (registry.mr_update_cost * 1000000))
+    return 0
+
+
+BENCHMARKS = {"spawn": bench_spawn,
+              "parse": bench_parse,
+              "metrics": bench_metrics}
+
+
+def main():
+    """
+    Parse the options and run the benchmarks
+    """
+    parser = optparse.OptionParser(
+        usage="%%prog [options] %s" % "|".join(sorted(BENCHMARKS)))
+    parser.add_option("--count", type="int", default=200,
+                      help="number of runs of each case")
+    parser.add_option("--host", help="host to run the SSH cases on")
+    parser.add_option("--devices", type="int", default=10000,
+                      help="number of devices in the parse case")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        args = sorted(BENCHMARKS)
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark [%s]" % name)
+        ret = BENCHMARKS[name](options)
+        if ret:
+            return ret
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Debugging tools of LIME: a sampling profiler and a span tracer.
+
+The profiler samples the stacks from a real OS thread, which is not a
+greenlet, so that it keeps sampling while the greenlets are busy. The stack
+of the main thread is the stack of whichever greenlet is running, so the
+profile shows where the CPU time goes, including the greenlets started by
+utils.thread_start(). The result is in the collapsed format of
+flamegraph.pl.
+
+The tracer keeps the latest spans, e.g. the phases of a tick and the SSH
+commands, in a ring buffer, which can be dumped in the trace event format
+of chrome://tracing.
+"""
+
+import collections
+import os
+import sys
+import time
+from gevent import monkey
+
+# The interval between two samples of the profiler in seconds
+PROFILE_INTERVAL = 0.01
+# The longest time that a profile could run
+PROFILE_MAX_SECONDS = 300
+# The number of spans kept by the tracer
+TRACE_BUFFER_SIZE = 100000
+
+
+def frame_name(frame):
+    """
+    Return the name of a frame in the collapsed stacks
+    """
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stacks of all threads periodically
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.sp_interval = interval
+        # Key is the collapsed stack, value is the number of samples
+        self.sp_stacks = collections.Counter()
+        self.sp_samples = 0
+        self.sp_running = False
+        # The monkey patched sleep would switch greenlets instead of
+        # sleeping in this OS thread
+        self.sp_sleep = monkey.get_original("time", "sleep")
+        self.sp_thread_id = None
+
+    def sp_sample(self):
+        """
+        Take one sample of all the threads except the profiler itself
+        """
+        # pylint: disable=protected-access
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.sp_thread_id:
+                continue
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            names.reverse()
+            self.sp_stacks[";".join(names)] += 1
+        self.sp_samples += 1
+
+    def sp_run(self, seconds):
+        """
+        Sample until the time is up
+        """
+        get_ident = monkey.get_original("thread", "get_ident")
+        self.sp_thread_id = get_ident()
+        end_time = time.time() + seconds
+        while self.sp_running and time.time() < end_time:
+            self.sp_sample()
+            self.sp_sleep(self.sp_interval)
+        self.sp_running = False
+
+    def sp_start(self, seconds):
+        """
+        Start sampling in a new OS thread
+        """
+        start_new_thread = monkey.get_original("thread", "start_new_thread")
+        self.sp_running = True
+        start_new_thread(self.sp_run, (min(seconds, PROFILE_MAX_SECONDS),))
+
+    def sp_collapsed(self):
+        """
+        Return the samples in the collapsed format, one stack per line
+        """
+        lines = ["%s %d" % (stack, count)
+                 for stack, count in sorted(self.sp_stacks.items())]
+        return "\n".join(lines) + "\n"
+
+
+class SpanTracer(object):
+    """
+    Keep the latest spans in a ring buffer
+    """
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        # Each span is (name, category, start, duration, args)
+        self.st_spans = collections.deque(maxlen=size)
+
+    def st_span(self, name, category, start, args=None):
+        """
+        Record a span that started at the time and ends now, return the
+        duration
+        """
+        duration = time.time() - start
+        self.st_spans.append((name, category, start, duration, args))
+        return duration
+
+    def st_events(self):
+        """
+        Return the spans in the trace event format. All the greenlets share
+        one OS thread, so the spans are put on rows by category.
+        """
+        pid = os.getpid()
+        events = []
+        for name, category, start, duration, args in list(self.st_spans):
+            event = {"name": name, "cat": category, "ph": "X",
+                     "ts": int(start * 1000000),
+                     "dur": int(duration * 1000000),
+                     "pid": pid, "tid": category}
+            if args is not None:
+                event["args"] = args
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+TRACER = SpanTracer()
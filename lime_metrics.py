@@ -0,0 +1,303 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Metrics of LIME itself, exposed in the text format of Prometheus.
+
+The metrics are updated on the hot paths, so an update only changes a few
+numbers in memory, and all the formatting happens when the metrics are
+scraped. All the threads of LIME are greenlets, and an update never yields,
+so no lock is needed.
+"""
+
+import bisect
+import sys
+import time
+
+# The upper bounds of the buckets of latency histograms in seconds
+LATENCY_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1,
+                   5, 10, 60]
+# The number of updates timed to estimate the cost of one update
+CALIBRATE_COUNT = 10000
+# The content type of the text format of Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# How many frames to walk up to find the operation of a command
+OPERATION_FRAME_DEPTH = 12
+# The operation of a command that is not run by any lh_* method
+OPERATION_OTHER = "other"
+
+
+def label_value_escape(value):
+    """
+    Escape a label value for the text format
+    """
+    value = str(value)
+    return (value.replace("\\", "\\\\").replace("\"", "\\\"").
+            replace("\n", "\\n"))
+
+
+def labels_format(label_names, label_values, extra=None):
+    """
+    Return the label part of a sample line, e.g. {host="oss1"}
+    """
+    pairs = ["%s=\"%s\"" % (name, label_value_escape(value))
+             for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        pairs.append("%s=\"%s\"" % extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def caller_operation(prefix="lh_"):
+    """
+    Return the name of the nearest calling function with the prefix, e.g.
+    the lh_* method of LustreHost that runs a command
+    """
+    # pylint: disable=protected-access
+    frame = sys._getframe(1)
+    for _ in range(OPERATION_FRAME_DEPTH):
+        if frame is None:
+            break
+        name = frame.f_code.co_name
+        if name.startswith(prefix):
+            return name
+        frame = frame.f_back
+    return OPERATION_OTHER
+
+
+class Metric(object):
+    """
+    A metric with optional labels, the values are kept per tuple of label
+    values
+    """
+    mt_type = "untyped"
+
+    def __init__(self, registry, name, description, label_names=()):
+        self.mt_registry = registry
+        self.mt_name = name
+        self.mt_description = description
+        self.mt_label_names = tuple(label_names)
+        self.mt_values = {}
+
+    def mt_samples(self):
+        """
+        Return the sample lines of the metric
+        """
+        lines = []
+        for label_values in sorted(self.mt_values):
+            lines.append("%s%s %r" %
+                         (self.mt_name,
+                          labels_format(self.mt_label_names, label_values),
+                          self.mt_values[label_values]))
+        return lines
+
+    def mt_format(self):
+        """
+        Return the metric in the text format
+        """
+        lines = ["# HELP %s %s" % (self.mt_name, self.mt_description),
+                 "# TYPE %s %s" % (self.mt_name, self.mt_type)]
+        return "\n".join(lines + self.mt_samples())
+
+
+class MetricCounter(Metric):
+    """
+    A value that only goes up
+    """
+    mt_type = "counter"
+
+    def mc_inc(self, labels=(), amount=1):
+        """
+        Increase the counter
+        """
+        self.mt_registry.mr_updates += 1
+        self.mt_values[labels] = self.mt_values.get(labels, 0) + amount
+
+
+class MetricGauge(Metric):
+    """
+    A value that goes up and down
+    """
+    mt_type = "gauge"
+
+    def mg_set(self, value, labels=()):
+        """
+        Set the gauge
+        """
+        self.mt_registry.mr_updates += 1
+        self.mt_values[labels] = value
+
+    def mg_inc(self, labels=(), amount=1):
+        """
+        Increase the gauge, decrease it if amount is negative
+        """
+        self.mt_registry.mr_updates += 1
+        self.mt_values[labels] = self.mt_values.get(labels, 0) + amount
+
+
+class MetricHistogram(Metric):
+    """
+    The distribution of observed values, e.g. latencies. The value of a
+    tuple of labels is [bucket counts, sum, count], the bucket counts are
+    not cumulative until formatted.
+    """
+    mt_type = "histogram"
+
+    def __init__(self, registry, name, description, label_names=(),
+                 buckets=None):
+        # pylint: disable=too-many-arguments
+        super(MetricHistogram, self).__init__(registry, name, description,
+                                              label_names)
+        if buckets is None:
+            buckets = LATENCY_BUCKETS
+        self.mh_buckets = sorted(buckets)
+
+    def mh_observe(self, value, labels=()):
+        """
+        Observe a value
+        """
+        self.mt_registry.mr_updates += 1
+        entry = self.mt_values.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.mh_buckets) + 1), 0.0, 0]
+            self.mt_values[labels] = entry
+        entry[0][bisect.bisect_left(self.mh_buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def mt_samples(self):
+        """
+        Return the sample lines of the histogram
+        """
+        lines = []
+        names = self.mt_label_names
+        bounds = [repr(float(bound)) for bound in self.mh_buckets] + ["+Inf"]
+        for label_values in sorted(self.mt_values):
+            counts, total, count = self.mt_values[label_values]
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %d" %
+                             (self.mt_name,
+                              labels_format(names, label_values,
+                                            ("le", bound)),
+                              cumulative))
+            labels = labels_format(names, label_values)
+            lines.append("%s_sum%s %r" % (self.mt_name, labels, total))
+            lines.append("%s_count%s %d" % (self.mt_name, labels, count))
+        return lines
+
+
+class MetricRegistry(object):
+    """
+    All the metrics of a process. The number of updates is counted so that
+    the cost of the instrumentation could be estimated.
+    """
+    def __init__(self):
+        self.mr_metrics = []
+        self.mr_updates = 0
+        # Seconds per update, measured when the registry is created
+        self.mr_update_cost = self.mr_calibrate()
+
+    def mr_register(self, metric):
+        """
+        Add a metric to the registry
+        """
+        self.mr_metrics.append(metric)
+        return metric
+
+    def mr_counter(self, name, description, label_names=()):
+        """
+        Create a counter
+        """
+        return self.mr_register(MetricCounter(self, name, description,
+                                              label_names))
+
+    def mr_gauge(self, name, description, label_names=()):
+        """
+        Create a gauge
+        """
+        return self.mr_register(MetricGauge(self, name, description,
+                                            label_names))
+
+    def mr_histogram(self, name, description, label_names=(), buckets=None):
+        """
+        Create a histogram
+        """
+        return self.mr_register(MetricHistogram(self, name, description,
+                                                label_names, buckets))
+
+    def mr_calibrate(self):
+        """
+        Return the cost in seconds of a histogram update together with the
+        clock reads that time it, which is the most expensive update
+        """
+        histogram = MetricHistogram(self, "calibrate", "", ("label",))
+        start = time.time()
+        for _ in range(CALIBRATE_COUNT):
+            begin = time.time()
+            histogram.mh_observe(time.time() - begin, ("label",))
+        cost = (time.time() - start) / CALIBRATE_COUNT
+        self.mr_updates = 0
+        return cost
+
+    def mr_overhead(self, updates, elapsed):
+        """
+        Return the estimated fraction of the elapsed time that was spent
+        on the number of updates
+        """
+        if elapsed <= 0:
+            return 0.0
+        return updates * self.mr_update_cost / elapsed
+
+    def mr_format(self):
+        """
+        Return all the metrics in the text format
+        """
+        return "\n".join([metric.mt_format()
+                          for metric in self.mr_metrics]) + "\n"
+
+
+REGISTRY = MetricRegistry()
+METRIC_POSTS = REGISTRY.mr_counter(
+    "lime_metric_post_requests_total",
+    "Requests of posting metrics from Collectd or relays", ("route",))
+METRIC_POST_SECONDS = REGISTRY.mr_histogram(
+    "lime_metric_post_seconds",
+    "Latency of handling a request of posting metrics", ("route",))
+DATAPOINTS_INGESTED = REGISTRY.mr_counter(
+    "lime_datapoints_ingested_total",
+    "Datapoints added to the watched jobs", ("source",))
+DATAPOINTS_DROPPED = REGISTRY.mr_counter(
+    "lime_datapoints_dropped_total",
+    "Datapoints that were not used", ("source", "reason"))
+TICK_SECONDS = REGISTRY.mr_histogram(
+    "lime_tick_seconds",
+    "Duration of the phases of a tick of sending datapoints", ("phase",))
+TICK_FIRES = REGISTRY.mr_counter(
+    "lime_tick_fires_total",
+    "Ticks fired because all the services reported or the deadline passed",
+    ("reason",))
+TICK_LATENESS_SECONDS = REGISTRY.mr_histogram(
+    "lime_tick_lateness_seconds",
+    "Time between the end of an interval and the firing of its tick")
+TICK_SKIPPED = REGISTRY.mr_counter(
+    "lime_tick_skipped_total",
+    "Intervals without a tick because a former tick overran")
+SSH_COMMAND_SECONDS = REGISTRY.mr_histogram(
+    "lime_ssh_command_seconds",
+    "Latency of commands run on hosts through SSH",
+    ("host", "operation"))
+WEBSOCKET_SENDS = REGISTRY.mr_gauge(
+    "lime_websocket_sends_pending",
+    "Messages being sent to websockets")
+LOCK_WAIT_SECONDS = REGISTRY.mr_histogram(
+    "lime_lock_wait_seconds",
+    "Time waiting for the lock of the watched jobs", ("caller",))
+DISCOVERY_CHANGES = REGISTRY.mr_counter(
+    "lime_discovery_changes_total",
+    "Heavy jobs promoted to or demoted from the watched jobs", ("action",))
+OVERHEAD_RATIO = REGISTRY.mr_gauge(
+    "lime_instrumentation_overhead_ratio",
+    "Estimated fraction of the last tick spent on updating these metrics")
@@ -0,0 +1,153 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Resident agent of LIME on OSS, which is deployed to and run on OSSes.
+
+The agent reads one JSON message per line from stdin and writes one JSON
+message per line to stdout. Messages from LIME:
+
+{"id": 1, "type": "batch", "commands": ["start a jobid={dd.0} rate=10"]}
+    Write the commands to nrs_tbf_rule one by one. Reply with
+    {"id": 1, "type": "result", "results": [0]}, a result is 0 or -errno.
+
+{"id": 2, "type": "state"}
+    Reply with {"id": 2, "type": "state", "nrs_tbf_rule": "..."}.
+
+The agent also pushes the state without id every push interval. Only
+standard libraries are used, and it runs with both Python 2 and Python 3.
+The proc root could be changed so that the agent can run on any host
+against a fake directory tree.
+"""
+
+import errno
+import json
+import optparse
+import os
+import select
+import sys
+import time
+
+NRS_TBF_RULE = "ost/OSS/ost_io/nrs_tbf_rule"
+
+
+class OSSAgent(object):
+    """
+    The agent that runs on OSS
+    """
+    def __init__(self, proc_root, push_interval):
+        self.oa_proc_root = proc_root
+        self.oa_push_interval = push_interval
+
+    def oa_rule_write(self, command):
+        """
+        Write a command to nrs_tbf_rule, return 0 or -errno
+        """
+        fname = os.path.join(self.oa_proc_root, NRS_TBF_RULE)
+        try:
+            fd = os.open(fname, os.O_WRONLY | os.O_APPEND)
+        except OSError as error:
+            return -error.errno
+        try:
+            os.write(fd, command.encode("utf-8"))
+        except OSError as error:
+            return -error.errno
+        finally:
+            os.close(fd)
+        return 0
+
+    def oa_read(self, fname):
+        """
+        Read a file, return None on failure
+        """
+        try:
+            return open(fname).read()
+        except IOError:
+            return None
+
+    def oa_state(self):
+        """
+        Return the state of TBF rules. The jobstats are not read, since
+        they come from Collectd.
+        """
+        rules = self.oa_read(os.path.join(self.oa_proc_root, NRS_TBF_RULE))
+        return {"type": "state", "time": time.time(),
+                "nrs_tbf_rule": rules}
+
+    def oa_handle(self, message):
+        """
+        Handle a message, return the reply
+        """
+        message_type = message.get("type")
+        if message_type == "batch":
+            results = []
+            for command in message.get("commands", []):
+                results.append(self.oa_rule_write(command))
+            reply = {"type": "result", "results": results}
+        elif message_type == "state":
+            reply = self.oa_state()
+        else:
+            reply = {"type": "error", "errno": -errno.EINVAL}
+        if "id" in message:
+            reply["id"] = message["id"]
+        return reply
+
+    def oa_send(self, reply):
+        """
+        Send a message to LIME
+        """
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+    def oa_run(self):
+        """
+        Handle the messages until stdin is closed
+        """
+        stdin = sys.stdin.fileno()
+        buf = b""
+        next_push = None
+        if self.oa_push_interval > 0:
+            next_push = time.time() + self.oa_push_interval
+        while True:
+            timeout = None
+            if next_push is not None:
+                timeout = max(next_push - time.time(), 0)
+            readable = select.select([stdin], [], [], timeout)[0]
+            if next_push is not None and time.time() >= next_push:
+                self.oa_send(self.oa_state())
+                next_push += self.oa_push_interval
+            if not readable:
+                continue
+            data = os.read(stdin, 65536)
+            if len(data) == 0:
+                return 0
+            lines = (buf + data).split(b"\n")
+            buf = lines[-1]
+            for line in lines[:-1]:
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    self.oa_send({"type": "error",
+                                  "errno": -errno.EINVAL})
+                    continue
+                self.oa_send(self.oa_handle(message))
+
+
+def main():
+    """
+    Parse the options and run the agent
+    """
+    parser = optparse.OptionParser()
+    parser.add_option("--proc-root", default="/proc/fs/lustre",
+                      help="root directory of Lustre proc entries")
+    parser.add_option("--push-interval", type="float", default=1,
+                      help="interval of pushing state, 0 means never")
+    options, _ = parser.parse_args()
+    agent = OSSAgent(options.proc_root, options.push_interval)
+    return agent.oa_run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Relay of LIME, which pre-aggregates the jobstats of a group of OSSes
+
+The Collectd daemons of the OSSes in a group, e.g. a rack, post to the
+relay instead of LIME. The relay calculates the rate of each metric of each
+job on each OST, and forwards the sum of the rates on each OSS to
+/summary_post of LIME every interval. So LIME handles one message per
+group per interval instead of the metrics of all OSTs and jobs.
+
+If LIME runs in sharded mode, the relay is given the URL of each shard by
+--shard NAME=URL, and the summary of each job is forwarded only to the shard
+that owns the job, see lime_shard.py.
+
+Usage: python lime_relay.py --upstream http://lime:24 --group rack1
+"""
+
+import json
+import logging
+import optparse
+import sys
+import threading
+import time
+import urllib2
+from gevent.wsgi import WSGIServer
+from gevent import sleep
+from flask import Flask, request
+
+import utils
+import collectd_metric
+import lime_shard
+
+RELAY_APP = Flask(__name__)
+# The default port that the relay listens on
+RELAY_PORT = 9007
+# The interval of forwarding summaries
+RELAY_INTERVAL = 1
+# The timeout of posting summaries to LIME
+RELAY_POST_TIMEOUT = 5
+RELAY = None
+
+
+class Relay(object):
+    """
+    Aggregate the metrics of a group and forward them to LIME
+    """
+    def __init__(self, group, upstreams, interval=RELAY_INTERVAL):
+        self.rl_group = group
+        # Key is shard name, value is the URL to post the summaries to. If
+        # not sharded, the only key is None.
+        self.rl_urls = {}
+        for shard, upstream in upstreams.iteritems():
+            self.rl_urls[shard] = upstream.rstrip("/") + "/summary_post"
+        self.rl_ring = None
+        if None not in self.rl_urls:
+            self.rl_ring = lime_shard.HashRing(sorted(self.rl_urls.keys()))
+        self.rl_interval = interval
+        # Key is (hostname, fsname, service_id, job_id, metric), value is
+        # CounterSeries
+        self.rl_series = {}
+        self.rl_lock = threading.Lock()
+
+    def rl_datapoint_add(self, datapoint):
+        """
+        Add a datapoint of a job on an OST
+        """
+        key = (datapoint.jd_hostname, datapoint.jd_fsname,
+               datapoint.jd_service_id, datapoint.jd_job_id,
+               datapoint.jd_metric)
+        self.rl_lock.acquire()
+        series = self.rl_series.get(key)
+        if series is None:
+            series = collectd_metric.CounterSeries()
+            self.rl_series[key] = series
+        series.cs_datapoint_add(datapoint.jd_timestamp, datapoint.jd_value)
+        self.rl_lock.release()
+
+    def rl_summaries(self):
+        """
+        Return the sum of the rates of each metric of each job on each host,
+        the dead series are removed
+        """
+        now = time.time()
+        rates = {}
+        self.rl_lock.acquire()
+        for key, series in self.rl_series.items():
+            if (series.cs_state(now) ==
+                    collectd_metric.CounterSeries.STATE_DEAD):
+                del self.rl_series[key]
+                continue
+            rate = series.cs_rate_get(now)
+            if rate is None:
+                continue
+            hostname, fsname, _, job_id, metric = key
+            summary_key = (hostname, fsname, job_id, metric)
+            rates[summary_key] = rates.get(summary_key, 0) + rate
+        self.rl_lock.release()
+        summaries = []
+        for key, rate in rates.iteritems():
+            summaries.append({"hostname": key[0], "fsname": key[1],
+                              "job_id": key[2], "metric": key[3],
+                              "time": now, "rate": rate})
+        return summaries
+
+    def rl_split(self, summaries):
+        """
+        Split the summaries by the shards that own the jobs, return a dict,
+        key is shard name, value is the list of summaries
+        """
+        if self.rl_ring is None:
+            return {None: summaries}
+        shard_summaries = {}
+        for summary in summaries:
+            shard = self.rl_ring.hr_shard(summary["job_id"])
+            shard_summaries.setdefault(shard, []).append(summary)
+        return shard_summaries
+
+    def rl_post(self, url, summaries):
+        """
+        Post the summaries to LIME
+        """
+        data = json.dumps({"group": self.rl_group, "time": time.time(),
+                           "summaries": summaries})
+        post = urllib2.Request(url, data,
+                               {"Content-Type": "application/json"})
+        try:
+            urllib2.urlopen(post, timeout=RELAY_POST_TIMEOUT).read()
+        except (urllib2.URLError, IOError) as error:
+            logging.error("failed to post summaries to [%s]: %s",
+                          url, error)
+
+    def rl_forward(self):
+        """
+        Forward the summaries to LIME every interval
+        """
+        while True:
+            sleep(self.rl_interval)
+            summaries = self.rl_summaries()
+            if len(summaries) == 0:
+                continue
+            threads = []
+            for shard, shard_summaries in \
+                    self.rl_split(summaries).iteritems():
+                threads.append(utils.thread_start(
+                    self.rl_post, (self.rl_urls[shard], shard_summaries)))
+            for thread in threads:
+                thread.join()
+
+
+@RELAY_APP.route("/metric_post", methods=['POST'])
+def relay_metric_post():
+    """
+    A metric datapoint is recieved from Collectd
+    """
+    for metric in request.json:
+        datapoint = collectd_metric.jobstats_datapoint_parse(metric)
+        if datapoint is None:
+            continue
+        if datapoint.jd_hostname is None:
+            logging.error("no host in metric [%s]", metric)
+            continue
+        RELAY.rl_datapoint_add(datapoint)
+    return "Succeeded"
+
+
+def main():
+    """
+    Parse the options and start the relay
+    """
+    # pylint: disable=global-statement
+    global RELAY
+    parser = optparse.OptionParser()
+    parser.add_option("--upstream", help="URL of LIME, e.g. http://lime:24")
+    parser.add_option("--shard", action="append", default=[],
+                      help="NAME=URL of a shard of LIME, could be repeated "
+                      "instead of --upstream")
+    parser.add_option("--group", help="name of the group of OSSes")
+    parser.add_option("--port", type="int", default=RELAY_PORT,
+                      help="port to receive the metrics from Collectd")
+    parser.add_option("--interval", type="float", default=RELAY_INTERVAL,
+                      help="interval of forwarding summaries in seconds")
+    options, _ = parser.parse_args()
+    if options.group is None:
+        parser.error("--group is needed")
+    if (options.upstream is None) == (len(options.shard) == 0):
+        parser.error("either --upstream or --shard is needed")
+    upstreams = {}
+    if options.upstream is not None:
+        upstreams[None] = options.upstream
+    for shard in options.shard:
+        if "=" not in shard:
+            parser.error("invalid --shard [%s], should be NAME=URL" % shard)
+        name, url = shard.split("=", 1)
+        upstreams[name] = url
+
+    logging.basicConfig(level=logging.INFO)
+    RELAY = Relay(options.group, upstreams, options.interval)
+    utils.thread_start(RELAY.rl_forward, ())
+    http_server = WSGIServer(('0.0.0.0', options.port), RELAY_APP)
+    http_server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
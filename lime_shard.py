@@ -0,0 +1,255 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Sharding of jobs across multiple LIME controllers
+
+In sharded mode, several LIME processes control the same Lustre clusters,
+each of them owns the jobs that the consistent hash ring maps to its shard.
+A shard only watches, limits and ingests the metrics of its own jobs, so
+the metrics could be split by a relay with --shard options, see
+lime_relay.py, or by the filters of Collectd. Adding or removing a shard
+only moves the jobs of the neighbouring virtual nodes.
+
+The OSSes are shared by all the shards, so the coordinator splits the
+capacity of each OSS between the shards. Every interval each shard posts
+its demand on each OSS to /shard_demand of the coordinator, and gets back
+its share of the capacity of each OSS. Each of the N shards gets at least
+SHARD_MIN_SHARE_FRACTION / N of an OSS, the rest is split in proportion to
+the demands.
+
+Usage: python lime_shard.py --port 9008
+
+All the processes could run on one host for testing, e.g.:
+    python lime_shard.py --port 9008
+    python lime_web.py --shard shard0 --port 8024 --log-dir log0
+    python lime_web.py --shard shard1 --port 8025 --log-dir log1
+    python lime_relay.py --group rack1 --shard shard0=http://localhost:8024 \
+        --shard shard1=http://localhost:8025
+with "sharding": {"shards": ["shard0", "shard1"],
+"coordinator": "http://localhost:9008"} in the cluster section of the
+configuration.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import optparse
+import sys
+import time
+import urllib2
+from gevent.wsgi import WSGIServer
+from flask import Flask, request
+
+COORDINATOR_APP = Flask(__name__)
+# The default port that the coordinator listens on
+COORDINATOR_PORT = 9008
+# The number of virtual nodes of each shard on the hash ring
+SHARD_VIRTUAL_NODES = 100
+# The demand of a shard is ignored if not updated for this many seconds
+SHARD_DEMAND_MAX_AGE = 10
+# Every shard gets at least this fraction of an even share of each OSS, so
+# that an idle shard still gets a share to ramp up from
+SHARD_MIN_SHARE_FRACTION = 0.25
+# The timeout of posting the demand to the coordinator
+SHARD_POST_TIMEOUT = 5
+COORDINATOR = None
+
+
+def ring_hash(key):
+    """
+    Return the position of a key on the hash ring
+    """
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring that maps job IDs to shards
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, shards, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.hr_shards = list(shards)
+        # Sorted list of (position, shard)
+        self.hr_nodes = []
+        for shard in self.hr_shards:
+            for index in range(virtual_nodes):
+                self.hr_nodes.append((ring_hash("%s#%d" % (shard, index)),
+                                      shard))
+        self.hr_nodes.sort()
+        self.hr_positions = [node[0] for node in self.hr_nodes]
+
+    def hr_shard(self, job_id):
+        """
+        Return the shard that owns the job
+        """
+        if len(self.hr_nodes) == 0:
+            return None
+        index = bisect.bisect(self.hr_positions, ring_hash(job_id))
+        if index == len(self.hr_nodes):
+            index = 0
+        return self.hr_nodes[index][1]
+
+
+def sharding_parse(config):
+    """
+    Parse the "sharding" section of the configuration, return (shard names,
+    URL of the coordinator), None on failure
+    """
+    shards = config.get("shards")
+    if not isinstance(shards, list) or len(shards) == 0:
+        logging.error("no shards in sharding config [%s]", config)
+        return None
+    if len(set(shards)) != len(shards):
+        logging.error("duplicated shards in sharding config [%s]", config)
+        return None
+    return shards, config.get("coordinator")
+
+
+class ShardMember(object):
+    """
+    The shard of this LIME process
+    """
+    def __init__(self, name, shards, coordinator=None):
+        self.shm_name = name
+        self.shm_ring = HashRing(shards)
+        self.shm_shard_number = len(shards)
+        # URL of /shard_demand of the coordinator, None if the capacity is
+        # split evenly
+        self.shm_url = None
+        if coordinator is not None:
+            self.shm_url = coordinator.rstrip("/") + "/shard_demand"
+
+    def shm_owns(self, job_id):
+        """
+        Whether the job belongs to this shard
+        """
+        return self.shm_ring.hr_shard(job_id) == self.shm_name
+
+    def shm_rule_foreign(self, rule):
+        """
+        Whether a TBF rule was started by another shard, i.e. any job that
+        it matches belongs to another shard
+        """
+        for job_id in rule.tr_expression.split():
+            if not self.shm_owns(job_id):
+                return True
+        return False
+
+    def shm_primary(self):
+        """
+        Whether this is the first shard, which does the work that should
+        be done only once for all the shards, e.g. starting the workloads
+        """
+        return self.shm_name == self.shm_ring.hr_shards[0]
+
+    def shm_share_default(self):
+        """
+        Return the share of the capacity of an OSS before the coordinator
+        answers
+        """
+        return 1.0 / self.shm_shard_number
+
+    def shm_shares_request(self, fsname, demand):
+        """
+        Post the demand of this shard on the OSSes of a cluster to the
+        coordinator. Return a dict, key is hostname, value is the share of
+        the capacity of the OSS, None on failure.
+        """
+        if self.shm_url is None:
+            return None
+        data = json.dumps({"shard": self.shm_name, "cluster": fsname,
+                           "demand": demand})
+        post = urllib2.Request(self.shm_url, data,
+                               {"Content-Type": "application/json"})
+        try:
+            reply = urllib2.urlopen(post, timeout=SHARD_POST_TIMEOUT).read()
+        except (urllib2.URLError, IOError) as error:
+            logging.error("failed to post shard demand to [%s]: %s",
+                          self.shm_url, error)
+            return None
+        try:
+            return json.loads(reply)["shares"]
+        except (ValueError, KeyError, TypeError):
+            logging.error("invalid reply from coordinator [%s]: [%s]",
+                          self.shm_url, reply)
+            return None
+
+
+class ShardCoordinator(object):
+    """
+    Split the capacity of each OSS between the shards by their demands
+    """
+    def __init__(self, max_age=SHARD_DEMAND_MAX_AGE):
+        self.sco_max_age = max_age
+        # Key is cluster name, value is a dict, key is shard name, value
+        # is (time, demand dict of hosts)
+        self.sco_demands = {}
+
+    def sco_demand_update(self, shard, fsname, demand, now=None):
+        """
+        Save the demand of a shard on the OSSes of a cluster, return the
+        shares of the shard
+        """
+        if now is None:
+            now = time.time()
+        shard_demands = self.sco_demands.setdefault(fsname, {})
+        shard_demands[shard] = (now, demand)
+        for name, entry in shard_demands.items():
+            if now - entry[0] > self.sco_max_age:
+                logging.info("shard [%s] of cluster [%s] is stale",
+                             name, fsname)
+                del shard_demands[name]
+
+        shard_number = len(shard_demands)
+        min_share = SHARD_MIN_SHARE_FRACTION / shard_number
+        shares = {}
+        for hostname, host_demand in demand.iteritems():
+            total = 0.0
+            for _, shard_demand in shard_demands.values():
+                total += shard_demand.get(hostname, 0.0)
+            if total <= 0:
+                shares[hostname] = 1.0 / shard_number
+                continue
+            shares[hostname] = (min_share +
+                                (1.0 - min_share * shard_number) *
+                                host_demand / total)
+        return shares
+
+
+@COORDINATOR_APP.route("/shard_demand", methods=['POST'])
+def coordinator_shard_demand():
+    """
+    A shard posted its demand
+    """
+    message = request.json
+    shares = COORDINATOR.sco_demand_update(message["shard"],
+                                           message["cluster"],
+                                           message["demand"])
+    return json.dumps({"shares": shares})
+
+
+def main():
+    """
+    Parse the options and start the coordinator
+    """
+    # pylint: disable=global-statement
+    global COORDINATOR
+    parser = optparse.OptionParser()
+    parser.add_option("--port", type="int", default=COORDINATOR_PORT,
+                      help="port to receive the demands of the shards")
+    parser.add_option("--max-age", type="float",
+                      default=SHARD_DEMAND_MAX_AGE,
+                      help="seconds until the demand of a shard is stale")
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    COORDINATOR = ShardCoordinator(options.max_age)
+    http_server = WSGIServer(('0.0.0.0', options.port), COORDINATOR_APP)
+    http_server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
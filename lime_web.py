@@ -5,8 +5,10 @@
 """
 Web inteface of LIME
 """
+import atexit
 import collections
 import json
+import optparse
 import os
 import threading
 import logging
@@ -14,25 +16,70 @@ import logging.handlers
 import time
 import sys
 import random
+import socket
 from gevent.wsgi import WSGIServer
 from gevent import monkey, sleep
 from geventwebsocket.handler import WebSocketHandler
 from geventwebsocket.exceptions import WebSocketError
 
 import utils
+import collectd_metric
 import lustre_config
-
-from flask import Flask, render_template, request
+import lustre_benchmark
+import rate_table
+import lime_metrics
+import lime_debug
+import lime_shard
+import heavy_hitters
+import rate_classes
+import tick_scheduler
+
+from flask import Flask, Response, render_template, request
 APP = Flask(__name__)
 
-
-METRIC_INTERVAL = 1
-CLUSTER = None
 DEFAULT_RATE_LIMIT = 10000
 MIN_RATE_LIMIT = 10
 MIN_GRL_RATE = 1
 MAX_REAL_IOPS = 500
 MAX_FAKE_IOPS = 1500
+# The interval of reading back the TBF rules on OSSes
+TBF_RULES_POLL_INTERVAL = 10
+# The weight of the newest observation of RPCs per unit of the rate
+RPC_RATIO_EWMA_WEIGHT = 0.2
+# The TBF rate is updated if the RPC ratio drifts more than this fraction
+RPC_RATIO_TOLERANCE = 0.1
+# The interval of reading the rate table while waiting for a tick
+RATE_TABLE_POLL_INTERVAL = 0.1
+# The default configuration file
+CONFIG_FILE = "static/lime_config.json"
+# The default port of the web server
+WEB_PORT = 24
+# The demand of a shard on a host is raised by this factor if its jobs are
+# near their limits, so that a throttled shard could get more capacity
+SHARD_DEMAND_GROWTH = 1.25
+# The default interval of promoting the heaviest jobs to watched jobs
+DISCOVERY_INTERVAL = 10
+# The default number of the heaviest jobs that are watched by the discovery
+DISCOVERY_TOP = 10
+# A discovered job is kept while it is among this many times of the number
+# of the heaviest jobs
+DISCOVERY_KEEP_RATIO = 2
+# A discovered job is stopped after it is not kept for this many intervals
+DISCOVERY_DEMOTE_INTERVALS = 3
+# The default seconds of profiling by /debug/profile
+DEBUG_PROFILE_SECONDS = 10
+# The service ID of the summary of all OSTs on a host from a relay
+RELAY_SERVICE = "relay"
+# The default port of the ingestion workers
+INGEST_PORT = 9006
+# The backlog of the listening socket of the ingestion workers
+INGEST_BACKLOG = 1024
+# The table that the ingestion workers write counters to, None if the
+# metrics are posted to the controller process directly
+RATE_TABLE = None
+# The shard of this process, None if not sharded, see lime_shard.py
+SHARD = None
+INGEST_APP = Flask("lime_ingest")
 
 class RatePolicy(object):
     # pylint: disable=too-few-public-methods
@@ -49,13 +96,14 @@ class RatePolicy(object):
 
     def rp_evaluate(self, job, fake_io):
         if job.wj_rate_limit is None:
-            logging.error("job rate limit is None.")
+            utils.log_limited(logging.DEBUG, "job rate limit is None.")
             return
 
-        if fake_io:
-            Et = min(job.wj_rate_limit, CLUSTER.lc_max_real_iops)
-        else:
-            Et = min(job.wj_rate_limit, CLUSTER.lc_max_fake_iops)
+        # The expectation can't be higher than what the targets can deliver
+        Et = job.wj_rate_limit
+        capacity = job.wj_capacity(fake_io)
+        if capacity is not None:
+            Et = min(Et, capacity)
 
         Rt = job.wj_rate
         self.rp_absum_diff += abs(Et - Rt)
@@ -64,6 +112,33 @@ class RatePolicy(object):
         logging.debug("Evaluation: [%f] algo [%s]",
                       self.rp_eva, self.rp_name)
 
+def capacity_split(total, hosts):
+    """
+    Split the total rate limit between the hosts evenly, but never give a
+    host more than its maximum rate limit. The rate that can't be used by a
+    host is given to the other hosts. Return a dict of host -> rate limit.
+    """
+    limits = {}
+    remaining = list(hosts)
+    left = total
+    while len(remaining) > 0:
+        share = left / len(remaining)
+        capped = []
+        for host in remaining:
+            max_limit = host.hfj_max_rate_limit()
+            if max_limit < share:
+                capped.append(host)
+                limits[host] = max_limit
+                left -= max_limit
+        if len(capped) == 0:
+            for host in remaining:
+                limits[host] = share
+            break
+        for host in capped:
+            remaining.remove(host)
+    return limits
+
+
 class GlobalRatePolicy(RatePolicy):
     """
     The policy tries to maintain the aggregate bandwidth of
@@ -92,10 +167,9 @@ class GlobalRatePolicy(RatePolicy):
             logging.debug("GRL: job rate limit is None.");
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                if host.hfj_rate_limit < DEFAULT_RATE_LIMIT:
-                    host.hfj_rate_limit = DEFAULT_RATE_LIMIT
-                    host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                     DEFAULT_RATE_LIMIT)
+                max_limit = host.hfj_max_rate_limit()
+                if host.hfj_rate_limit != max_limit:
+                    host.hfj_change_tbf_rate(max_limit)
             return
         if job.wj_current_rate_limit != job.wj_rate_limit:
             # IMPROVE: not perfect algorithm, set on active hosts,
@@ -104,10 +178,12 @@ class GlobalRatePolicy(RatePolicy):
             if num == 0:
                 return
             activeNum = 0
+            active_hosts = []
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
                 if host.hfj_rate > 0:
                     activeNum += 1
+                    active_hosts.append(host)
 
             rateLimit = MIN_GRL_RATE
             inRateLimit = MIN_GRL_RATE
@@ -123,14 +199,16 @@ class GlobalRatePolicy(RatePolicy):
                           "inactive hosts [%d] inRateLimit [%d], evaluation [%f]",
                           job.wj_rate_limit, job.wj_rate, activeNum, rateLimit,
                           num - activeNum, inRateLimit, self.rp_eva)
+            # The rate that a saturated host can't deliver is moved to the
+            # other active hosts
+            active_limits = capacity_split(rateLimit * activeNum,
+                                           active_hosts)
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
                 if host.hfj_rate > 0:
-                    host.hfj_rate_limit = rateLimit
+                    host.hfj_change_tbf_rate(active_limits[host])
                 else:
-                    host.hfj_rate_limit = inRateLimit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 host.hfj_rate_limit)
+                    host.hfj_change_tbf_rate(inRateLimit)
             job.wj_current_rate_limit = job.wj_rate_limit
             return
 
@@ -158,24 +236,20 @@ class IndependentRatePolicy(RatePolicy):
         if job.wj_rate_limit is None:
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                if host.hfj_rate_limit < DEFAULT_RATE_LIMIT:
-                    host.hfj_rate_limit = DEFAULT_RATE_LIMIT
-                    host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                     DEFAULT_RATE_LIMIT)
+                max_limit = host.hfj_max_rate_limit()
+                if host.hfj_rate_limit != max_limit:
+                    host.hfj_change_tbf_rate(max_limit)
             return
         if job.wj_current_rate_limit != job.wj_rate_limit:
             # IMPROVE: not perfect algorithm, need to set on active hosts,
             # rather than all hosts.
             if len(job.wj_hosts) == 0:
                 return
-            rate_limit = job.wj_rate_limit / len(job.wj_hosts)
-            if rate_limit > DEFAULT_RATE_LIMIT:
-                rate_limit = DEFAULT_RATE_LIMIT
+            limits = capacity_split(job.wj_rate_limit,
+                                    job.wj_hosts.values())
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                host.hfj_rate_limit = rate_limit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 rate_limit)
+                host.hfj_change_tbf_rate(limits[host])
             job.wj_current_rate_limit = job.wj_rate_limit
             return
 
@@ -308,12 +382,12 @@ class ActionHistory(object):
         Regret the action
         """
         assert self.ah_stage == ActionHistory.STAGE_ACTED
-        logging.error("changing rate of host [%s] for job [%s] from [%d] "
-                      "back to [%d]",
-                      self.ah_action_hostname,
-                      self.ah_action_job_id,
-                      self.ah_action_limit_after,
-                      self.ah_action_limit_before)
+        logging.info("changing rate of host [%s] for job [%s] from [%d] "
+                     "back to [%d]",
+                     self.ah_action_hostname,
+                     self.ah_action_job_id,
+                     self.ah_action_limit_after,
+                     self.ah_action_limit_before)
         if self.ah_action_job_id not in self.ah_qos_task.wjs_jobs:
             return -1
         job = self.ah_qos_task.wjs_jobs[self.ah_action_job_id]
@@ -334,12 +408,12 @@ class ActionHistory(object):
         if (self.ah_action_type == ActionHistory.ACTION_DECREASE_MYSELF or
                 self.ah_action_type == ActionHistory.ACTION_INCREASE_MYSELF or
                 self.ah_action_type == ActionHistory.ACTION_DECREASE_OTHERS):
-            logging.error("changing rate of host [%s] for job [%s] from [%d] "
-                          "to [%d]",
-                          self.ah_action_hostname,
-                          self.ah_action_job_id,
-                          self.ah_action_limit_before,
-                          self.ah_action_limit_after)
+            logging.info("changing rate of host [%s] for job [%s] from [%d] "
+                         "to [%d]",
+                         self.ah_action_hostname,
+                         self.ah_action_job_id,
+                         self.ah_action_limit_before,
+                         self.ah_action_limit_after)
             if self.ah_action_job_id not in self.ah_qos_task.wjs_jobs:
                 return -1
             job = self.ah_qos_task.wjs_jobs[self.ah_action_job_id]
@@ -360,7 +434,7 @@ class ActionHistory(object):
         """
         job_id = self.ah_job_id
         action_id = self.ah_action_job_id
-        logging.error("processing action with stage [%s]", self.ah_stage)
+        logging.debug("processing action with stage [%s]", self.ah_stage)
         if self.ah_stage == ActionHistory.STAGE_ACTED:
             self.ah_rates_after_action = qos_task.wjs_save_rates(job_id,
                                                                  action_id)
@@ -382,11 +456,11 @@ class ActionHistory(object):
             self.ah_rates_after_regret = qos_task.wjs_save_rates(job_id,
                                                                  action_id)
             if self.ah_declined_after_regret():
-                logging.error("action caused declining and regetting "
-                              "didn't recover it")
+                logging.info("action caused declining and regetting "
+                             "didn't recover it")
             else:
-                logging.error("action caused declining and regetting "
-                              "recovered it")
+                logging.info("action caused declining and regetting "
+                             "recovered it")
         return False
 
 
@@ -428,17 +502,14 @@ class PriorityRatePolicy(RatePolicy):
                 continue
             # IMPROVE: not perfect algorithm, need to set on active hosts,
             # rather than all hosts.
-            rate_limit = job.wj_rate_limit / len(job.wj_hosts)
-            if rate_limit > DEFAULT_RATE_LIMIT:
-                rate_limit = DEFAULT_RATE_LIMIT
+            limits = capacity_split(job.wj_rate_limit,
+                                    job.wj_hosts.values())
             for hostname in job.wj_hosts:
                 host = job.wj_hosts[hostname]
-                host.hfj_rate_limit = rate_limit
-                host.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
-                                                 rate_limit)
+                host.hfj_change_tbf_rate(limits[host])
                 changed = True
-                logging.error("updated rate limit of job [%s] on host [%s] "
-                              "from GUI", job_id, hostname)
+                logging.info("updated rate limit of job [%s] on host [%s] "
+                             "from GUI", job_id, hostname)
         return changed
 
     def prp_increase_self(self, qos_task, job, job_id, failure_time):
@@ -448,14 +519,15 @@ class PriorityRatePolicy(RatePolicy):
         hosts = job.wj_hosts_random()
         selected = None
         for host in hosts:
-            logging.error("checking host [%s] with total throughput [%d]",
+            logging.debug("checking host [%s] with total throughput [%d]",
                           host.hfj_host.sh_hostname, host.hfj_rate)
             diff = MIN_RATE_LIMIT * 2
             limit_after = host.hfj_rate_limit + diff
-            if limit_after > DEFAULT_RATE_LIMIT:
-                limit_after = DEFAULT_RATE_LIMIT
-            if limit_after == host.hfj_rate_limit:
-                logging.error("not able to start an increase action for job "
+            max_limit = host.hfj_max_rate_limit()
+            if limit_after > max_limit:
+                limit_after = max_limit
+            if limit_after <= host.hfj_rate_limit:
+                logging.debug("not able to start an increase action for job "
                               "[%s] on host [%s] because the action would "
                               "change nothing", job_id,
                               host.hfj_host.sh_hostname)
@@ -469,9 +541,9 @@ class PriorityRatePolicy(RatePolicy):
                                 job_id, selected.hfj_host.sh_hostname,
                                 selected.hfj_rate_limit, limit_after,
                                 ActionHistory.RESULT_RISE)
-        logging.error("trying to increase rate of job [%s] by "
-                      "increasing its limitation",
-                      job_id)
+        logging.info("trying to increase rate of job [%s] by "
+                     "increasing its limitation",
+                     job_id)
         new_act.ah_failure_time = failure_time
         ret = new_act.ah_act()
         if ret:
@@ -483,15 +555,15 @@ class PriorityRatePolicy(RatePolicy):
         """
         Decrease the rate of some other job.
         """
-        logging.error("trying to increase rate of job [%s] by "
-                      "decreasing rates of other jobs", job_id)
+        logging.info("trying to increase rate of job [%s] by "
+                     "decreasing rates of other jobs", job_id)
         host = None
         for hostname in job.wj_hosts:
-            logging.error("checking any job to decrease rate on host [%s] ",
+            logging.debug("checking any job to decrease rate on host [%s] ",
                           hostname)
             higher_priority = True
             if hostname not in job.wj_hosts:
-                logging.error("not going to decrease jobs on host [%s] "
+                logging.debug("not going to decrease jobs on host [%s] "
                               "because job [%s] has no rate on host [%s]",
                               hostname, job_id, hostname)
                 continue
@@ -501,15 +573,15 @@ class PriorityRatePolicy(RatePolicy):
                     higher_priority = False
                     continue
                 if higher_priority:
-                    logging.error("not going to decrease job [%s] because "
+                    logging.debug("not going to decrease job [%s] because "
                                   "it has higher priority", tmp_job_id)
                     continue
                 if tmp_job.wj_rate == 0:
-                    logging.error("not going to decrease job [%s] because "
+                    logging.debug("not going to decrease job [%s] because "
                                   "it has no rate", tmp_job_id)
                     continue
                 if hostname not in tmp_job.wj_hosts:
-                    logging.error("not going to decrease job [%s] because "
+                    logging.debug("not going to decrease job [%s] because "
                                   "it has no rate on host [%s]", tmp_job_id,
                                   hostname)
                     continue
@@ -517,12 +589,12 @@ class PriorityRatePolicy(RatePolicy):
                 if host is None or host.hfj_rate < tmp_host.hfj_rate:
                     host = tmp_host
         if host is None:
-            logging.error("no job to decrease rate in order to "
-                          "increase rate of job [%s]", job_id)
+            utils.log_limited(logging.INFO, "no job to decrease rate in "
+                              "order to increase rate of job [%s]", job_id)
             return -1
-        logging.error("selected job [%s] to decrease rate in order to "
-                      "increase rate of job [%s]", host.hfj_job.wj_job_id,
-                      job_id)
+        logging.info("selected job [%s] to decrease rate in order to "
+                     "increase rate of job [%s]", host.hfj_job.wj_job_id,
+                     job_id)
         # Decrease the rate to provide extra rate for job with higher priority
         #if job.wj_rate_limit is None:
         #    diff = DEFAULT_RATE_LIMIT
@@ -533,8 +605,8 @@ class PriorityRatePolicy(RatePolicy):
         #    limit_after = MIN_RATE_LIMIT
         limit_after = MIN_RATE_LIMIT
         if host.hfj_rate_limit == limit_after:
-            logging.error("no job to decrease rate in order to "
-                          "increase rate of job [%s]", job_id)
+            utils.log_limited(logging.INFO, "no job to decrease rate in "
+                              "order to increase rate of job [%s]", job_id)
             return -1
         new_act = ActionHistory(qos_task, job_id,
                                 ActionHistory.ACTION_DECREASE_OTHERS,
@@ -554,7 +626,7 @@ class PriorityRatePolicy(RatePolicy):
         """
         Start an action. If started, return 0, else -1.
         """
-        logging.error("checking whether to start an action for job [%s]",
+        logging.debug("checking whether to start an action for job [%s]",
                       job_id)
         if job_id not in qos_task.wjs_jobs:
             return -1
@@ -564,9 +636,9 @@ class PriorityRatePolicy(RatePolicy):
                 rate > job.wj_rate_limit * 11 / 10):
             host = job.wj_highest_throughput_host()
             if host is None or host.hfj_rate < MIN_RATE_LIMIT:
-                logging.error("not able to start a decrease action for job "
-                              "[%s] because all host has very small rate",
-                              job_id)
+                utils.log_limited(logging.INFO, "not able to start a decrease "
+                                  "action for job [%s] because all host has "
+                                  "very small rate", job_id)
                 return -1
 
             diff = rate - job.wj_rate_limit
@@ -584,8 +656,8 @@ class PriorityRatePolicy(RatePolicy):
             if ret:
                 return ret
             self.prp_last_action = new_act
-            logging.error("trying to decrease rate of job [%s]",
-                          job_id)
+            logging.info("trying to decrease rate of job [%s]",
+                         job_id)
             return 0
 
         action = self.prp_last_action
@@ -657,8 +729,8 @@ class PriorityRatePolicy(RatePolicy):
             else:
                 if action.ah_failure_time > self.prp_max_failures:
                     self.prp_last_action = None
-                    logging.error("too many action failures for job [%s], "
-                                  "won't try any more", job_id)
+                    logging.warning("too many action failures for job "
+                                    "[%s], won't try any more", job_id)
                 else:
                     ret = self.prp_start_action(qos_task, job_id,
                                                 action.ah_failure_time)
@@ -689,9 +761,12 @@ class PriorityRatePolicy(RatePolicy):
 
 class WatchedJobs(object):
     """
-    All the watched Jobs will be group here
+    All the watched Jobs will be group here. Each Lustre cluster has its
+    own object of WatchedJobs, which is the controller of the cluster with
+    its own tick loop.
     """
-    def __init__(self, fake_io):
+    def __init__(self, cluster, fake_io):
+        self.wjs_cluster = cluster
         self.wjs_jobs = collections.OrderedDict()
         self.wjs_condition = threading.Condition()
 
@@ -704,8 +779,37 @@ class WatchedJobs(object):
         self.wjs_rate_policies.append(self.wjs_priority_policy)
         self.wjs_current_policy = self.wjs_priority_policy
         self.wjs_current_fake_io = fake_io
+        # The expected interval of the datapoints from Collectd
+        self.wjs_metric_interval = collectd_metric.COUNTER_INTERVAL
+        # A series without datapoint for this long has a rate of 0
+        self.wjs_metric_max_age = collectd_metric.COUNTER_MAX_AGE
+        self.wjs_scheduler = tick_scheduler.TickScheduler(
+            self.wjs_metric_interval)
+        # The shares of the capacity of the OSSes given to this shard by
+        # the coordinator, key is hostname
+        self.wjs_shares = {}
+        # The discovery of the heaviest jobs, None if disabled
+        self.wjs_discovery = None
+        self.wjs_discovery_top = DISCOVERY_TOP
+        self.wjs_discovery_interval = DISCOVERY_INTERVAL
+        # The rate limit of the discovered jobs
+        self.wjs_discovery_rate_limit = DEFAULT_RATE_LIMIT
+        # The rate classes that share TBF rules between jobs, None if each
+        # job has its own rule, see rate_classes.py
+        self.wjs_rate_classes = None
+        self.wjs_rebalance_interval = \
+            rate_classes.RATE_CLASS_REBALANCE_INTERVAL
         utils.thread_start(self.wjs_datapoints_send, ())
 
+    def wjs_lock(self, caller):
+        """
+        Acquire the lock of the jobs, the time waiting for it is measured
+        """
+        start = time.time()
+        self.wjs_condition.acquire()
+        lime_metrics.LOCK_WAIT_SECONDS.mh_observe(time.time() - start,
+                                                  (caller,))
+
     def _wjs_find_job(self, job_id):
         """
         Find job according to its job ID
@@ -719,78 +823,539 @@ class WatchedJobs(object):
         """
         Find job according to its job ID
         """
-        self.wjs_condition.acquire()
+        self.wjs_lock("wjs_find_job")
         job = self._wjs_find_job(job_id)
         self.wjs_condition.release()
         return job
 
-    def wjs_watch_job(self, job_id, websocket):
+    def wjs_watch_job(self, job_id, websocket, metric=None):
         """
-        A websocket connected, so watch the job
+        A websocket connected, so watch the job. The metric is what the
+        policies target for the job, see metric_weights_parse().
         """
-        self.wjs_condition.acquire()
+        if SHARD is not None and not SHARD.shm_owns(job_id):
+            logging.error("job [%s] belongs to shard [%s], not [%s]",
+                          job_id, SHARD.shm_ring.hr_shard(job_id),
+                          SHARD.shm_name)
+            return -1
+        self.wjs_lock("wjs_watch_job")
         job = self._wjs_find_job(job_id)
         if job is None:
-            job = WatchedJob(job_id, WATCHED_JOBS)
-            self.wjs_jobs[job_id] = job
-            tbf_name = lustre_config.tbf_escape_name(job_id)
-            CLUSTER.lc_start_tbf_rule(tbf_name, job_id, DEFAULT_RATE_LIMIT)
+            job = self._wjs_add_job(job_id,
+                                    collectd_metric.metric_weights_parse(
+                                        metric))
+            if job is None:
+                self.wjs_condition.release()
+                return -1
         job.wj_websockets.append(websocket)
         self.wjs_condition.release()
+        return 0
+
+    def _wjs_add_job(self, job_id, weights=None):
+        """
+        Add a job and start its TBF rule, return the job, None if the
+        rate classes have no room for it. The weights are the metric that
+        the job chooses, None for the default.
+        """
+        job = WatchedJob(job_id, self)
+        if weights is not None:
+            job.wj_metric_weights = weights
+        if self.wjs_rate_classes is None:
+            self.wjs_jobs[job_id] = job
+            self._wjs_job_rule_start(job)
+            return job
+        moves = []
+        ret = self.wjs_rate_classes.rcm_assign(job_id, moves)
+        if ret:
+            logging.error("no TBF rule could limit job [%s] of cluster [%s]",
+                          job_id, self.wjs_cluster.lc_fsname)
+            return None
+        self.wjs_jobs[job_id] = job
+        job.wj_rate_class = self.wjs_rate_classes.rcm_job_classes[job_id]
+        changed_classes = []
+        if job.wj_rate_class is None:
+            self._wjs_job_rule_start(job)
+        else:
+            changed_classes.append(job.wj_rate_class)
+        self._wjs_rate_classes_apply(moves, changed_classes)
+        return job
+
+    def _wjs_remove_job(self, job_id):
+        """
+        Stop the TBF rule of a job and remove it
+        """
+        job = self.wjs_jobs.pop(job_id)
+        if self.wjs_rate_classes is not None:
+            self.wjs_rate_classes.rcm_remove(job_id)
+        if job.wj_rate_class is None:
+            self.wjs_cluster.lc_stop_tbf_rule(job.wj_tbf_name)
+        else:
+            self._wjs_class_rule_update(job.wj_rate_class)
+
+    def wjs_job_tbf_rate(self, job, hostname):
+        """
+        Return the TBF rate that the limit of a job on a host converts to.
+        Before the job has datapoints from the host, the default limit is
+        converted with the average RPC ratio of the other jobs of the same
+        metric on the host.
+        """
+        host = job.wj_hosts.get(hostname)
+        if host is None:
+            ratios = []
+            for other in self.wjs_jobs.itervalues():
+                other_host = other.wj_hosts.get(hostname)
+                if (other_host is None or
+                        other_host.hfj_rpc_ratio is None or
+                        other.wj_metric_weights != job.wj_metric_weights):
+                    continue
+                ratios.append(other_host.hfj_rpc_ratio)
+            ratio = None
+            if len(ratios) > 0:
+                ratio = sum(ratios) / len(ratios)
+            return tbf_rate_convert(DEFAULT_RATE_LIMIT, ratio)
+        if host.hfj_tbf_rate is not None:
+            return host.hfj_tbf_rate
+        return host.hfj_tbf_rate_convert(host.hfj_rate_limit)
+
+    def wjs_class_tbf_rate(self, rate_class, hostname, extra_job_ids=None):
+        """
+        Return the TBF rate of a class on a host, which is the sum of the
+        rates of its jobs and the extra jobs
+        """
+        job_ids = rate_class.rc_job_ids
+        if extra_job_ids is not None:
+            job_ids = job_ids | extra_job_ids
+        rate = 0
+        for job_id in job_ids:
+            rate += self.wjs_job_tbf_rate(self.wjs_jobs[job_id], hostname)
+        return rate
+
+    def _wjs_job_rule_start(self, job):
+        """
+        Start the own TBF rule of a job with its current limit on each host
+        """
+        for host in self.wjs_cluster.lc_oss_hosts():
+            hostname = host.sh_hostname
+            ret = host.lh_start_tbf_rule(job.wj_tbf_name, job.wj_job_id,
+                                         self.wjs_job_tbf_rate(job,
+                                                               hostname))
+            if ret:
+                logging.error("failed to start TBF rule [%s] on host [%s]",
+                              job.wj_tbf_name, hostname)
+
+    def _wjs_class_rule_update(self, rate_class, extra_job_ids=None):
+        """
+        Start the TBF rule of a class after its jobs changed, or stop it if
+        no job is left. The rule of a pool is started under its other name
+        before the old rule is stopped on each host, so that its jobs always
+        match a rule. If the start fails on a host, the old rule is kept.
+        The extra jobs are still matched by the rule, e.g. the jobs leaving
+        the pool until their own rules are started.
+        """
+        old_name = rate_class.rc_rule_name
+        if len(rate_class.rc_job_ids) == 0 and not extra_job_ids:
+            if old_name is not None:
+                self.wjs_cluster.lc_stop_tbf_rule(old_name)
+                rate_class.rc_rule_name = None
+            return
+        name = rate_class.rc_rule_next_name()
+        expression = rate_class.rc_expression(extra_job_ids)
+        for host in self.wjs_cluster.lc_oss_hosts():
+            hostname = host.sh_hostname
+            rate = self.wjs_class_tbf_rate(rate_class, hostname,
+                                           extra_job_ids)
+            ret = host.lh_start_tbf_rule(name, expression, rate)
+            if ret:
+                logging.error("failed to start TBF rule [%s] on host [%s]",
+                              name, hostname)
+                continue
+            if old_name is None or old_name == name:
+                continue
+            ret = host.lh_stop_tbf_rule(old_name)
+            if ret:
+                logging.error("failed to stop TBF rule [%s] on host [%s]",
+                              old_name, hostname)
+        rate_class.rc_rule_name = name
+
+    def _wjs_rate_classes_apply(self, moves, changed_classes):
+        """
+        Start and stop the TBF rules after jobs moved between the rate
+        classes. The classes that jobs join are started first, still
+        matching the jobs that leave them. Then the own rules of the jobs
+        that joined a class are stopped and the own rules of the jobs that
+        left are started, and at last the classes they left are updated.
+        So the jobs always match a rule, and at most one more rule than the
+        bound is active at any time.
+        """
+        demoted_jobs = []
+        promoted_jobs = []
+        # Key is a class, value is the set of the IDs of the jobs that left
+        leaving_jobs = {}
+        for job_id, old_class, new_class in moves:
+            job = self.wjs_jobs[job_id]
+            job.wj_rate_class = new_class
+            if new_class is None:
+                logging.info("job [%s] moves from rule [%s] to its own rule",
+                             job_id, old_class.rc_name)
+                promoted_jobs.append(job)
+                leaving_jobs.setdefault(old_class, set()).add(job_id)
+            else:
+                logging.info("job [%s] moves from its own rule to rule [%s]",
+                             job_id, new_class.rc_name)
+                demoted_jobs.append(job)
+                changed_classes.append(new_class)
+        for rate_class in set(changed_classes):
+            self._wjs_class_rule_update(rate_class,
+                                        leaving_jobs.get(rate_class))
+        for job in demoted_jobs:
+            if job.wj_rate_class is not None:
+                self.wjs_cluster.lc_stop_tbf_rule(job.wj_tbf_name)
+        for job in promoted_jobs:
+            if job.wj_rate_class is None:
+                self._wjs_job_rule_start(job)
+        for rate_class in leaving_jobs:
+            self._wjs_class_rule_update(rate_class)
+
+    def wjs_rate_classes_rebalance(self):
+        """
+        Give the own TBF rules to the heaviest jobs and move the others to
+        the pool rules
+        """
+        self.wjs_lock("wjs_rate_classes_rebalance")
+        job_rates = {}
+        for job_id, job in self.wjs_jobs.iteritems():
+            job_rates[job_id] = job.wj_rate or 0
+        moves = self.wjs_rate_classes.rcm_rebalance(job_rates)
+        self._wjs_rate_classes_apply(moves, [])
+        self.wjs_condition.release()
+
+    def wjs_rate_classes_loop(self):
+        """
+        Rebalance the rate classes every rebalance interval
+        """
+        while True:
+            sleep(self.wjs_rebalance_interval)
+            self.wjs_rate_classes_rebalance()
 
     def wjs_unwatch_job(self, job_id, websocket):
         """
         A websocket disconnected, so unwatch the job
         """
-        self.wjs_condition.acquire()
+        self.wjs_lock("wjs_unwatch_job")
         job = self._wjs_find_job(job_id)
         if job is None:
             self.wjs_condition.release()
             return -1
         if websocket in job.wj_websockets:
             job.wj_websockets.remove(websocket)
-        if len(job.wj_websockets) == 0:
-            tbf_name = lustre_config.tbf_escape_name(job_id)
-            CLUSTER.lc_stop_tbf_rule(tbf_name)
-            del self.wjs_jobs[job_id]
+        if len(job.wj_websockets) == 0 and not job.wj_discovered:
+            self._wjs_remove_job(job_id)
         self.wjs_condition.release()
         return 0
 
-    def wjs_metric_received(self, service_id, job_id, timestamp, value):
+    def wjs_metric_received(self, service_id, job_id, metric, timestamp,
+                            value):
         """
         Recived a datapoint
         """
-        self.wjs_condition.acquire()
+        # pylint: disable=too-many-arguments
+        self.wjs_scheduler.tks_report(service_id, timestamp)
+        self.wjs_lock("wjs_metric_received")
         job = self._wjs_find_job(job_id)
+        if self._wjs_discovery_counts(job, job_id):
+            self.wjs_discovery.hhd_datapoint_add(service_id, job_id, metric,
+                                                 value)
         if job is None:
             self.wjs_condition.release()
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("post", "unknown_job"))
             return 1
-        job.wj_datapoint_add(service_id, timestamp, value)
+        job.wj_datapoint_add(service_id, metric, timestamp, value)
         self.wjs_condition.release()
+        lime_metrics.DATAPOINTS_INGESTED.mc_inc(("post",))
         return 0
 
-    def wjs_datapoints_send(self):
+    def wjs_summary_received(self, hostname, job_id, metric, timestamp,
+                             rate):
         """
-        Send datapoints of jobs
+        Recived the summary of a job on a host from a relay
         """
+        # pylint: disable=too-many-arguments
+        host = self.wjs_cluster.lc_host_find(hostname)
+        if host is None:
+            utils.log_limited(logging.ERROR, "summary of job [%s] from "
+                              "unknown host [%s]", job_id, hostname)
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("relay", "unknown_host"))
+            return -1
+        self.wjs_scheduler.tks_report(host.sh_hostname, timestamp)
+        self.wjs_lock("wjs_summary_received")
+        job = self._wjs_find_job(job_id)
+        if self._wjs_discovery_counts(job, job_id):
+            self.wjs_discovery.hhd_summary_add(job_id, metric, rate,
+                                               self.wjs_metric_interval)
+        if job is None:
+            self.wjs_condition.release()
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("relay", "unknown_job"))
+            return 1
+        job.wj_summary_add(host, metric, timestamp, rate)
+        self.wjs_condition.release()
+        lime_metrics.DATAPOINTS_INGESTED.mc_inc(("relay",))
+        return 0
+
+    def wjs_datapoints_send(self):
+        """
+        Send datapoints of jobs. Each tick updates the rates, tunes the
+        limits and then sends the datapoints, the time of each phase is
+        measured and traced. The ticks are scheduled by the watermark of
+        the datapoints, see tick_scheduler.py.
+        """
+        # pylint: disable=too-many-locals
+        registry = lime_metrics.REGISTRY
+        tracer = lime_debug.TRACER
+        scheduler = self.wjs_scheduler
+        poll_func = None
+        if RATE_TABLE is not None:
+            poll_func = rate_table_dispatch
         while True:
-            logging.debug("sending datapoints of jobs")
-            self.wjs_condition.acquire()
+            index, reason, lateness = scheduler.tks_wait(
+                poll_func, RATE_TABLE_POLL_INTERVAL)
+            lime_metrics.TICK_FIRES.mc_inc((reason,))
+            lime_metrics.TICK_LATENESS_SECONDS.mh_observe(lateness)
+            self.wjs_lock("wjs_datapoints_send")
+            tick_start = time.time()
+            updates = registry.mr_updates
+            for job in self.wjs_jobs.values():
+                job.wj_rate_get()
+            self.wjs_capacity_observe()
+            self.wjs_rpc_ratio_update()
+            rate_end = time.time()
+            tracer.st_span("rate", "tick", tick_start)
+            lime_metrics.TICK_SECONDS.mh_observe(rate_end - tick_start,
+                                                 ("rate",))
+
+            self.wjs_current_policy.rp_tune_func(self)
+            tune_end = time.time()
+            tracer.st_span("rp_tune_func", "tick", rate_end,
+                           {"policy": self.wjs_current_policy.rp_name})
+            lime_metrics.TICK_SECONDS.mh_observe(tune_end - rate_end,
+                                                 ("tune",))
+
             deleted_jobs = []
             for job_id, job in self.wjs_jobs.iteritems():
+                send_start = time.time()
                 ret = job.wj_datapoint_send()
+                tracer.st_span("wj_datapoint_send", "send", send_start,
+                               {"job_id": job_id})
                 if ret == 1:
                     deleted_jobs.append(job_id)
 
             for job_id in deleted_jobs:
-                tbf_name = lustre_config.tbf_escape_name(job_id)
-                CLUSTER.lc_stop_tbf_rule(tbf_name)
-                del self.wjs_jobs[job_id]
-
-            self.wjs_current_policy.rp_tune_func(self)
+                self._wjs_remove_job(job_id)
+            tick_end = time.time()
+            lime_metrics.TICK_SECONDS.mh_observe(tick_end - tune_end,
+                                                 ("send",))
+            if (tracer.st_span("tick", "tick", tick_start) >
+                    scheduler.tks_interval):
+                logging.warning("tick took [%f] seconds, longer than the "
+                                "interval [%f], rate [%f], tune [%f], "
+                                "send [%f]", tick_end - tick_start,
+                                scheduler.tks_interval, rate_end - tick_start,
+                                tune_end - rate_end, tick_end - tune_end)
+            lime_metrics.OVERHEAD_RATIO.mg_set(
+                registry.mr_overhead(registry.mr_updates - updates,
+                                     tick_end - tick_start))
             self.wjs_condition.release()
-            logging.debug("sent datapoints of jobs")
-            sleep(METRIC_INTERVAL)
+            skipped = scheduler.tks_done(index)
+            if skipped > 0:
+                lime_metrics.TICK_SKIPPED.mc_inc(amount=skipped)
+                utils.log_limited(logging.WARNING, "skipped the ticks of [%d] "
+                                  "intervals because of overrun, stats: %s",
+                                  skipped, scheduler.tks_stats())
+
+    def wjs_rate_table_add(self, updates):
+        """
+        Add the counters of this cluster that the ingestion workers updated,
+        see rate_table_dispatch()
+        """
+        self.wjs_lock("wjs_rate_table_add")
+        ingested = 0
+        for job_id, service_id, metric, timestamp, value in updates:
+            self.wjs_scheduler.tks_report(service_id, timestamp)
+            job = self._wjs_find_job(job_id)
+            if self._wjs_discovery_counts(job, job_id):
+                self.wjs_discovery.hhd_datapoint_add(service_id, job_id,
+                                                     metric, value)
+            if job is None:
+                continue
+            job.wj_datapoint_add(service_id, metric, timestamp, value)
+            ingested += 1
+        self.wjs_condition.release()
+        lime_metrics.DATAPOINTS_INGESTED.mc_inc(("rate_table",), ingested)
+        lime_metrics.DATAPOINTS_DROPPED.mc_inc(("rate_table", "unknown_job"),
+                                               len(updates) - ingested)
+
+    def _wjs_discovery_counts(self, job, job_id):
+        """
+        Whether the datapoint of a job should be counted by the discovery.
+        The watched jobs are counted too, so that the discovered jobs keep
+        their counts and stay among the heaviest jobs.
+        """
+        if self.wjs_discovery is None:
+            return False
+        return job is not None or SHARD is None or SHARD.shm_owns(job_id)
+
+    def wjs_discover(self):
+        """
+        Watch the heaviest jobs, and stop watching the discovered jobs that
+        are no longer among them unless a websocket is watching them. A
+        discovered job is kept while it is among the heaviest jobs with a
+        margin, and only stopped after it is out of them for several
+        intervals, so that the jobs don't flap.
+        """
+        self.wjs_lock("wjs_discover")
+        discovery = self.wjs_discovery
+        kept = discovery.hhd_top(self.wjs_discovery_top *
+                                 DISCOVERY_KEEP_RATIO)
+        top = kept[:self.wjs_discovery_top]
+        for job_id in top:
+            job = self._wjs_find_job(job_id)
+            if job is None:
+                logging.info("discovered heavy job [%s] of cluster [%s]",
+                             job_id, self.wjs_cluster.lc_fsname)
+                job = self._wjs_add_job(job_id)
+                if job is None:
+                    continue
+                job.wj_rate_limit = self.wjs_discovery_rate_limit
+                job.wj_discovered = True
+                lime_metrics.DISCOVERY_CHANGES.mc_inc(("promote",))
+            elif not job.wj_discovered:
+                job.wj_discovered = True
+        for job_id, job in self.wjs_jobs.items():
+            if not job.wj_discovered:
+                continue
+            if job_id in kept:
+                job.wj_discovery_misses = 0
+                continue
+            job.wj_discovery_misses += 1
+            if job.wj_discovery_misses < DISCOVERY_DEMOTE_INTERVALS:
+                continue
+            job.wj_discovered = False
+            if len(job.wj_websockets) > 0:
+                continue
+            logging.info("job [%s] of cluster [%s] is no longer heavy",
+                         job_id, self.wjs_cluster.lc_fsname)
+            self._wjs_remove_job(job_id)
+            lime_metrics.DISCOVERY_CHANGES.mc_inc(("demote",))
+        discovery.hhd_decay()
+        self.wjs_condition.release()
+
+    def wjs_discovery_loop(self):
+        """
+        Discover the heaviest jobs every discovery interval
+        """
+        while True:
+            sleep(self.wjs_discovery_interval)
+            self.wjs_discover()
+
+    def wjs_capacity_observe(self):
+        """
+        Update the capacity model of the cluster by the observed rates. A
+        host could only be saturated if none of the jobs on it is held back
+        by its TBF limit, otherwise the throughput would only show the
+        limits. Whether the host is really full is decided by the capacity
+        model, which waits for the throughput to stop rising.
+        """
+        fake_io = self.wjs_current_fake_io
+        host_rates = {}
+        host_saturated = {}
+        service_rates = {}
+        default_weights = collectd_metric.metric_weights_parse(None)
+        for job in self.wjs_jobs.values():
+            # The capacity is measured in the default metric, the rates in
+            # other metrics can not be added up with it
+            if job.wj_metric_weights != default_weights:
+                continue
+            for hostname, host in job.wj_hosts.iteritems():
+                host_rates[hostname] = (host_rates.get(hostname, 0) +
+                                        host.hfj_rate)
+                throttled = host.hfj_rate >= host.hfj_rate_limit * 9 / 10
+                host_saturated[hostname] = (host_saturated.get(hostname,
+                                                               True) and
+                                            not throttled)
+                for service_id, service in host.hfj_services.iteritems():
+                    # The summary of a relay has no rates of the OSTs
+                    if service.sfj_rate is None or service_id == RELAY_SERVICE:
+                        continue
+                    service_rates[service_id] = \
+                        service_rates.get(service_id, 0) + service.sfj_rate
+
+        # A shard only sees its own share of the hosts, so the rates are
+        # scaled up to the capacity of the whole hosts
+        capacity_map = self.wjs_cluster.lc_capacity
+        for hostname, rate in host_rates.iteritems():
+            share = self.wjs_capacity_share(hostname)
+            capacity_map.cm_oss_observe(hostname, fake_io, rate / share,
+                                        host_saturated[hostname])
+        for service_id, rate in service_rates.iteritems():
+            host = self.wjs_cluster.lc_map_service_host[service_id]
+            hostname = host.sh_hostname
+            share = self.wjs_capacity_share(hostname)
+            capacity_map.cm_ost_observe(service_id, fake_io, rate / share,
+                                        host_saturated[hostname])
+
+    def wjs_capacity_share(self, hostname):
+        """
+        Return the share of the capacity of a host that this shard could
+        use, 1 if not sharded
+        """
+        if SHARD is None:
+            return 1.0
+        return self.wjs_shares.get(hostname, SHARD.shm_share_default())
+
+    def wjs_shard_demand(self):
+        """
+        Return the demand of this shard on each OSS, which is the sum of
+        the rates of the jobs, raised if the jobs are near their limits
+        """
+        demand = {}
+        for host in self.wjs_cluster.lc_oss_hosts():
+            demand[host.sh_hostname] = 0.0
+        self.wjs_lock("wjs_shard_demand")
+        for job in self.wjs_jobs.values():
+            for hostname, host in job.wj_hosts.iteritems():
+                rate = host.hfj_rate
+                if rate >= host.hfj_rate_limit * 9 / 10:
+                    rate *= SHARD_DEMAND_GROWTH
+                demand[hostname] = demand.get(hostname, 0.0) + rate
+        self.wjs_condition.release()
+        return demand
+
+    def wjs_shard_report(self):
+        """
+        Post the demand of this shard to the coordinator every interval and
+        save the shares of the capacity that it returns
+        """
+        fsname = self.wjs_cluster.lc_fsname
+        while True:
+            sleep(self.wjs_metric_interval)
+            shares = SHARD.shm_shares_request(fsname,
+                                              self.wjs_shard_demand())
+            if shares is not None:
+                self.wjs_shares = shares
+
+    def wjs_rpc_ratio_update(self):
+        """
+        Learn how many RPCs each job sends per unit of its rate on each
+        host, and correct the TBF rates whose conversion has drifted
+        """
+        for job in self.wjs_jobs.values():
+            for host in job.wj_hosts.values():
+                host.hfj_rpc_ratio_observe()
+                if host.hfj_tbf_rate is None:
+                    continue
+                tbf_rate = host.hfj_tbf_rate_convert(host.hfj_rate_limit)
+                if (abs(tbf_rate - host.hfj_tbf_rate) >
+                        host.hfj_tbf_rate * RPC_RATIO_TOLERANCE):
+                    host.hfj_change_tbf_rate(host.hfj_rate_limit)
 
     def wjs_save_rates(self, end_job_id, action_job_id):
         """
@@ -814,19 +1379,19 @@ class WatchedJobs(object):
         policy_name = cluster["policy"]
         jobs = cluster["jobs"]
         fake_io = cluster["fake_io"]
-        self.wjs_condition.acquire()
+        self.wjs_lock("wjs_update_config")
         if self.wjs_current_policy.rp_name != policy_name:
             for policy in self.wjs_rate_policies:
                 if policy.rp_name == policy_name:
-                    logging.error("changing policy to %s", policy_name)
+                    logging.info("changing policy to %s", policy_name)
                     self.wjs_current_policy = policy
                     break
         if fake_io != self.wjs_current_fake_io:
-            logging.error("changing fake I/O to %s", fake_io)
+            logging.info("changing fake I/O to %s", fake_io)
             if fake_io:
-                ret = CLUSTER.lc_enable_fake_io_for_oss()
+                ret = self.wjs_cluster.lc_enable_fake_io_for_oss()
             else:
-                ret = CLUSTER.lc_clear_loc_for_oss()
+                ret = self.wjs_cluster.lc_clear_loc_for_oss()
             if ret:
                 logging.error("failed to enable/disable fake I/O")
             else:
@@ -836,9 +1401,24 @@ class WatchedJobs(object):
             thoughput = config_job["throughput"]
             job = self.wjs_jobs[job_id]
             job.wj_rate_limit = int(thoughput)
+            if "metric" in config_job:
+                weights = collectd_metric.metric_weights_parse(
+                    config_job["metric"])
+                if weights is not None:
+                    job.wj_metric_weights = weights
         self.wjs_condition.release()
 
 
+def tbf_rate_convert(rate_limit, rpc_ratio):
+    """
+    Convert a rate limit in the unit of the job metric to the RPC rate of
+    TBF. The RPC size is assumed to be 1MB if the ratio is unknown.
+    """
+    if rpc_ratio is None:
+        return rate_limit
+    return max(int(round(rate_limit * rpc_ratio)), 1)
+
+
 class HostForJob(object):
     """
     Each host has an object of HostForJob for each job
@@ -848,18 +1428,111 @@ class HostForJob(object):
         self.hfj_host = host
         # Array of services for job
         self.hfj_services = {}
+        # The rate limit in the unit of the job metric, e.g. MB/s
         self.hfj_rate_limit = DEFAULT_RATE_LIMIT
         self.hfj_rate = 0
         self.hfj_job = job
+        # RPCs per unit of the job metric, e.g. 256 RPCs per MB for 4KB
+        # writes. None if not learned yet.
+        self.hfj_rpc_ratio = None
+        # The RPC rate of the TBF rule, None if not changed by LIME yet
+        self.hfj_tbf_rate = None
+
+    def hfj_capacity(self):
+        """
+        Return the capacity of this host, None if unknown. It is the same
+        learned capacity that wj_capacity() uses for the evaluation.
+        """
+        jobs = self.hfj_job.wj_jobs
+        capacity_map = jobs.wjs_cluster.lc_capacity
+        hostname = self.hfj_host.sh_hostname
+        capacity = capacity_map.cm_oss_capacity(hostname,
+                                                jobs.wjs_current_fake_io)
+        if capacity is None:
+            return None
+        return capacity * jobs.wjs_capacity_share(hostname)
 
-    def hfj_change_tbf_rate(self, rate_limit):
+    def hfj_max_rate_limit(self):
+        """
+        Return the highest rate limit that makes sense on this host
+        """
+        # The capacity is measured in the default metric
+        if (self.hfj_job.wj_metric_weights !=
+                collectd_metric.metric_weights_parse(None)):
+            return DEFAULT_RATE_LIMIT
+        capacity = self.hfj_capacity()
+        if capacity is None or capacity >= DEFAULT_RATE_LIMIT:
+            return DEFAULT_RATE_LIMIT
+        return max(int(capacity), MIN_RATE_LIMIT)
+
+    def hfj_rpc_ratio_observe(self):
+        """
+        Learn the RPCs per unit of the job metric from the rates of the
+        services, e.g. the reciprocal of the average RPC size in MB for the
+        bandwidth metrics. Only the RPCs of the metrics that the job
+        chooses are counted, e.g. the write RPCs for write_bytes.
         """
-        Change the job's rate on this host
+        rpc_metrics = set()
+        for metric, weight in self.hfj_job.wj_metric_weights.iteritems():
+            if weight > 0:
+                rpc_metrics.add(collectd_metric.RPC_METRICS[metric])
+        rate = 0
+        rpc_rate = 0
+        for service in self.hfj_services.values():
+            if service.sfj_rate is None:
+                continue
+            rate += service.sfj_rate
+            for metric in rpc_metrics:
+                metric_rate = service.sfj_rates.get(metric)
+                if metric_rate is not None:
+                    rpc_rate += metric_rate
+        if rate <= 0 or rpc_rate <= 0:
+            return
+        ratio = rpc_rate / rate
+        if self.hfj_rpc_ratio is None:
+            self.hfj_rpc_ratio = ratio
+        else:
+            self.hfj_rpc_ratio = (RPC_RATIO_EWMA_WEIGHT * ratio +
+                                  (1 - RPC_RATIO_EWMA_WEIGHT) *
+                                  self.hfj_rpc_ratio)
+
+    def hfj_tbf_rate_convert(self, rate_limit):
+        """
+        Convert a rate limit in the unit of the job metric to the RPC rate
+        of TBF
+        """
+        return tbf_rate_convert(rate_limit, self.hfj_rpc_ratio)
+
+    def hfj_change_tbf_rate(self, rate_limit):
         """
-        ret = self.hfj_host.lh_change_tbf_rate(self.hfj_job.wj_tbf_name,
-                                               rate_limit)
-        if ret == 0:
-            self.hfj_rate_limit = rate_limit
+        Change the job's rate on this host, the rate limit will never be
+        higher than what the host can deliver
+        """
+        rate_limit = min(rate_limit, self.hfj_max_rate_limit())
+        tbf_rate = self.hfj_tbf_rate_convert(rate_limit)
+        job = self.hfj_job
+        rate_class = job.wj_rate_class
+        if rate_class is None:
+            ret = self.hfj_host.lh_change_tbf_rate(job.wj_tbf_name,
+                                                   tbf_rate)
+            if ret == 0:
+                self.hfj_rate_limit = rate_limit
+                self.hfj_tbf_rate = tbf_rate
+            return ret
+
+        # The rule of the class is shared, its rate is the sum of the
+        # rates of the jobs in the class
+        old_rate_limit = self.hfj_rate_limit
+        old_tbf_rate = self.hfj_tbf_rate
+        self.hfj_rate_limit = rate_limit
+        self.hfj_tbf_rate = tbf_rate
+        class_rate = job.wj_jobs.wjs_class_tbf_rate(rate_class,
+                                                    self.hfj_host.sh_hostname)
+        ret = self.hfj_host.lh_change_tbf_rate(rate_class.rc_rule_name,
+                                               class_rate)
+        if ret:
+            self.hfj_rate_limit = old_rate_limit
+            self.hfj_tbf_rate = old_tbf_rate
         return ret
 
 
@@ -881,18 +1554,29 @@ class WatchedJob(object):
         # Host for each job
         self.wj_hosts = {}
         self.wj_tbf_name = lustre_config.tbf_escape_name(job_id)
-
-    def wj_datapoint_add(self, service_id, timestamp, value):
-        """
-        Recived a datapoint of this job
+        # The weight of each metric in the rate that the policies target
+        self.wj_metric_weights = collectd_metric.metric_weights_parse(None)
+        # Key is metric, value is the rate of the metric in its scale
+        self.wj_metric_rates = {}
+        # Whether the job is watched because it is among the heaviest jobs
+        self.wj_discovered = False
+        # The discovery intervals since the job was last among the heaviest
+        self.wj_discovery_misses = 0
+        # The RateClass whose TBF rule the job shares, None if the job has
+        # its own rule
+        self.wj_rate_class = None
+
+    def wj_datapoint_add(self, service_id, metric, timestamp, value):
+        """
+        Recived a datapoint of a metric of this job
         """
         if service_id not in self.wj_services:
-            service = ServiceForJob()
-            host = CLUSTER.lc_map_service_host[service_id]
+            service = ServiceForJob(self)
+            host = self.wj_jobs.wjs_cluster.lc_map_service_host[service_id]
             hostname = host.sh_hostname
             if hostname not in self.wj_hosts:
-                logging.error("service [%s] is on host [%s]", service_id,
-                              hostname)
+                logging.info("service [%s] is on host [%s]", service_id,
+                             hostname)
                 host_for_job = HostForJob(self, host)
                 self.wj_hosts[hostname] = host_for_job
             else:
@@ -901,29 +1585,51 @@ class WatchedJob(object):
             self.wj_services[service_id] = service
         else:
             service = self.wj_services[service_id]
-        service.sfj_datapoint_add(timestamp, value)
+        service.sfj_datapoint_add(metric, timestamp, value)
+
+    def wj_summary_add(self, host, metric, timestamp, rate):
+        """
+        Recived the summary of a metric of this job on a host from a relay,
+        the rate is the sum of the OSTs on the host per second
+        """
+        hostname = host.sh_hostname
+        if hostname not in self.wj_hosts:
+            self.wj_hosts[hostname] = HostForJob(self, host)
+        host_for_job = self.wj_hosts[hostname]
+        if RELAY_SERVICE not in host_for_job.hfj_services:
+            host_for_job.hfj_services[RELAY_SERVICE] = ServiceForJob(self)
+        host_for_job.hfj_services[RELAY_SERVICE].sfj_rate_set(metric,
+                                                              timestamp,
+                                                              rate)
 
     def wj_datapoint_send(self):
         """
-        Send a datapoint to clients
+        Send the datapoint of the current rate to clients
         """
         dead_websockets = []
-        rate = self.wj_rate_get()
+        rate = self.wj_rate
+        cluster = self.wj_jobs.wjs_cluster
         json_string = json.dumps({
             "type": "datapoint",
             "time": time.time(),
             "rate": rate,
+            "metric_rates": self.wj_metric_rates,
+            "cluster": cluster.lc_fsname,
+            "workload_rate": cluster.lc_workload_rate(self.wj_job_id),
             "job_id": self.wj_job_id})
         for websocket in self.wj_websockets:
+            lime_metrics.WEBSOCKET_SENDS.mg_inc()
             try:
                 websocket.send(json_string)
             except WebSocketError:
                 websocket.closed = True
                 dead_websockets.append(websocket)
+            finally:
+                lime_metrics.WEBSOCKET_SENDS.mg_inc(amount=-1)
 
         for websocket in dead_websockets:
             self.wj_websockets.remove(websocket)
-        if len(self.wj_websockets) == 0:
+        if len(self.wj_websockets) == 0 and not self.wj_discovered:
             return 1
         return 0
 
@@ -931,19 +1637,93 @@ class WatchedJob(object):
         """
         Return the current rate according the datapoints
         """
+        now = time.time()
         rate = 0
-        for hostname in self.wj_hosts:
+        metric_rates = {}
+        for hostname in self.wj_hosts.keys():
             host = self.wj_hosts[hostname]
             host.hfj_rate = 0
-            for service_id in host.hfj_services:
+            for service_id in host.hfj_services.keys():
                 service = host.hfj_services[service_id]
+                service.sfj_rate_update(now)
+                if service.sfj_dead(now):
+                    # The job is gone from this service, free the series
+                    del host.hfj_services[service_id]
+                    self.wj_services.pop(service_id, None)
+                    continue
+                for metric, metric_rate in service.sfj_rates.iteritems():
+                    if metric_rate is not None:
+                        metric_rates[metric] = (metric_rates.get(metric, 0) +
+                                                metric_rate)
                 service_rate = service.sfj_rate
                 if service_rate is not None:
                     rate += service_rate
                     host.hfj_rate += service_rate
+            if len(host.hfj_services) == 0:
+                # All the series of the job on the host are dead
+                self.wj_host_remove(hostname)
         self.wj_rate = rate
+        self.wj_metric_rates = metric_rates
         return rate
 
+    def wj_host_remove(self, hostname):
+        """
+        Remove a host whose series are all dead. A new HostForJob starts
+        with the default limit if the job comes back, so the TBF rule of
+        the job on the host is reset to the default limit first. Return 0
+        on success, -1 if the rule could not be reset, then the host is
+        kept and the removal is retried in the next tick.
+        """
+        host = self.wj_hosts.pop(hostname)
+        jobs = self.wj_jobs
+        rate_class = self.wj_rate_class
+        if rate_class is None:
+            name = self.wj_tbf_name
+            tbf_rate = jobs.wjs_job_tbf_rate(self, hostname)
+        else:
+            # The share of the job in the rate of the class is reset
+            name = rate_class.rc_rule_name
+            tbf_rate = jobs.wjs_class_tbf_rate(rate_class, hostname)
+        if name is not None:
+            ret = host.hfj_host.lh_change_tbf_rate(name, tbf_rate)
+            if ret:
+                logging.error("failed to reset TBF rule [%s] of job [%s] on "
+                              "host [%s], keeping the host",
+                              name, self.wj_job_id, hostname)
+                self.wj_hosts[hostname] = host
+                return ret
+        # The policies split the limit of the job again between the hosts
+        # that are left
+        self.wj_current_rate_limit = None
+        return 0
+
+    def wj_capacity(self, fake_io):
+        """
+        Return the highest rate that the hosts of this job could deliver,
+        None if unknown
+        """
+        jobs = self.wj_jobs
+        capacity_map = jobs.wjs_cluster.lc_capacity
+        cluster_capacity = capacity_map.cm_cluster_capacity(fake_io)
+        if cluster_capacity is not None and SHARD is not None:
+            hostnames = [host.sh_hostname
+                         for host in jobs.wjs_cluster.lc_oss_hosts()]
+            if len(hostnames) > 0:
+                cluster_capacity *= (sum([jobs.wjs_capacity_share(hostname)
+                                          for hostname in hostnames]) /
+                                     len(hostnames))
+        capacity = 0
+        for hostname in self.wj_hosts:
+            host_capacity = capacity_map.cm_oss_capacity(hostname, fake_io)
+            if host_capacity is None:
+                return cluster_capacity
+            capacity += host_capacity * jobs.wjs_capacity_share(hostname)
+        if len(self.wj_hosts) == 0:
+            return cluster_capacity
+        if cluster_capacity is not None:
+            capacity = min(capacity, cluster_capacity)
+        return capacity
+
     def wj_highest_limit_host(self):
         """
         Return the host with the highest rate limit
@@ -997,26 +1777,26 @@ class WatchedJob(object):
         # instead, should select the host with the higest rate
         selected = self.wj_highest_limit_host()
         if selected is None:
-            logging.error("no selected host to decrease rate")
+            utils.log_limited(logging.WARNING,
+                              "no selected host to decrease rate")
             return -1
         old = selected.hfj_rate_limit
+        rate_limit = old
         # The rate is lower than the limit, there is other bottleneck
         # Set the rate limit to the real limit to speedup the decrease process
         if old > selected.hfj_rate * 11 / 10:
-            selected.hfj_rate_limit = selected.hfj_rate
+            rate_limit = selected.hfj_rate
 
-        if diff + MIN_RATE_LIMIT > selected.hfj_rate_limit:
-            selected.hfj_rate_limit = MIN_RATE_LIMIT
+        if diff + MIN_RATE_LIMIT > rate_limit:
+            rate_limit = MIN_RATE_LIMIT
         else:
-            selected.hfj_rate_limit -= diff
+            rate_limit -= diff
         logging.info("decreasing rate of host [%s] for job [%s] from [%d] "
                      "to [%d]",
                      selected.hfj_host.sh_hostname,
                      self.wj_job_id,
-                     old, selected.hfj_rate_limit)
-        selected.hfj_host.lh_change_tbf_rate(self.wj_tbf_name,
-                                             selected.hfj_rate_limit)
-        return 0
+                     old, rate_limit)
+        return selected.hfj_change_tbf_rate(rate_limit)
 
     def wj_increase_lowest_host(self):
         """
@@ -1025,26 +1805,24 @@ class WatchedJob(object):
         selected = None
         for hostname in self.wj_hosts:
             host = self.wj_hosts[hostname]
-            if host.hfj_rate_limit >= DEFAULT_RATE_LIMIT:
+            if host.hfj_rate_limit >= host.hfj_max_rate_limit():
                 continue
             if (selected is None or
                     selected.hfj_rate_limit > host.hfj_rate_limit):
                 selected = host
         if selected is None:
-            logging.error("no selected host to increase rate")
+            utils.log_limited(logging.WARNING,
+                              "no selected host to increase rate")
             return
         old = selected.hfj_rate_limit
         diff = self.wj_rate_limit - self.wj_rate
-        selected.hfj_rate_limit += diff
-        if selected.hfj_rate_limit > DEFAULT_RATE_LIMIT:
-            selected.hfj_rate_limit = DEFAULT_RATE_LIMIT
+        rate_limit = min(old + diff, selected.hfj_max_rate_limit())
         logging.info("increasing rate of host [%s] for job [%s] from [%d] "
                      "to [%d]",
                      selected.hfj_host.sh_hostname,
                      self.wj_job_id,
-                     old, selected.hfj_rate_limit)
-        selected.hfj_host.lh_change_tbf_rate(self.wj_tbf_name,
-                                             selected.hfj_rate_limit)
+                     old, rate_limit)
+        selected.hfj_change_tbf_rate(rate_limit)
         return
 
 
@@ -1052,29 +1830,123 @@ class ServiceForJob(object):
     """
     Each service (OST) has an object of ServiceForJob for each job
     """
-    # pylint: disable=too-few-public-methods
-    def __init__(self):
-        # Data collected from collectd
-        self.sfj_value = None
-        self.sfj_timestamp = None
+    def __init__(self, job):
+        self.sfj_job = job
+        # Data collected from collectd, key is metric, value is
+        # CounterSeries
+        self.sfj_series = {}
+        # Key is metric, value is the rate in the scale of the metric, None
+        # if unknown
+        self.sfj_rates = {}
+        # The weighted rate that the policies target, None if unknown
         self.sfj_rate = None
 
-    def sfj_datapoint_add(self, timestamp, value):
+    def _sfj_series(self, metric):
+        """
+        Return the series of a metric
+        """
+        series = self.sfj_series.get(metric)
+        if series is None:
+            jobs = self.sfj_job.wj_jobs
+            series = collectd_metric.CounterSeries(
+                interval=jobs.wjs_metric_interval,
+                max_age=jobs.wjs_metric_max_age)
+            self.sfj_series[metric] = series
+        return series
+
+    def sfj_datapoint_add(self, metric, timestamp, value):
         """
         A datapoint is recived for this job and this service
         """
-        # If overflow happens, rate will be kept unchanged for one interval
-        if (self.sfj_timestamp is not None and
-                value >= self.sfj_value and
-                timestamp > self.sfj_timestamp):
-            diff = value - self.sfj_value
-            time_diff = timestamp - self.sfj_timestamp
-            self.sfj_rate = diff / time_diff / 1000000
-        self.sfj_timestamp = timestamp
-        self.sfj_value = value
+        self._sfj_series(metric).cs_datapoint_add(timestamp, value)
+        self.sfj_rate_update()
 
+    def sfj_rate_set(self, metric, timestamp, rate):
+        """
+        The rate per second is calculated by a relay
+        """
+        self._sfj_series(metric).cs_rate_set(timestamp, rate)
+        self.sfj_rate_update()
 
-WATCHED_JOBS = None
+    def sfj_rate_update(self, now=None):
+        """
+        Update the rates, which expire if no datapoint comes in time. The
+        rate that the policies target is the weighted sum of the metrics
+        chosen by the job.
+        """
+        for metric, series in self.sfj_series.iteritems():
+            rate = series.cs_rate_get(now)
+            if rate is not None:
+                rate *= collectd_metric.METRIC_SCALES[metric]
+            self.sfj_rates[metric] = rate
+        weighted_rate = None
+        for metric, weight in self.sfj_job.wj_metric_weights.iteritems():
+            rate = self.sfj_rates.get(metric)
+            if rate is None:
+                continue
+            if weighted_rate is None:
+                weighted_rate = 0
+            weighted_rate += rate * weight
+        self.sfj_rate = weighted_rate
+
+    def sfj_dead(self, now=None):
+        """
+        Whether no datapoint of any metric has come for the max age
+        """
+        for series in self.sfj_series.values():
+            if (series.cs_state(now) !=
+                    collectd_metric.CounterSeries.STATE_DEAD):
+                return False
+        return True
+
+
+# The controllers of the Lustre clusters, key is the fsname, value is
+# WatchedJobs
+CONTROLLERS = collections.OrderedDict()
+
+
+def controller_find(fsname, hostname=None):
+    """
+    Find the controller of the cluster that a metric belongs to. If the
+    metric has no fsname, find it by the host. Return None if not found.
+    """
+    if fsname is not None:
+        return CONTROLLERS.get(fsname)
+    if len(CONTROLLERS) == 1:
+        return CONTROLLERS.values()[0]
+    if hostname is None:
+        return None
+    for controller in CONTROLLERS.values():
+        if controller.wjs_cluster.lc_host_find(hostname) is not None:
+            return controller
+    return None
+
+
+def rate_table_dispatch():
+    """
+    Read the counters that the ingestion workers updated since last time,
+    and add them to the controllers of their clusters. A series could be in
+    the regions of several workers, so the updates are sorted by time.
+    """
+    updates = sorted(RATE_TABLE.srt_updates(), key=lambda entry: entry[5])
+    cluster_updates = collections.OrderedDict()
+    for entry in updates:
+        fsname = entry[0]
+        if fsname == "":
+            fsname = None
+        hostname = entry[1]
+        if hostname == "":
+            hostname = None
+        controller = controller_find(fsname, hostname)
+        if controller is None:
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("rate_table",
+                                                    "unknown_cluster"))
+            continue
+        if controller not in cluster_updates:
+            cluster_updates[controller] = []
+        cluster_updates[controller].append(entry[2:])
+    for controller, entries in cluster_updates.iteritems():
+        controller.wjs_rate_table_add(entries)
 
 
 @APP.route("/")
@@ -1085,54 +1957,169 @@ def app_root():
     return render_template("index.html")
 
 
-def tsdb_tags_parse(tsdb_tags, tag_dict):
+@APP.route("/metric_post", methods=['POST'])
+def app_metric_post():
     """
-    Parse a TSDB tag string to dictionary
+    A metric datapoint is recieved from Collectd
     """
-    tags = tsdb_tags.split()
-    for tag in tags:
-        pair = tag.split("=")
-        if len(pair) != 2:
-            logging.error("tsdb tags [%s] is invalid", tsdb_tags)
-            return -1
-        tag_dict[pair[0]] = pair[1]
-    return 0
+    start = time.time()
+    for metric in request.json:
+        datapoint = collectd_metric.jobstats_datapoint_parse(metric)
+        if datapoint is None:
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("post", "ignored"))
+            continue
+        controller = controller_find(datapoint.jd_fsname,
+                                     datapoint.jd_hostname)
+        if controller is None:
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("post",
+                                                    "unknown_cluster"))
+            continue
+        service_id = datapoint.jd_service_id
+        job_id = datapoint.jd_job_id
+        metric = datapoint.jd_metric
+        value = datapoint.jd_value
+        timestamp = datapoint.jd_timestamp
+        controller.wjs_metric_received(service_id, job_id, metric,
+                                       timestamp, value)
+        utils.log_limited(logging.DEBUG, "service_id :%s, job_id: %s, "
+                          "metric: %s, time: %d, value: %d", service_id,
+                          job_id, metric, timestamp, value)
+    lime_metrics.METRIC_POSTS.mc_inc(("metric_post",))
+    lime_metrics.METRIC_POST_SECONDS.mh_observe(time.time() - start,
+                                                ("metric_post",))
+    return "Succeeded"
 
 
-@APP.route("/metric_post", methods=['POST'])
-def app_metric_post():
+@INGEST_APP.route("/metric_post", methods=['POST'])
+def ingest_metric_post():
     """
-    A metric datapoint is recieved from Collectd
+    A metric datapoint is recieved from Collectd by an ingestion worker
     """
-    logging.debug(json.dumps(request.json, indent=4))
     for metric in request.json:
-        meta = metric["meta"]
-        tsdb_name = meta["tsdb_name"]
-        if tsdb_name != "ost_jobstats_samples":
+        datapoint = collectd_metric.jobstats_datapoint_parse(metric)
+        if datapoint is None:
             continue
-        tsdb_tags = meta["tsdb_tags"]
-        tag_dict = {}
-        ret = tsdb_tags_parse(tsdb_tags, tag_dict)
-        if ret:
+        fsname = datapoint.jd_fsname
+        if fsname is None:
+            fsname = ""
+        hostname = datapoint.jd_hostname
+        if hostname is None:
+            hostname = ""
+        RATE_TABLE.srt_write(fsname, hostname, datapoint.jd_job_id,
+                             datapoint.jd_service_id, datapoint.jd_metric,
+                             datapoint.jd_timestamp, datapoint.jd_value)
+    return "Succeeded"
+
+
+def ingest_parent_watch(parent_pid):
+    """
+    Exit the ingestion worker if the controller process exits
+    """
+    while os.getppid() == parent_pid:
+        sleep(1)
+    os._exit(0)
+
+
+def ingest_workers_start(workers, port):
+    """
+    Fork the ingestion workers, which parse the posts of Collectd and write
+    the counters to the shared rate table. This should be called before any
+    thread is started, since the threads would be inherited by the workers.
+    """
+    # pylint: disable=global-statement,protected-access
+    global RATE_TABLE
+    RATE_TABLE = rate_table.SharedRateTable(workers)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(INGEST_BACKLOG)
+    parent_pid = os.getpid()
+    for region in range(workers):
+        pid = os.fork()
+        if pid:
+            logging.info("started ingestion worker [%d] on port [%d]",
+                         pid, port)
             continue
-        logging.debug("tag_dict: %s", tag_dict)
-        if tag_dict["optype"] != "sum_write_bytes":
+        utils.log_restart_after_fork()
+        RATE_TABLE.srt_writer_attach(region)
+        utils.thread_start(ingest_parent_watch, (parent_pid,))
+        http_server = WSGIServer(listener, INGEST_APP)
+        http_server.serve_forever()
+        os._exit(0)
+    listener.close()
+
+
+@APP.route("/summary_post", methods=['POST'])
+def app_summary_post():
+    """
+    The summaries of a group of OSSes are recieved from a relay, see
+    lime_relay.py
+    """
+    start = time.time()
+    summary = request.json
+    logging.debug("summaries from relay of group [%s]", summary["group"])
+    for job_summary in summary["summaries"]:
+        metric = job_summary.get("metric", collectd_metric.DEFAULT_METRIC)
+        controller = controller_find(job_summary.get("fsname"),
+                                     job_summary["hostname"])
+        if controller is None:
+            lime_metrics.DATAPOINTS_DROPPED.mc_inc(("relay",
+                                                    "unknown_cluster"))
             continue
-        service_id = tag_dict["ost_index"]
-        logging.debug(json.dumps(metric, indent=4))
-        job_id = tag_dict["job_id"]
-        value = metric["values"][0]
-        timestamp = metric["time"]
-        WATCHED_JOBS.wjs_metric_received(service_id, job_id, timestamp, value)
-        logging.debug("service_id :%s, job_id: %s, time: %d, value: %d",
-                      service_id, job_id, timestamp, value)
+        controller.wjs_summary_received(job_summary["hostname"],
+                                        job_summary["job_id"], metric,
+                                        job_summary["time"],
+                                        job_summary["rate"])
+    lime_metrics.METRIC_POSTS.mc_inc(("summary_post",))
+    lime_metrics.METRIC_POST_SECONDS.mh_observe(time.time() - start,
+                                                ("summary_post",))
     return "Succeeded"
 
 
+@APP.route("/metrics")
+def app_metrics():
+    """
+    The metrics of LIME itself in the text format of Prometheus
+    """
+    return Response(lime_metrics.REGISTRY.mr_format(),
+                    content_type=lime_metrics.CONTENT_TYPE)
+
+
+@APP.route("/debug/profile")
+def app_debug_profile():
+    """
+    Profile LIME for some seconds, return the stacks in the collapsed
+    format of flamegraph.pl
+    """
+    seconds = request.args.get("seconds", DEBUG_PROFILE_SECONDS, type=float)
+    profiler = lime_debug.SamplingProfiler()
+    profiler.sp_start(seconds)
+    while profiler.sp_running:
+        sleep(profiler.sp_interval)
+    logging.info("profiled [%d] samples in [%f] seconds",
+                 profiler.sp_samples, seconds)
+    return Response(profiler.sp_collapsed(), content_type="text/plain")
+
+
+@APP.route("/debug/trace")
+def app_debug_trace():
+    """
+    Dump the latest spans as a file in the trace event format, which could
+    be loaded by chrome://tracing
+    """
+    response = Response(json.dumps(lime_debug.TRACER.st_events()),
+                        content_type="application/json")
+    response.headers["Content-Disposition"] = \
+        "attachment; filename=lime_trace.json"
+    return response
+
+
 @APP.route("/console_websocket")
 def app_console_websocket():
     """
-    Start the websocket connection
+    Start the websocket connection. The connection is scoped to one
+    cluster, which is chosen by the "cluster" argument of the URL or the
+    name of the cluster in the first message.
     """
     # pylint: disable=too-many-locals,too-many-branches
     # pylint: disable=too-many-return-statements,too-many-statements
@@ -1141,16 +2128,25 @@ def app_console_websocket():
         config_string = websocket.receive()
         config = json.loads(config_string)
         cluster = config["cluster"]
+        fsname = request.args.get("cluster", cluster.get("name"))
+        controller = controller_find(fsname)
+        if controller is None:
+            logging.error("websocket for unknown cluster [%s]", fsname)
+            return "Failure"
         jobs = cluster["jobs"]
+        watched_jobs = []
         for job in jobs:
             job_id = job["job_id"]
-            WATCHED_JOBS.wjs_watch_job(job_id, websocket)
+            ret = controller.wjs_watch_job(job_id, websocket,
+                                           job.get("metric"))
+            if ret == 0:
+                watched_jobs.append(job_id)
 
         while not websocket.closed:
             data = websocket.receive()
             logging.debug("command: %s", data)
             config = json.loads(data)
-            ret = WATCHED_JOBS.wjs_update_config(config)
+            ret = controller.wjs_update_config(config)
             if ret:
                 result = "failure"
             else:
@@ -1163,8 +2159,8 @@ def app_console_websocket():
             logging.debug("sent result")
             websocket.send(json_string)
 
-        for job in jobs:
-            WATCHED_JOBS.wjs_unwatch_job(job_id, websocket)
+        for job_id in watched_jobs:
+            controller.wjs_unwatch_job(job_id, websocket)
         logging.debug("websocket is closed")
         return "Success"
     else:
@@ -1172,17 +2168,61 @@ def app_console_websocket():
         return "Failure"
 
 
-def load_config():
-    # pylint: disable=global-statement,too-many-return-statements
+def tbf_rules_poll(cluster):
     """
-    Load configuration file and do some initialization
+    Read back the TBF rules on OSSes periodically, so that the rules
+    changed by others are noticed and the model used to skip redundant
+    writes is kept correct
     """
-    global CLUSTER
-    json_data = open('static/lime_config.json')
+    while True:
+        sleep(TBF_RULES_POLL_INTERVAL)
+        diffs = cluster.lc_tbf_rules_poll()
+        for hostname, diff in diffs.iteritems():
+            if diff is None or diff.trd_empty():
+                continue
+            # The rules of the other shards change all the time
+            for rule in diff.trd_added:
+                if SHARD is not None and SHARD.shm_rule_foreign(rule):
+                    continue
+                logging.warning("TBF rule [%s] appeared on host [%s]",
+                                rule.tr_name, hostname)
+            for rule in diff.trd_removed:
+                if SHARD is not None and SHARD.shm_rule_foreign(rule):
+                    continue
+                logging.warning("TBF rule [%s] disappeared on host [%s]",
+                                rule.tr_name, hostname)
+            for old_rule, rule in diff.trd_changed:
+                if SHARD is not None and SHARD.shm_rule_foreign(rule):
+                    continue
+                logging.warning("TBF rule [%s] on host [%s] changed from "
+                                "rate [%d] to [%d]", rule.tr_name, hostname,
+                                old_rule.tr_rate, rule.tr_rate)
+
+
+def read_config(fname=CONFIG_FILE):
+    """
+    Read the configuration file
+    """
+    json_data = open(fname)
     config = json.load(json_data)
+    json_data.close()
+    return config
 
-    logging.debug("config: %s", config)
-    cluster = config["cluster"]
+
+def config_clusters(config):
+    """
+    Return the configurations of the clusters. The "cluster" section is the
+    one shown by the GUI, more could be listed in the "clusters" section.
+    """
+    return [config["cluster"]] + config.get("clusters", [])
+
+
+def controller_start(cluster):
+    # pylint: disable=too-many-return-statements
+    """
+    Initialize a Lustre cluster and start its controller, return the
+    controller, None on failure
+    """
     fsname = cluster["name"]
     hosts = []
     for host in cluster["hosts"]:
@@ -1191,52 +2231,155 @@ def load_config():
     fake_io = cluster["fake_io"]
     jobs = cluster["jobs"]
     logging.debug("fsname: [%s], hosts: %s", fsname, hosts)
-    CLUSTER = lustre_config.LustreCluster(fsname, hosts,
-                                          ssh_identity_file=identity)
+    classes_config = cluster.get("rate_classes", {})
+    class_map = None
+    if classes_config.get("enabled", False):
+        if SHARD is not None and len(classes_config.get("classes", [])) > 0:
+            logging.error("the static rate classes of cluster [%s] can't be "
+                          "owned by one shard", fsname)
+            return None
+        pool_prefix = rate_classes.POOL_RULE_PREFIX
+        if SHARD is not None:
+            pool_prefix += "_" + lustre_config.tbf_escape_name(
+                SHARD.shm_name)
+        class_map = rate_classes.rate_classes_parse(classes_config,
+                                                    pool_prefix)
+        if class_map is None:
+            return None
+
+    lustre_cluster = lustre_config.LustreCluster(fsname, hosts,
+                                                 ssh_identity_file=identity)
     logging.debug("detecting services")
-    global WATCHED_JOBS
-    WATCHED_JOBS = WatchedJobs(fake_io)
-    ret = CLUSTER.lc_detect_services()
+    ret = lustre_cluster.lc_detect_services()
     if ret:
-        return -1
+        return None
 
-    ret = CLUSTER.lc_benchmark()
+    benchmark_config = lustre_benchmark.benchmark_config_parse(
+        cluster.get("benchmark"))
+    ret = lustre_cluster.lc_benchmark(benchmark_config)
     if ret:
-        return -1
+        return None
 
-    ret = CLUSTER.lc_restart_collectd()
+    ret = lustre_cluster.lc_restart_collectd()
     if ret:
-        return -1
+        return None
 
     if fake_io:
-        ret = CLUSTER.lc_enable_fake_io_for_oss()
+        ret = lustre_cluster.lc_enable_fake_io_for_oss()
         if ret:
-            return -1
+            return None
     else:
-        ret = CLUSTER.lc_clear_loc_for_oss()
+        ret = lustre_cluster.lc_clear_loc_for_oss()
         if ret:
-            return -1
+            return None
 
-    ret = CLUSTER.lc_check_cpt_for_oss()
+    ret = lustre_cluster.lc_check_cpt_for_oss()
     if ret:
-        return -1
+        return None
 
-    ret = CLUSTER.lc_enable_fifo_for_ost_io()
+    ret = lustre_cluster.lc_enable_fifo_for_ost_io()
     if ret:
-        return -1
+        return None
 
-    ret = CLUSTER.lc_enable_tbf_for_ost_io("jobid")
+    ret = lustre_cluster.lc_enable_tbf_for_ost_io("jobid")
     if ret:
-        return -1
-
-    ret = CLUSTER.lc_set_jobid_var("procname_uid")
+        return None
+
+    # The agents are optional, SSH is used for the hosts without agents
+    oss_agent = cluster.get("oss_agent", False)
+    if oss_agent:
+        proc_root = None
+        if isinstance(oss_agent, dict):
+            proc_root = oss_agent.get("local_proc_root")
+        lustre_cluster.lc_start_agents(proc_root)
+        # The agents would keep running on the OSSes after LIME exits
+        atexit.register(lustre_cluster.lc_stop_agents)
+
+    # The rules left by a former run would limit the jobs unexpectedly,
+    # the rules of the other shards are kept
+    keep_func = None
+    if SHARD is not None:
+        keep_func = SHARD.shm_rule_foreign
+    ret = lustre_cluster.lc_tbf_rules_cleanup(keep_func=keep_func)
     if ret:
-        return -1
+        return None
+    utils.thread_start(tbf_rules_poll, (lustre_cluster,))
 
-    ret = CLUSTER.lc_start_io(jobs)
+    ret = lustre_cluster.lc_set_jobid_var("procname_uid")
     if ret:
-        return -1
+        return None
+
+    # Starting the workloads stops the former ones on all the clients, so
+    # only one shard starts them
+    if SHARD is None or SHARD.shm_primary():
+        ret = lustre_cluster.lc_start_io(jobs)
+        if ret:
+            return None
 
+    controller = WatchedJobs(lustre_cluster, fake_io)
+    metric = cluster.get("metric", {})
+    controller.wjs_metric_interval = metric.get(
+        "interval", collectd_metric.COUNTER_INTERVAL)
+    controller.wjs_metric_max_age = metric.get(
+        "max_age", collectd_metric.COUNTER_MAX_AGE)
+    controller.wjs_scheduler.tks_interval_set(
+        controller.wjs_metric_interval,
+        metric.get("tick_deadline", tick_scheduler.TICK_DEADLINE))
+    if SHARD is not None and SHARD.shm_url is not None:
+        utils.thread_start(controller.wjs_shard_report, ())
+    if class_map is not None:
+        controller.wjs_rate_classes = class_map
+        controller.wjs_rebalance_interval = classes_config.get(
+            "rebalance_interval", rate_classes.RATE_CLASS_REBALANCE_INTERVAL)
+        utils.thread_start(controller.wjs_rate_classes_loop, ())
+    discovery = cluster.get("discovery", {})
+    if discovery.get("enabled", False):
+        controller.wjs_discovery = heavy_hitters.JobDiscovery(
+            discovery.get("metric", collectd_metric.DEFAULT_METRIC),
+            discovery.get("capacity", heavy_hitters.DISCOVERY_CAPACITY))
+        controller.wjs_discovery_top = discovery.get("top", DISCOVERY_TOP)
+        controller.wjs_discovery_interval = discovery.get(
+            "interval", DISCOVERY_INTERVAL)
+        controller.wjs_discovery_rate_limit = int(discovery.get(
+            "throughput", DEFAULT_RATE_LIMIT))
+        utils.thread_start(controller.wjs_discovery_loop, ())
+    return controller
+
+
+def load_config(fname=CONFIG_FILE):
+    """
+    Load configuration file and start the controllers of the clusters
+    concurrently
+    """
+    config = read_config(fname)
+    logging.debug("config: %s", config)
+    clusters = config_clusters(config)
+    controllers = {}
+
+    def controller_start_thread(cluster):
+        """
+        Start the controller of a cluster and save it
+        """
+        controllers[cluster["name"]] = controller_start(cluster)
+
+    names = [cluster["name"] for cluster in clusters]
+    for name in names:
+        if names.count(name) > 1:
+            logging.error("duplicated cluster [%s]", name)
+            return -1
+    threads = []
+    for cluster in clusters:
+        threads.append(utils.thread_start(controller_start_thread,
+                                          (cluster,)))
+    for thread in threads:
+        thread.join()
+    for cluster in clusters:
+        controller = controllers.get(cluster["name"])
+        if controller is None:
+            logging.error("failed to start controller of cluster [%s]",
+                          cluster["name"])
+            return -1
+        CONTROLLERS[cluster["name"]] = controller
     return 0
 
 
@@ -1244,19 +2387,49 @@ def start_web():
     """
     Start the web server of LIME
     """
-    logdir = "log"
+    # pylint: disable=global-statement
+    global SHARD
+    parser = optparse.OptionParser()
+    parser.add_option("--config", default=CONFIG_FILE,
+                      help="configuration file")
+    parser.add_option("--port", type="int", default=WEB_PORT,
+                      help="port of the web server")
+    parser.add_option("--log-dir", default="log",
+                      help="directory of the log files")
+    parser.add_option("--shard",
+                      help="run as the shard with this name, the shards are "
+                      "listed in the sharding section of the configuration")
+    options, _ = parser.parse_args()
+    logdir = options.log_dir
     if not os.path.exists(logdir):
         os.mkdir(logdir)
     elif not os.path.isdir(logdir):
         logging.error("[%s] is not a directory", logdir)
         sys.exit(-1)
-    utils.configure_logging(logdir)
-    ret = load_config()
+    cluster = read_config(options.config)["cluster"]
+    utils.configure_logging(logdir, cluster.get("logging"))
+    if options.shard is not None:
+        sharding = lime_shard.sharding_parse(cluster.get("sharding", {}))
+        if sharding is None:
+            sys.exit(-1)
+        shards, coordinator = sharding
+        if options.shard not in shards:
+            logging.error("shard [%s] is not in the shards %s",
+                          options.shard, shards)
+            sys.exit(-1)
+        SHARD = lime_shard.ShardMember(options.shard, shards, coordinator)
+    # With ingestion workers, the posts of Collectd are parsed by multiple
+    # processes, the controller process reads the counters from the table
+    ingest = cluster.get("ingest", {})
+    workers = ingest.get("workers", 0)
+    if workers > 0:
+        ingest_workers_start(workers, ingest.get("port", INGEST_PORT))
+    ret = load_config(options.config)
     if ret:
         logging.error("failed to load config")
         sys.exit(ret)
     monkey.patch_all()
-    http_server = WSGIServer(('0.0.0.0', 24), APP,
+    http_server = WSGIServer(('0.0.0.0', options.port), APP,
                              handler_class=WebSocketHandler)
     http_server.serve_forever()
     sys.exit(0)
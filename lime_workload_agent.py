@@ -0,0 +1,222 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Synthetic workload agent of LIME, which is deployed to and run on clients.
+
+The agent runs a workload pattern until it is killed, and prints a line of
+"bandwidth <time> <bytes_per_second> <ops_per_second>" every report
+interval. Only standard libraries are used, and it runs with both Python 2
+and Python 3 since the clients might have either one.
+"""
+
+import ctypes
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+PATTERN_SEQUENTIAL = "sequential"
+PATTERN_RANDOM = "random"
+DIRECTION_READ = "read"
+DIRECTION_WRITE = "write"
+# prctl() option to set the name of the calling thread
+PR_SET_NAME = 15
+# The exit status on I/O failure, which should differ from the 255 that SSH
+# exits with when the connection fails
+EXIT_IO_FAILURE = 1
+
+
+def set_process_name(name):
+    """
+    Set the name of the thread, the threads created later inherit it. The
+    job ID of Lustre might use the process name, e.g. "procname_uid".
+    """
+    try:
+        libc = ctypes.CDLL(None)
+        libc.prctl(PR_SET_NAME, ctypes.c_char_p(name.encode("ascii")),
+                   0, 0, 0)
+    except (OSError, AttributeError):
+        sys.stderr.write("failed to set process name to [%s]\n" % name)
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of the I/O, shared by all the workers
+    """
+    def __init__(self, rate):
+        # Bytes per second, 0 means unlimited
+        self.tb_rate = rate
+        self.tb_tokens = 0.0
+        self.tb_time = time.time()
+        self.tb_lock = threading.Lock()
+
+    def tb_consume(self, size):
+        """
+        Wait until the size could be consumed
+        """
+        if self.tb_rate <= 0:
+            return
+        while True:
+            self.tb_lock.acquire()
+            now = time.time()
+            # Allow a burst of one second at most
+            self.tb_tokens = min(self.tb_tokens +
+                                 (now - self.tb_time) * self.tb_rate,
+                                 self.tb_rate)
+            self.tb_time = now
+            if self.tb_tokens >= size:
+                self.tb_tokens -= size
+                self.tb_lock.release()
+                return
+            wait = (size - self.tb_tokens) / self.tb_rate
+            self.tb_lock.release()
+            time.sleep(wait)
+
+
+class Workload(object):
+    """
+    The workload with a pattern
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, options):
+        self.wl_fname = options.file
+        self.wl_pattern = options.pattern
+        self.wl_direction = options.direction
+        self.wl_block_size = options.block_size * 1024
+        self.wl_queue_depth = options.queue_depth
+        self.wl_blocks = max(options.file_size * 1024 * 1024 //
+                             self.wl_block_size, 1)
+        self.wl_bucket = TokenBucket(options.rate * 1000000)
+        self.wl_lock = threading.Lock()
+        self.wl_bytes = 0
+        self.wl_ops = 0
+        self.wl_next_block = 0
+        self.wl_error = None
+
+    def wl_block_get(self):
+        """
+        Return the next block to do I/O with
+        """
+        if self.wl_pattern == PATTERN_RANDOM:
+            return random.randint(0, self.wl_blocks - 1)
+        self.wl_lock.acquire()
+        block = self.wl_next_block
+        self.wl_next_block = (block + 1) % self.wl_blocks
+        self.wl_lock.release()
+        return block
+
+    def wl_prepare(self):
+        """
+        Make sure the file is large enough for reading
+        """
+        if self.wl_direction != DIRECTION_READ:
+            return
+        size = self.wl_blocks * self.wl_block_size
+        if os.path.exists(self.wl_fname) and \
+                os.path.getsize(self.wl_fname) >= size:
+            return
+        data = b"\0" * self.wl_block_size
+        fd = os.open(self.wl_fname, os.O_WRONLY | os.O_CREAT, 0o644)
+        for _ in range(self.wl_blocks):
+            os.write(fd, data)
+        os.close(fd)
+
+    def wl_worker(self):
+        """
+        One worker of the queue
+        """
+        if self.wl_direction == DIRECTION_READ:
+            fd = os.open(self.wl_fname, os.O_RDONLY)
+        else:
+            fd = os.open(self.wl_fname, os.O_WRONLY | os.O_CREAT, 0o644)
+        data = b"\0" * self.wl_block_size
+        try:
+            while True:
+                self.wl_bucket.tb_consume(self.wl_block_size)
+                os.lseek(fd, self.wl_block_get() * self.wl_block_size,
+                         os.SEEK_SET)
+                if self.wl_direction == DIRECTION_READ:
+                    size = len(os.read(fd, self.wl_block_size))
+                else:
+                    size = os.write(fd, data)
+                self.wl_lock.acquire()
+                self.wl_bytes += size
+                self.wl_ops += 1
+                self.wl_lock.release()
+        except OSError as error:
+            self.wl_error = error
+        finally:
+            os.close(fd)
+
+    def wl_run(self, report_interval):
+        """
+        Start the workers and report the bandwidth periodically
+        """
+        self.wl_prepare()
+        for _ in range(self.wl_queue_depth):
+            thread = threading.Thread(target=self.wl_worker)
+            thread.daemon = True
+            thread.start()
+
+        last_time = time.time()
+        last_bytes = 0
+        last_ops = 0
+        while self.wl_error is None:
+            time.sleep(report_interval)
+            now = time.time()
+            self.wl_lock.acquire()
+            total_bytes = self.wl_bytes
+            total_ops = self.wl_ops
+            self.wl_lock.release()
+            elapsed = now - last_time
+            sys.stdout.write("bandwidth %f %f %f\n" %
+                             (now, (total_bytes - last_bytes) / elapsed,
+                              (total_ops - last_ops) / elapsed))
+            sys.stdout.flush()
+            last_time = now
+            last_bytes = total_bytes
+            last_ops = total_ops
+        sys.stderr.write("I/O failure on file [%s]: %s\n" %
+                         (self.wl_fname, self.wl_error))
+        return -1
+
+
+def main():
+    """
+    Parse the options and run the workload
+    """
+    parser = optparse.OptionParser()
+    parser.add_option("--file", help="the file to do I/O with")
+    parser.add_option("--pattern", default=PATTERN_SEQUENTIAL,
+                      choices=[PATTERN_SEQUENTIAL, PATTERN_RANDOM])
+    parser.add_option("--direction", default=DIRECTION_WRITE,
+                      choices=[DIRECTION_READ, DIRECTION_WRITE])
+    parser.add_option("--block-size", type="int", default=1024,
+                      help="block size in KB")
+    parser.add_option("--queue-depth", type="int", default=1,
+                      help="number of concurrent I/O")
+    parser.add_option("--rate", type="float", default=0,
+                      help="target rate in MB/s, 0 means unlimited")
+    parser.add_option("--file-size", type="int", default=4096,
+                      help="size of the file in MB")
+    parser.add_option("--procname", default="dd",
+                      help="process name, which could be part of job ID")
+    parser.add_option("--report-interval", type="float", default=1,
+                      help="interval of reporting bandwidth in seconds")
+    options, _ = parser.parse_args()
+    if options.file is None:
+        parser.error("--file is needed")
+
+    set_process_name(options.procname)
+    workload = Workload(options)
+    ret = workload.wl_run(options.report_interval)
+    if ret:
+        return EXIT_IO_FAILURE
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
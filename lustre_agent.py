@@ -0,0 +1,185 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Connection to the resident agent of LIME on OSS, see lime_oss_agent.py
+"""
+
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# local libs
+import utils
+
+# The agent script, which is sent to the OSSes
+OSS_AGENT = "lime_oss_agent.py"
+# Where the agent script is put on the OSSes
+OSS_AGENT_DEST = "/tmp/lime_oss_agent.py"
+# The timeout of waiting for the reply of a message
+AGENT_REPLY_TIMEOUT = 5
+# The interval that the agent pushes the state
+AGENT_PUSH_INTERVAL = 1
+
+
+def oss_agent_source():
+    """
+    Return the path of the agent script on local host
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        OSS_AGENT)
+
+
+def oss_agent_local_command(proc_root):
+    """
+    Return the command to run the agent on local host against a fake proc
+    root, which stands in for an OSS
+    """
+    return ("%s %s --proc-root %s --push-interval %s" %
+            (sys.executable, oss_agent_source(), proc_root,
+             AGENT_PUSH_INTERVAL))
+
+
+def oss_agent_remote_command():
+    """
+    Return the command to run the agent on an OSS
+    """
+    return ("python %s --push-interval %s" %
+            (OSS_AGENT_DEST, AGENT_PUSH_INTERVAL))
+
+
+class AgentConnection(object):
+    """
+    A persistent stream to an agent. Messages are sent through stdin of the
+    agent process and replies are read from its stdout.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name, command):
+        self.ac_name = name
+        self.ac_command = command
+        self.ac_process = None
+        self.ac_ids = itertools.count(1)
+        # Key is message ID, value is [Event, reply]
+        self.ac_waiters = {}
+        self.ac_lock = threading.Lock()
+        self.ac_closed = True
+        # The latest state pushed by the agent
+        self.ac_state = None
+        self.ac_state_time = None
+
+    def ac_start(self):
+        """
+        Start the agent process
+        """
+        try:
+            self.ac_process = subprocess.Popen(self.ac_command,
+                                               stdin=subprocess.PIPE,
+                                               stdout=subprocess.PIPE,
+                                               shell=True)
+        except OSError:
+            logging.error("failed to start agent [%s] with command [%s]",
+                          self.ac_name, self.ac_command)
+            return -1
+        self.ac_closed = False
+        utils.thread_start(self.ac_reader, ())
+        logging.info("started agent [%s] with command [%s]", self.ac_name,
+                     self.ac_command)
+        return 0
+
+    def ac_reader(self):
+        """
+        Read the replies and the pushed states from the agent
+        """
+        while True:
+            line = self.ac_process.stdout.readline()
+            if len(line) == 0:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logging.error("invalid message from agent [%s]: [%s]",
+                              self.ac_name, line)
+                continue
+            if message.get("type") == "state":
+                self.ac_state = message
+                self.ac_state_time = time.time()
+            message_id = message.get("id")
+            if message_id is None:
+                continue
+            self.ac_lock.acquire()
+            waiter = self.ac_waiters.pop(message_id, None)
+            self.ac_lock.release()
+            if waiter is None:
+                continue
+            waiter[1] = message
+            waiter[0].set()
+        logging.error("agent [%s] exited", self.ac_name)
+        self.ac_close()
+
+    def ac_request(self, message, timeout=AGENT_REPLY_TIMEOUT):
+        """
+        Send a message and wait for the reply, return None on failure
+        """
+        if self.ac_closed:
+            return None
+        message_id = self.ac_ids.next()
+        message["id"] = message_id
+        waiter = [threading.Event(), None]
+        self.ac_lock.acquire()
+        self.ac_waiters[message_id] = waiter
+        try:
+            self.ac_process.stdin.write(json.dumps(message) + "\n")
+            self.ac_process.stdin.flush()
+        except (IOError, ValueError):
+            self.ac_waiters.pop(message_id, None)
+            self.ac_lock.release()
+            logging.error("failed to send message to agent [%s]",
+                          self.ac_name)
+            self.ac_close()
+            return None
+        self.ac_lock.release()
+
+        waiter[0].wait(timeout)
+        if waiter[1] is None:
+            self.ac_lock.acquire()
+            self.ac_waiters.pop(message_id, None)
+            self.ac_lock.release()
+            logging.error("timeout when waiting for reply from agent [%s]",
+                          self.ac_name)
+            return None
+        return waiter[1]
+
+    def ac_batch(self, commands):
+        """
+        Write a batch of commands to nrs_tbf_rule. Return the list of
+        results, None if the agent failed.
+        """
+        reply = self.ac_request({"type": "batch", "commands": commands})
+        if reply is None or reply.get("type") != "result":
+            return None
+        return reply["results"]
+
+    def ac_close(self):
+        """
+        Stop the agent
+        """
+        self.ac_lock.acquire()
+        if self.ac_closed:
+            self.ac_lock.release()
+            return
+        self.ac_closed = True
+        waiters = self.ac_waiters.values()
+        self.ac_waiters = {}
+        self.ac_lock.release()
+        for waiter in waiters:
+            waiter[0].set()
+        try:
+            self.ac_process.stdin.close()
+        except IOError:
+            pass
+        utils.nuke_subprocess(self.ac_process)
@@ -0,0 +1,492 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Benchmark the capacity of a Lustre cluster from all of its clients
+"""
+
+import json
+import logging
+import math
+import os
+import time
+
+# local libs
+import utils
+
+# The size of the file written by each client in each round
+BENCHMARK_SIZE_MB = 1024
+# The block size of the writes
+BENCHMARK_BLOCK_SIZE_KB = 1024
+# How long each target is benchmarked, in seconds
+BENCHMARK_DURATION = 10
+# The file to cache the results between restarts
+BENCHMARK_CACHE_FILE = "benchmark_cache.json"
+# The cached results older than this (in seconds) will be ignored
+BENCHMARK_CACHE_MAX_AGE = 86400
+# The percentiles reported for each target
+BENCHMARK_PERCENTILES = [50, 90, 99]
+# Target names
+TARGET_AGGREGATE = "aggregate"
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank percentile of the values
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    rank = max(0, min(rank, len(ordered) - 1))
+    return ordered[rank]
+
+
+class BenchmarkConfig(object):
+    """
+    The configuration of benchmark
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, size_mb=BENCHMARK_SIZE_MB,
+                 block_size_kb=BENCHMARK_BLOCK_SIZE_KB,
+                 duration=BENCHMARK_DURATION,
+                 cache_file=BENCHMARK_CACHE_FILE,
+                 cache_max_age=BENCHMARK_CACHE_MAX_AGE):
+        # pylint: disable=too-many-arguments
+        self.bc_size_mb = size_mb
+        self.bc_block_size_kb = block_size_kb
+        self.bc_duration = duration
+        self.bc_cache_file = cache_file
+        self.bc_cache_max_age = cache_max_age
+
+    def bc_key(self):
+        """
+        Return the key of this configuration, the cached results are only
+        valid for the same key
+        """
+        return ("size_mb=%s,block_size_kb=%s,duration=%s" %
+                (self.bc_size_mb, self.bc_block_size_kb, self.bc_duration))
+
+
+def benchmark_config_parse(config):
+    """
+    Parse the "benchmark" section of the configuration, all the fields are
+    optional
+    """
+    if config is None:
+        config = {}
+    return BenchmarkConfig(
+        size_mb=int(config.get("size_mb", BENCHMARK_SIZE_MB)),
+        block_size_kb=int(config.get("block_size_kb",
+                                     BENCHMARK_BLOCK_SIZE_KB)),
+        duration=float(config.get("duration", BENCHMARK_DURATION)),
+        cache_file=config.get("cache_file", BENCHMARK_CACHE_FILE),
+        cache_max_age=float(config.get("cache_max_age",
+                                       BENCHMARK_CACHE_MAX_AGE)))
+
+
+class BenchmarkResult(object):
+    """
+    The throughput samples (MB/s) of a benchmark target
+    """
+    def __init__(self, target, samples=None):
+        self.br_target = target
+        if samples is None:
+            samples = []
+        self.br_samples = samples
+
+    def br_add(self, sample):
+        """
+        Add a throughput sample
+        """
+        self.br_samples.append(sample)
+
+    def br_percentile(self, percent):
+        """
+        Return the percentile of the samples
+        """
+        return percentile(self.br_samples, percent)
+
+    def br_capacity(self):
+        """
+        The capacity of the target, i.e. the median throughput
+        """
+        return self.br_percentile(50)
+
+    def br_summary(self):
+        """
+        Return the summary of the samples
+        """
+        summary = {"samples": len(self.br_samples)}
+        if len(self.br_samples) == 0:
+            return summary
+        summary["mean"] = sum(self.br_samples) / len(self.br_samples)
+        summary["max"] = max(self.br_samples)
+        for percent in BENCHMARK_PERCENTILES:
+            summary["p%d" % percent] = self.br_percentile(percent)
+        return summary
+
+
+class ClusterBenchmark(object):
+    """
+    Benchmark the capacity of the whole cluster, of each OSS and of each
+    OST. All clients write concurrently in each round of a target.
+    """
+    def __init__(self, cluster, config, fake_io):
+        self.cb_cluster = cluster
+        self.cb_config = config
+        self.cb_fake_io = fake_io
+        self.cb_aggregate = BenchmarkResult(TARGET_AGGREGATE)
+        # Key is the OSS hostname
+        self.cb_osses = {}
+        # Key is the OST service name
+        self.cb_osts = {}
+        self.cb_time = None
+
+    def cb_cache_key(self):
+        """
+        The key of the results in the cache file
+        """
+        if self.cb_fake_io:
+            io_type = "fake"
+        else:
+            io_type = "real"
+        return "%s:%s:%s" % (self.cb_cluster.lc_fsname, io_type,
+                             self.cb_config.bc_key())
+
+    def cb_cache_load(self):
+        """
+        Load the results from the cache file, return 0 if loaded
+        """
+        fname = self.cb_config.bc_cache_file
+        if fname is None or not os.path.exists(fname):
+            return -1
+        try:
+            cache = json.load(open(fname))
+        except (IOError, ValueError):
+            logging.error("failed to load benchmark cache [%s]", fname)
+            return -1
+
+        key = self.cb_cache_key()
+        if key not in cache:
+            return -1
+        cached = cache[key]
+        if time.time() - cached["time"] > self.cb_config.bc_cache_max_age:
+            logging.info("cached benchmark results [%s] are too old", key)
+            return -1
+        self.cb_time = cached["time"]
+        self.cb_aggregate = BenchmarkResult(TARGET_AGGREGATE,
+                                            cached["aggregate"])
+        for hostname, samples in cached["osses"].iteritems():
+            self.cb_osses[hostname] = BenchmarkResult(hostname, samples)
+        for service_name, samples in cached["osts"].iteritems():
+            self.cb_osts[service_name] = BenchmarkResult(service_name,
+                                                         samples)
+        logging.info("loaded benchmark results [%s] from cache [%s]",
+                     key, fname)
+        return 0
+
+    def cb_cache_save(self):
+        """
+        Save the results to the cache file
+        """
+        fname = self.cb_config.bc_cache_file
+        if fname is None:
+            return 0
+        cache = {}
+        if os.path.exists(fname):
+            try:
+                cache = json.load(open(fname))
+            except (IOError, ValueError):
+                logging.error("ignoring broken benchmark cache [%s]", fname)
+        osses = {}
+        for hostname, result in self.cb_osses.iteritems():
+            osses[hostname] = result.br_samples
+        osts = {}
+        for service_name, result in self.cb_osts.iteritems():
+            osts[service_name] = result.br_samples
+        aggregate = self.cb_aggregate.br_samples
+        cache[self.cb_cache_key()] = {"time": self.cb_time,
+                                      "aggregate": aggregate,
+                                      "osses": osses,
+                                      "osts": osts}
+        try:
+            json.dump(cache, open(fname, "w"), indent=4)
+        except IOError:
+            logging.error("failed to save benchmark cache [%s]", fname)
+            return -1
+        return 0
+
+    def cb_round(self, placements, fnames):
+        """
+        Run one round of writing from all the placements concurrently,
+        return the aggregate throughput in MB/s
+        """
+        results = {}
+
+        def round_thread(index, service):
+            """
+            Write from one client
+            """
+            results[index] = service.ls_host.lh_benchmark_round(
+                service, fnames[index], self.cb_config)
+
+        threads = []
+        for index, placement in enumerate(placements):
+            service = placement[0]
+            threads.append(utils.thread_start(round_thread, (index, service)))
+        for thread in threads:
+            thread.join()
+
+        total_bytes = 0
+        elapsed = 0
+        for index in range(len(placements)):
+            result = results.get(index)
+            if result is None:
+                return -1
+            written, seconds = result
+            total_bytes += written
+            elapsed = max(elapsed, seconds)
+        if elapsed <= 0:
+            return -1
+        return total_bytes / elapsed / 1000000
+
+    def cb_target(self, result, placements):
+        """
+        Benchmark a target for the configured duration. A placement is a
+        tuple of the client service and the index of the OST to write to,
+        the index is None if the file should be striped to all OSTs.
+        """
+        fnames = []
+        try:
+            ret = self._cb_target_run(result, placements, fnames)
+        finally:
+            # Remove the files even if the benchmark failed, otherwise they
+            # would use the space of the OSTs
+            for index, fname in enumerate(fnames):
+                service = placements[index][0]
+                service.ls_host.sh_run("rm -f %s" % fname)
+        return ret
+
+    def _cb_target_run(self, result, placements, fnames):
+        """
+        Prepare the files and benchmark a target. The name of a file is
+        appended to fnames before it is created, so the caller could
+        remove it.
+        """
+        for index, placement in enumerate(placements):
+            service, ost_index = placement
+            fname = ("%s/%s_benchmark_%d" %
+                     (service.ls_mount_point, service.ls_host.sh_hostname,
+                      index))
+            fnames.append(fname)
+            ret = service.ls_host.lh_benchmark_prepare(service, fname,
+                                                       ost_index)
+            if ret:
+                logging.error("failed to prepare benchmark of target [%s] "
+                              "on host [%s]", result.br_target,
+                              service.ls_host.sh_hostname)
+                return ret
+
+        start_time = time.time()
+        while True:
+            throughput = self.cb_round(placements, fnames)
+            if throughput < 0:
+                logging.error("failed to benchmark target [%s]",
+                              result.br_target)
+                return -1
+            result.br_add(throughput)
+            if time.time() - start_time >= self.cb_config.bc_duration:
+                break
+
+        logging.info("benchmark of target [%s]: %s", result.br_target,
+                     result.br_summary())
+        return 0
+
+    def cb_run(self):
+        """
+        Run the benchmark of all targets, or load the results from cache
+        """
+        ret = self.cb_cache_load()
+        if ret == 0:
+            return 0
+
+        clients = self.cb_cluster.lc_client_services()
+        osts = self.cb_cluster.lc_ost_services()
+        if len(clients) == 0:
+            logging.error("no client to benchmark cluster [%s]",
+                          self.cb_cluster.lc_fsname)
+            return -1
+
+        placements = [(client, None) for client in clients]
+        ret = self.cb_target(self.cb_aggregate, placements)
+        if ret:
+            return ret
+
+        for hostname, services in osts.iteritems():
+            placements = []
+            for index, client in enumerate(clients):
+                service = services[index % len(services)]
+                placements.append((client, service.ls_ost_index()))
+            result = BenchmarkResult(hostname)
+            ret = self.cb_target(result, placements)
+            if ret:
+                return ret
+            self.cb_osses[hostname] = result
+
+            for service in services:
+                placements = [(client, service.ls_ost_index())
+                              for client in clients]
+                result = BenchmarkResult(service.ls_service_name)
+                ret = self.cb_target(result, placements)
+                if ret:
+                    return ret
+                self.cb_osts[service.ls_service_name] = result
+
+        self.cb_time = time.time()
+        self.cb_cache_save()
+        return 0
+
+    def cb_oss_capacity(self, hostname):
+        """
+        Return the capacity of an OSS in MB/s, None if unknown
+        """
+        if hostname not in self.cb_osses:
+            return None
+        return self.cb_osses[hostname].br_capacity()
+
+    def cb_ost_capacity(self, service_name):
+        """
+        Return the capacity of an OST in MB/s, None if unknown
+        """
+        if service_name not in self.cb_osts:
+            return None
+        return self.cb_osts[service_name].br_capacity()
+
+
+# The weight of a new observation when a saturated target is updated
+CAPACITY_EWMA_WEIGHT = 0.2
+# How many consecutive saturated ticks on a plateau before updating a
+# capacity downwards
+CAPACITY_SATURATION_TICKS = 5
+# The throughput is on a plateau if it rises less than this fraction over
+# the highest throughput of the saturated ticks
+CAPACITY_PLATEAU_TOLERANCE = 0.05
+# A capacity never goes below this fraction of the benchmarked value, since
+# a saturated-looking target might just have too few I/O to do
+CAPACITY_MIN_FRACTION = 0.5
+
+
+class TargetCapacity(object):
+    """
+    The capacity (MB/s) of an OSS or an OST. It starts from the benchmark
+    and is only updated online afterwards, the observations alone never
+    create a capacity.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, capacity):
+        # The capacity updated by the observed rates
+        self.tc_capacity = capacity
+        self.tc_floor = capacity * CAPACITY_MIN_FRACTION
+        self.tc_saturated_ticks = 0
+        # The highest throughput since the target became saturated
+        self.tc_plateau_rate = None
+
+    def tc_observe(self, rate, saturated):
+        """
+        Update the capacity according to the observed rate. A target that
+        delivers more than its capacity raises it immediately. The capacity
+        only moves down towards the rate if the target is saturated, i.e.
+        no job on it is held back by its limit, and the throughput has
+        stopped rising for a while.
+        """
+        if rate > self.tc_capacity:
+            self.tc_capacity = rate
+        if not saturated or rate <= 0:
+            self.tc_saturated_ticks = 0
+            self.tc_plateau_rate = None
+            return
+        if (self.tc_plateau_rate is None or
+                rate > self.tc_plateau_rate *
+                (1 + CAPACITY_PLATEAU_TOLERANCE)):
+            # Still rising, the limits are not what stops the throughput
+            self.tc_plateau_rate = rate
+            self.tc_saturated_ticks = 0
+            return
+        self.tc_saturated_ticks += 1
+        if self.tc_saturated_ticks < CAPACITY_SATURATION_TICKS:
+            return
+        capacity = ((1 - CAPACITY_EWMA_WEIGHT) * self.tc_capacity +
+                    CAPACITY_EWMA_WEIGHT * self.tc_plateau_rate)
+        self.tc_capacity = max(capacity, self.tc_floor)
+
+
+class CapacityMap(object):
+    """
+    The capacity model of the OSSes and the OSTs of a cluster, both for
+    real I/O and fake I/O. It is filled in by benchmark and then updated
+    online by the observed rates.
+    """
+    def __init__(self):
+        # Key is whether fake I/O, value is a dict of hostname -> capacity
+        self.cm_osses = {False: {}, True: {}}
+        # Key is whether fake I/O, value is a dict of OST -> capacity
+        self.cm_osts = {False: {}, True: {}}
+        # Key is whether fake I/O, value is the capacity of the cluster
+        self.cm_aggregate = {False: None, True: None}
+
+    def cm_benchmark_load(self, benchmark):
+        """
+        Fill in the capacities from the benchmark results
+        """
+        fake_io = benchmark.cb_fake_io
+        self.cm_aggregate[fake_io] = benchmark.cb_aggregate.br_capacity()
+        for hostname, result in benchmark.cb_osses.iteritems():
+            capacity = result.br_capacity()
+            if capacity is not None:
+                self.cm_osses[fake_io][hostname] = TargetCapacity(capacity)
+        for service_name, result in benchmark.cb_osts.iteritems():
+            capacity = result.br_capacity()
+            if capacity is not None:
+                self.cm_osts[fake_io][service_name] = \
+                    TargetCapacity(capacity)
+
+    def cm_oss_capacity(self, hostname, fake_io):
+        """
+        Return the capacity of an OSS, None if unknown
+        """
+        target = self.cm_osses[fake_io].get(hostname)
+        if target is None:
+            return None
+        return target.tc_capacity
+
+    def cm_ost_capacity(self, service_name, fake_io):
+        """
+        Return the capacity of an OST, None if unknown
+        """
+        target = self.cm_osts[fake_io].get(service_name)
+        if target is None:
+            return None
+        return target.tc_capacity
+
+    def cm_cluster_capacity(self, fake_io):
+        """
+        Return the capacity of the cluster, None if unknown
+        """
+        return self.cm_aggregate[fake_io]
+
+    def cm_oss_observe(self, hostname, fake_io, rate, saturated):
+        """
+        Update the capacity of a benchmarked OSS by the observed rate
+        """
+        target = self.cm_osses[fake_io].get(hostname)
+        if target is not None:
+            target.tc_observe(rate, saturated)
+
+    def cm_ost_observe(self, service_name, fake_io, rate, saturated):
+        """
+        Update the capacity of a benchmarked OST by the observed rate
+        """
+        target = self.cm_osts[fake_io].get(service_name)
+        if target is not None:
+            target.tc_observe(rate, saturated)
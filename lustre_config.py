@@ -5,12 +5,53 @@
 Config Lustre using SSH connection
 """
 
+import os
 import re
+import math
 import logging
+import threading
+import time
 
 # local libs
 import ssh_host
 import utils
+import lustre_agent
+import lustre_benchmark
+import lustre_tbf
+import lustre_workload
+import watched_io
+
+# The timeout of probing a host, an unreachable host should not block others
+LUSTRE_PROBE_TIMEOUT = 30
+# The interval before probing a host again after a failure
+LUSTRE_PROBE_RETRY_INTERVAL = 60
+# The TTL of cached Lustre probes, e.g. version, devices and CPT setting.
+# These only change when Lustre is reconfigured.
+LUSTRE_CACHE_TTL = 60
+# The command to get the filesystems on MGS
+LUSTRE_MGS_FILESYSTEMS_COMMAND = "cat /proc/fs/lustre/mgs/MGS/filesystems"
+# The sections of the probe script that runs on each host, each section is
+# (name, command)
+LUSTRE_PROBE_SECTIONS = [
+    ("version", "cat /proc/fs/lustre/version"),
+    ("devices", "lctl dl"),
+    ("mounts", "cat /proc/mounts"),
+    ("mgs_filesystems", LUSTRE_MGS_FILESYSTEMS_COMMAND),
+    ("cpt", "cat /sys/module/libcfs/parameters/cpu_npartitions")]
+# The first field of the line that ends a section of the probe output, the
+# other fields are the section name and the exit status of its command
+LUSTRE_PROBE_MARKER = "@@lime_probe"
+# The proc entry to control the TBF rules of ost_io
+LUSTRE_NRS_TBF_RULE = "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule"
+# The state pushed by the agent older than this is not used as TBF rules
+LUSTRE_AGENT_STATE_MAX_AGE = lustre_agent.AGENT_PUSH_INTERVAL * 2
+# The first delay before reconnecting to a workload agent after the SSH
+# connection failed, doubled after each quick failure up to the maximum
+LUSTRE_WORKLOAD_RESTART_DELAY = 1
+# The maximum delay before reconnecting to a workload agent, a connection
+# that lasted longer than this gets the first delay again
+LUSTRE_WORKLOAD_RESTART_DELAY_MAX = 60
+
 
 class LustreService(object):
     # pylint: disable=too-few-public-methods
@@ -31,6 +72,58 @@ class LustreService(object):
         self.ls_host = host
         self.ls_mount_point = mount_point
 
+    def ls_ost_index(self):
+        """
+        Return the numeric index of an OST service
+        """
+        assert self.ls_service_type == LustreService.TYPE_OST
+        return int(self.ls_service_name[len("OST"):], 16)
+
+
+def lustre_probe_script():
+    """
+    Return the script that collects all the sections in one run. An empty
+    line is printed before each marker in case the output of the command
+    does not end with a newline.
+    """
+    commands = []
+    for name, command in LUSTRE_PROBE_SECTIONS:
+        commands.append("%s 2>/dev/null; status=$?; echo; echo %s %s $status" %
+                        (command, LUSTRE_PROBE_MARKER, name))
+    return "; ".join(commands)
+
+
+def lustre_probe_parse(output):
+    """
+    Parse the output of the probe script in one pass. Return a dict, key is
+    the section name, value is the CommandResult of the section command.
+    """
+    sections = {}
+    lines = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == LUSTRE_PROBE_MARKER:
+            try:
+                exit_status = int(fields[2])
+            except ValueError:
+                logging.error("invalid probe marker [%s]", line)
+                return None
+            # Remove the empty line printed before the marker
+            if len(lines) > 0 and lines[-1] == "":
+                lines.pop()
+            stdout = "".join([probe_line + "\n" for probe_line in lines])
+            sections[fields[1]] = utils.CommandResult(stdout=stdout,
+                                                      exit_status=exit_status)
+            lines = []
+            continue
+        lines.append(line)
+    for name, _ in LUSTRE_PROBE_SECTIONS:
+        if name not in sections:
+            logging.error("section [%s] is missing in the probe output",
+                          name)
+            return None
+    return sections
+
 
 def version_value(major, minor, patch):
     """
@@ -69,7 +162,28 @@ class LustreHost(ssh_host.SSHHost):
         self.lh_lustre_version_patch = None
         self.lh_lustre_version_fix = None
         self.lh_version_value = None
-        self.lh_detect_lustre_version()
+        # Whether the TBF rule commands use "jobid={...} rate=..." syntax
+        self.lh_tbf_key_value_syntax = None
+        # Protect the probing so that it only happens once at the same time
+        self.lh_probe_lock = threading.Lock()
+        self.lh_probe_failure_time = None
+        # Whether the probe succeeded, only set after all the probed fields
+        # are filled, so that it could be checked without the lock
+        self.lh_probed = False
+        self.lh_workload_agent_deployed = False
+        # The mount points whose workload is stopped, so that their agents
+        # are not started again
+        self.lh_workload_stopped = set()
+        # The connection to the resident agent, None if not running
+        self.lh_agent = None
+        # The active TBF rules, key is rule name, value is TBFRule. None if
+        # unknown, e.g. never read or a write failed.
+        self.lh_tbf_rules = None
+        # Serialize the reads and writes of the TBF rules, so that a read
+        # never replaces the model with the rules before a write
+        self.lh_tbf_lock = threading.RLock()
+        # When the last write of the TBF rules finished
+        self.lh_tbf_write_time = 0
 
     def lh_detect_services(self, cluster_services, map_service_host):
         # pylint: disable=too-many-statements
@@ -79,8 +193,15 @@ class LustreHost(ssh_host.SSHHost):
         logging.debug("detecting services on host [%s]", self.sh_hostname)
         services = {}
 
+        # All the information comes from one run of the probe script. The
+        # MGS filesystems are only used if a MGS is found.
+        probe = self.lh_probe_host()
+        if probe is None:
+            logging.error("failed to probe host [%s]", self.sh_hostname)
+            return -1
         command = ("lctl dl")
-        retval = self.sh_run(command)
+        retval = probe["devices"]
+        mgs_retval = probe["mgs_filesystems"]
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -92,73 +213,36 @@ class LustreHost(ssh_host.SSHHost):
 
         logging.debug("command [%s] output on host [%s]: [%s]",
                       command, self.sh_hostname, retval.cr_stdout)
-        for line in retval.cr_stdout.splitlines():
-            logging.debug("checking line [%s]", line)
-            match = self.lh_cluster.lc_mdt_regular.match(line)
-            if match:
-                mdt_index = match.group("mdt_index")
-                service_name = ("MDT%s" % (mdt_index))
-                logging.debug("service [%s] running on host [%s]",
-                              service_name, self.sh_hostname)
-                if service_name in cluster_services:
-                    service = cluster_services[service_name]
-                    logging.error("two hosts [%s] and [%s] for service [%s]",
-                                  service.ls_host.sh_hostname,
-                                  self.sh_hostname, service_name)
-                    return -1
-                service = LustreService(self.lh_cluster,
-                                        LustreService.TYPE_MDT,
-                                        service_name,
-                                        self)
-                cluster_services[service_name] = service
-                services[service_name] = service
-                map_service_host[service_name] = self
-
-            match = self.lh_cluster.lc_ost_regular.match(line)
-            if match:
-                ost_index = match.group("ost_index")
-                service_name = ("OST%s" % (ost_index))
-                logging.debug("service [%s] running on host [%s]",
-                              service_name, self.sh_hostname)
-                if service_name in cluster_services:
-                    service = cluster_services[service_name]
-                    logging.error("two hosts [%s] and [%s] for service [%s]",
-                                  service.ls_host.sh_hostname,
-                                  self.sh_hostname, service_name)
-                    return -1
-                service = LustreService(self.lh_cluster,
-                                        LustreService.TYPE_OST, service_name,
-                                        self)
-                cluster_services[service_name] = service
-                services[service_name] = service
-                map_service_host[service_name] = self
-
-            match = self.lh_cluster.lc_mgs_regular.match(line)
-            if match:
+        classifier = self.lh_cluster.lc_device_classifier
+        for service_type, match in classifier.lcl_iterate(retval.cr_stdout):
+            if service_type == LustreService.TYPE_MDT:
+                service_name = ("MDT%s" % match.group("mdt_index"))
+            elif service_type == LustreService.TYPE_OST:
+                service_name = ("OST%s" % match.group("ost_index"))
+            else:
                 service_name = "MGS"
                 logging.debug("service [%s] might be running on host [%s]",
                               service_name, self.sh_hostname)
-
-                filesystems = self.lh_mgs_get_filesystems()
+                filesystems = self.lh_mgs_get_filesystems(retval=mgs_retval)
                 if self.lh_cluster.lc_fsname not in filesystems:
-                    continue                
-
-                if service_name in cluster_services:
-                    service = cluster_services[service_name]
-                    logging.error("two hosts [%s] and [%s] for service [%s]",
-                                  service.ls_host.sh_hostname,
-                                  self.sh_hostname, service_name)
-                    return -1
-                service = LustreService(self.lh_cluster,
-                                        LustreService.TYPE_MGS,
-                                        service_name, self)
-                cluster_services[service_name] = service
-                services[service_name] = service
-                map_service_host[service_name] = self
+                    continue
+            logging.debug("service [%s] running on host [%s]",
+                          service_name, self.sh_hostname)
+            if service_name in cluster_services:
+                service = cluster_services[service_name]
+                logging.error("two hosts [%s] and [%s] for service [%s]",
+                              service.ls_host.sh_hostname,
+                              self.sh_hostname, service_name)
+                return -1
+            service = LustreService(self.lh_cluster, service_type,
+                                    service_name, self)
+            cluster_services[service_name] = service
+            services[service_name] = service
+            map_service_host[service_name] = self
 
         # Detect Lustre client
-        command = ("cat /proc/mounts | grep lustre")
-        retval = self.sh_run(command)
+        command = ("cat /proc/mounts")
+        retval = probe["mounts"]
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -168,22 +252,20 @@ class LustreHost(ssh_host.SSHHost):
                           retval.cr_stderr)
             return -1
 
-        for line in retval.cr_stdout.splitlines():
-            logging.debug("checking line [%s]", line)
-            match = self.lh_cluster.lc_client_regular.match(line)
-            if match:
-                mount_point = match.group("mount_point")
-                service_name = ("client:%s:%s" %
-                                (self.sh_hostname, mount_point))
-                service = LustreService(self.lh_cluster,
-                                        LustreService.TYPE_CLIENT,
-                                        service_name, self,
-                                        mount_point=mount_point)
-                cluster_services[service_name] = service
-                services[service_name] = service
-                map_service_host[service_name] = self
-                logging.debug("service [%s] running on host [%s]",
-                              service_name, self.sh_hostname)
+        client_regular = self.lh_cluster.lc_client_regular
+        for match in client_regular.finditer(retval.cr_stdout):
+            mount_point = match.group("mount_point")
+            service_name = ("client:%s:%s" %
+                            (self.sh_hostname, mount_point))
+            service = LustreService(self.lh_cluster,
+                                    LustreService.TYPE_CLIENT,
+                                    service_name, self,
+                                    mount_point=mount_point)
+            cluster_services[service_name] = service
+            services[service_name] = service
+            map_service_host[service_name] = self
+            logging.debug("service [%s] running on host [%s]",
+                          service_name, self.sh_hostname)
 
         self.lh_services = services
         return 0
@@ -239,36 +321,79 @@ class LustreHost(ssh_host.SSHHost):
             return -1
         return 0
 
-    def lh_start_tbf_rule(self, name, expression, rate):
+    def lh_agent_start(self, proc_root=None):
         """
-        Start an TBF rule
+        Start the resident agent for TBF control. If proc_root is not None,
+        the agent runs on local host against the fake proc root, which
+        stands in for this host.
         """
-        if self.lh_version_value >= version_value(2, 8, 54):
-            command = ("echo -n start %s jobid={%s} rate=%d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, expression, rate))
+        if proc_root is None:
+            ret = self.sh_send_file(lustre_agent.oss_agent_source(),
+                                    lustre_agent.OSS_AGENT_DEST)
+            if ret:
+                logging.error("failed to send agent to host [%s]",
+                              self.sh_hostname)
+                return ret
+            command = ssh_host.ssh_command(
+                self.sh_hostname, lustre_agent.oss_agent_remote_command(),
+                identity_file=self.sh_identity_file)
         else:
-            command = ("echo -n start %s {%s} %d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, expression, rate))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
+            command = lustre_agent.oss_agent_local_command(proc_root)
+        agent = lustre_agent.AgentConnection(self.sh_hostname, command)
+        ret = agent.ac_start()
+        if ret:
+            return ret
+        self.lh_agent = agent
         return 0
 
-    def lh_stop_tbf_rule(self, name):
+    def lh_agent_stop(self):
         """
-        Start an TBF rule
+        Stop the resident agent
         """
-        command = ("echo -n stop %s > "
-                   "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                   (name))
+        if self.lh_agent is None:
+            return
+        self.lh_agent.ac_close()
+        self.lh_agent = None
+
+    def lh_tbf_rule_write(self, commands):
+        """
+        Write the commands to the TBF rule entry of ost_io. The agent is
+        used if it is running, otherwise fall back to SSH.
+        """
+        self.lh_tbf_lock.acquire()
+        try:
+            return self._lh_tbf_rule_write(commands)
+        finally:
+            # Even a failed write could have changed some rules, so the
+            # state that the agent read before now is outdated
+            self.lh_tbf_write_time = time.time()
+            self.lh_tbf_lock.release()
+
+    def _lh_tbf_rule_write(self, commands):
+        """
+        Write the commands without the lock
+        """
+        agent = self.lh_agent
+        if agent is not None and not agent.ac_closed:
+            results = agent.ac_batch(commands)
+            if results is not None:
+                ret = 0
+                for command, result in zip(commands, results):
+                    if result:
+                        logging.error("failed to write [%s] to [%s] on "
+                                      "host [%s] through agent, ret = [%d]",
+                                      command, LUSTRE_NRS_TBF_RULE,
+                                      self.sh_hostname, result)
+                        ret = -1
+                if ret:
+                    self.lh_tbf_rules = None
+                return ret
+            logging.error("agent on host [%s] failed, falling back to SSH",
+                          self.sh_hostname)
+
+        command = " && ".join(["echo -n %s > %s" %
+                               (tbf_command, LUSTRE_NRS_TBF_RULE)
+                               for tbf_command in commands])
         retval = self.sh_run(command)
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
@@ -277,39 +402,209 @@ class LustreHost(ssh_host.SSHHost):
                           retval.cr_exit_status,
                           retval.cr_stdout,
                           retval.cr_stderr)
+            self.lh_tbf_rules = None
             return -1
         return 0
 
+    def lh_tbf_rules_read(self):
+        """
+        Read the active TBF rules and update the model. The state pushed by
+        the agent is used if it is fresh and was received after the last
+        write, otherwise read through SSH. Return the TBFRuleDiff since the
+        last read, None on failure.
+        """
+        self.lh_tbf_lock.acquire()
+        try:
+            data = None
+            agent = self.lh_agent
+            if (agent is not None and not agent.ac_closed and
+                    agent.ac_state is not None and
+                    agent.ac_state_time > self.lh_tbf_write_time and
+                    time.time() - agent.ac_state_time <=
+                    LUSTRE_AGENT_STATE_MAX_AGE):
+                data = agent.ac_state.get("nrs_tbf_rule")
+            if data is None:
+                command = ("cat %s" % LUSTRE_NRS_TBF_RULE)
+                retval = self.sh_run(command, silent=True)
+                if retval.cr_exit_status != 0:
+                    logging.error("failed to run command [%s] on host [%s], "
+                                  "ret = [%d], stdout = [%s], stderr = [%s]",
+                                  command, self.sh_hostname,
+                                  retval.cr_exit_status,
+                                  retval.cr_stdout,
+                                  retval.cr_stderr)
+                    return None
+                data = retval.cr_stdout
+            rules = lustre_tbf.tbf_rules_parse(data)
+            if rules is None:
+                logging.error("failed to parse TBF rules on host [%s]",
+                              self.sh_hostname)
+                return None
+            diff = lustre_tbf.tbf_rules_diff(self.lh_tbf_rules, rules)
+            self.lh_tbf_rules = rules
+            return diff
+        finally:
+            self.lh_tbf_lock.release()
+
+    def lh_tbf_rules_cleanup(self, keep_names=None, keep_func=None):
+        """
+        Stop all the TBF rules except the default one, the ones in
+        keep_names and the ones that keep_func(rule) returns True for in one
+        batch, e.g. the rules left by a former run
+        """
+        self.lh_tbf_lock.acquire()
+        try:
+            diff = self.lh_tbf_rules_read()
+            if diff is None:
+                return -1
+            if keep_names is None:
+                keep_names = []
+            if keep_func is not None:
+                keep_names = keep_names + [name for name, rule
+                                           in self.lh_tbf_rules.iteritems()
+                                           if keep_func(rule)]
+            commands = []
+            for name in self.lh_tbf_rules:
+                if name == lustre_tbf.TBF_DEFAULT_RULE or name in keep_names:
+                    continue
+                logging.info("stopping orphaned TBF rule [%s] on host [%s]",
+                             name, self.sh_hostname)
+                commands.append("stop %s" % name)
+            if len(commands) == 0:
+                return 0
+            ret = self.lh_tbf_rule_write(commands)
+            if ret:
+                return ret
+            for name in self.lh_tbf_rules.keys():
+                if (name != lustre_tbf.TBF_DEFAULT_RULE and
+                        name not in keep_names):
+                    del self.lh_tbf_rules[name]
+            return 0
+        finally:
+            self.lh_tbf_lock.release()
+
+    def lh_start_tbf_rule(self, name, expression, rate):
+        """
+        Start an TBF rule. If it fails because the model missed a rule with
+        the same name, the rules are read again and the start is retried.
+        """
+        self.lh_tbf_lock.acquire()
+        try:
+            ret = self.lh_probe_needed()
+            if ret:
+                return ret
+            ret = self._lh_start_tbf_rule(name, expression, rate)
+            if ret == 0:
+                return 0
+            if self.lh_tbf_rules_read() is None:
+                return ret
+            if name not in self.lh_tbf_rules:
+                return ret
+            logging.info("TBF rule [%s] exists on host [%s] although not "
+                         "known, retrying", name, self.sh_hostname)
+            return self._lh_start_tbf_rule(name, expression, rate)
+        finally:
+            self.lh_tbf_lock.release()
+
+    def _lh_start_tbf_rule(self, name, expression, rate):
+        """
+        Start an TBF rule without the lock and the retry
+        """
+        rules = self.lh_tbf_rules
+        commands = []
+        if rules is not None and name in rules:
+            rule = rules[name]
+            if rule.tr_expression == expression:
+                return self.lh_change_tbf_rate(name, rate)
+            commands.append("stop %s" % (name))
+        if self.lh_tbf_key_value_syntax:
+            commands.append("start %s jobid={%s} rate=%d" %
+                            (name, expression, rate))
+        else:
+            commands.append("start %s {%s} %d" % (name, expression, rate))
+        ret = self.lh_tbf_rule_write(commands)
+        if ret == 0 and rules is not None:
+            rules[name] = lustre_tbf.TBFRule(name, expression, rate)
+        return ret
+
+    def lh_stop_tbf_rule(self, name):
+        """
+        Stop an TBF rule. The stop is always written, since the model could
+        miss a rule that exists. If it fails, the rules are read again and
+        a rule that does not exist counts as stopped.
+        """
+        self.lh_tbf_lock.acquire()
+        try:
+            command = ("stop %s" % (name))
+            ret = self.lh_tbf_rule_write([command])
+            if ret:
+                if self.lh_tbf_rules_read() is None:
+                    return ret
+                if name in self.lh_tbf_rules:
+                    return ret
+                logging.debug("TBF rule [%s] does not exist on host [%s], no "
+                              "need to stop", name, self.sh_hostname)
+                return 0
+            rules = self.lh_tbf_rules
+            if rules is not None:
+                rules.pop(name, None)
+            return ret
+        finally:
+            self.lh_tbf_lock.release()
+
     def lh_change_tbf_rate(self, name, rate):
         """
         Change the TBF rate of a rule
         """
-        if self.lh_version_value >= version_value(2, 8, 54):
-            command = ("echo -n change %s rate=%d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, rate))
-        else:
-            command = ("echo -n change %s %d > "
-                       "/proc/fs/lustre/ost/OSS/ost_io/nrs_tbf_rule" %
-                       (name, rate))
-        retval = self.sh_run(command)
+        self.lh_tbf_lock.acquire()
+        try:
+            rules = self.lh_tbf_rules
+            if (rules is not None and name in rules and
+                    rules[name].tr_rate == rate):
+                return 0
+            ret = self.lh_probe_needed()
+            if ret:
+                return ret
+            if self.lh_tbf_key_value_syntax:
+                command = ("change %s rate=%d" % (name, rate))
+            else:
+                command = ("change %s %d" % (name, rate))
+            ret = self.lh_tbf_rule_write([command])
+            if ret == 0 and rules is not None and name in rules:
+                rules[name].tr_rate = rate
+            return ret
+        finally:
+            self.lh_tbf_lock.release()
+
+    def lh_probe_host(self, refresh=False):
+        """
+        Run the probe script on the host, or reuse the cached output of it.
+        Return the dict of sections, None on failure.
+        """
+        command = lustre_probe_script()
+        if refresh:
+            self.sh_cache_invalidate(command)
+        retval = self.sh_run_cached(command, LUSTRE_CACHE_TTL,
+                                    timeout=LUSTRE_PROBE_TIMEOUT)
         if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
+            logging.error("failed to run probe script on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
+                          self.sh_hostname,
                           retval.cr_exit_status,
                           retval.cr_stdout,
                           retval.cr_stderr)
-            return -1
-        return 0
+            return None
+        return lustre_probe_parse(retval.cr_stdout)
 
     def lh_detect_lustre_version(self):
         """
         Detect the Lustre version
         """
-        command = ("cat /proc/fs/lustre/version | grep lustre: | "
-                   "awk '{print $2}'")
-        retval = self.sh_run(command)
+        probe = self.lh_probe_host()
+        if probe is None:
+            return -1
+        command = ("cat /proc/fs/lustre/version")
+        retval = probe["version"]
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -318,7 +613,12 @@ class LustreHost(ssh_host.SSHHost):
                           retval.cr_stdout,
                           retval.cr_stderr)
             return -1
-        self.lh_lustre_version_string = retval.cr_stdout.strip()
+        self.lh_lustre_version_string = ""
+        for line in retval.cr_stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == "lustre:":
+                self.lh_lustre_version_string = fields[1]
+                break
         #version_pattern = (r"^(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)\."
         #                   r"(?P<fix>\d+)$")
         version_pattern = (r"^(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)")
@@ -341,12 +641,56 @@ class LustreHost(ssh_host.SSHHost):
                       self.lh_version_value)
         return 0
 
+    def lh_probe(self):
+        """
+        Detect the version and capabilities of the host. The result is
+        memoized, a failed probe will only be retried after an interval.
+        """
+        self.lh_probe_lock.acquire()
+        try:
+            if self.lh_probed:
+                return 0
+            if (self.lh_probe_failure_time is not None and
+                    time.time() < (self.lh_probe_failure_time +
+                                   LUSTRE_PROBE_RETRY_INTERVAL)):
+                return -1
+            ret = self.lh_detect_lustre_version()
+            if ret:
+                logging.error("failed to probe host [%s]", self.sh_hostname)
+                self.lh_version_value = None
+                self.lh_probe_failure_time = time.time()
+                return ret
+            self.lh_tbf_key_value_syntax = (self.lh_version_value >=
+                                            version_value(2, 8, 54))
+            self.lh_probe_failure_time = None
+            self.lh_probed = True
+            return 0
+        finally:
+            self.lh_probe_lock.release()
+
+    def lh_probe_needed(self):
+        """
+        Make sure the host has been probed, the first one that needs it
+        will probe all the hosts of the cluster concurrently
+        """
+        if self.lh_probed:
+            return 0
+        self.lh_cluster.lc_probe_hosts()
+        if not self.lh_probed:
+            logging.error("unknown Lustre version on host [%s]",
+                          self.sh_hostname)
+            return -1
+        return 0
+
     def lh_check_cpt(self):
         """
         Check whether the cpu_npartitions module param of libcfs is 1
         """
+        probe = self.lh_probe_host()
+        if probe is None:
+            return -1
         command = ("cat /sys/module/libcfs/parameters/cpu_npartitions")
-        retval = self.sh_run(command)
+        retval = probe["cpt"]
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -439,28 +783,81 @@ class LustreHost(ssh_host.SSHHost):
             return -1
         return 0
 
-    def lh_io_thread(self, login_name, fname):
+    def lh_workload_agent_deploy(self):
         """
-        The thread of doing I/O
+        Send the workload agent to this host
         """
-        while True:
-            command = ("dd if=/dev/zero of=%s bs=1M" % (fname))
-            retval = self.sh_run(command, login_name=login_name)
-            if retval.cr_exit_status != 0:
-                logging.error("failed to run command [%s] on host [%s], "
-                              "ret = [%d], stdout = [%s], stderr = [%s]",
+        if self.lh_workload_agent_deployed:
+            return 0
+        source = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              lustre_workload.WORKLOAD_AGENT)
+        ret = self.sh_send_file(source, lustre_workload.WORKLOAD_AGENT_DEST)
+        if ret:
+            logging.error("failed to send workload agent to host [%s]",
+                          self.sh_hostname)
+            return ret
+        self.lh_workload_agent_deployed = True
+        return 0
+
+    def lh_workload_thread(self, login_name, mount_point, fname, workload,
+                           stats, log_fname):
+        """
+        The thread of running the workload agent, the agent keeps on
+        running until it is killed by lh_stop_io(). If the SSH connection
+        fails, the agent is started again with an exponential backoff. If
+        the agent itself fails or is killed otherwise, give up.
+        """
+        # pylint: disable=too-many-arguments
+        command = ("python %s --file %s %s" %
+                   (lustre_workload.WORKLOAD_AGENT_DEST, fname,
+                    workload.wc_agent_options()))
+        output_func = lustre_workload.workload_output
+        stdout_tee = watched_io.watched_io_open(log_fname, output_func,
+                                                stats)
+        delay = LUSTRE_WORKLOAD_RESTART_DELAY
+        ret = 0
+        while mount_point not in self.lh_workload_stopped:
+            start_time = time.time()
+            retval = self.sh_run(command, login_name=login_name,
+                                 timeout=None, stdout_tee=stdout_tee,
+                                 return_stdout=False)
+            if mount_point in self.lh_workload_stopped:
+                break
+            if retval.cr_exit_status != ssh_host.SSH_ERROR_EXIT_STATUS:
+                logging.error("workload agent [%s] on host [%s] exited, "
+                              "ret = [%s], stderr = [%s]",
                               command, self.sh_hostname,
                               retval.cr_exit_status,
-                              retval.cr_stdout,
                               retval.cr_stderr)
-                return -1
-        return 0
+                ret = -1
+                break
+            if time.time() - start_time > LUSTRE_WORKLOAD_RESTART_DELAY_MAX:
+                delay = LUSTRE_WORKLOAD_RESTART_DELAY
+            logging.error("connection to workload agent [%s] on host [%s] "
+                          "failed, stderr = [%s], reconnecting in [%s] "
+                          "seconds",
+                          command, self.sh_hostname,
+                          retval.cr_stderr, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, LUSTRE_WORKLOAD_RESTART_DELAY_MAX)
+        stdout_tee.close()
+        return ret
 
     def lh_start_io(self, service, index, stripe_count=None,
-                    login_name="root"):
+                    login_name="root", workload=None, stats=None,
+                    logdir="log"):
         """
         Start IO with user
         """
+        # pylint: disable=too-many-arguments
+        if workload is None:
+            workload = lustre_workload.WorkloadConfig()
+        if stats is None:
+            stats = lustre_workload.WorkloadStats(None, self.sh_hostname)
+        ret = self.lh_workload_agent_deploy()
+        if ret:
+            return ret
+
         fname = ("%s/%s_%s_%s" % (service.ls_mount_point, login_name,
                                   service.ls_host.sh_hostname, index))
 
@@ -501,13 +898,20 @@ class LustreHost(ssh_host.SSHHost):
                           retval.cr_stderr)
             return -1
 
-        utils.thread_start(self.lh_io_thread, (login_name, fname))
+        log_fname = ("%s/workload_%s_%s.log" %
+                     (logdir, self.sh_hostname, index))
+        self.lh_workload_stopped.discard(service.ls_mount_point)
+        utils.thread_start(self.lh_workload_thread,
+                           (login_name, service.ls_mount_point, fname,
+                            workload, stats, log_fname))
         return 0
 
     def lh_stop_io(self, service):
         """
-        Start IO with user
+        Stop IO with user
         """
+        # The workload threads should not start the killed agents again
+        self.lh_workload_stopped.add(service.ls_mount_point)
         command = ("fuser -km %s" % (service.ls_mount_point))
         retval = self.sh_run(command)
         if (retval.cr_exit_status != 0 and retval.cr_exit_status != 1 and
@@ -521,77 +925,70 @@ class LustreHost(ssh_host.SSHHost):
             return -1
         return 0
 
-    def lh_benchmark(self, service, stripe_count = None):
+    def lh_benchmark_prepare(self, service, fname, ost_index=None):
         """
-        Benchmark the system performance from clients.
+        Create the file for benchmark on the client. If ost_index is None,
+        the file will be striped to all OSTs, otherwise it will only be
+        on the OST.
         """
-        fname = ("%s/%s_benchmark" % (service.ls_mount_point,
-                                  service.ls_host.sh_hostname))
-
-        command = ("rm -f %s" % (fname))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
-
-        stripe = ""
-        if stripe_count is not None:
-            stripe = ("-c %d" % stripe_count)
-
-        command = ("lfs setstripe %s %s" % (stripe, fname))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
+        if ost_index is None:
+            stripe = "-c -1"
+        else:
+            stripe = ("-c 1 -i %d" % ost_index)
 
-        command = ("chmod 777 %s" % (fname))
-        retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
-            logging.error("failed to run command [%s] on host [%s], "
-                          "ret = [%d], stdout = [%s], stderr = [%s]",
-                          command, self.sh_hostname,
-                          retval.cr_exit_status,
-                          retval.cr_stdout,
-                          retval.cr_stderr)
-            return -1
+        commands = [("rm -f %s" % (fname)),
+                    ("lfs setstripe %s %s" % (stripe, fname)),
+                    ("chmod 777 %s" % (fname))]
+        for command in commands:
+            retval = self.sh_run(command)
+            if retval.cr_exit_status != 0:
+                logging.error("failed to run command [%s] on host [%s], "
+                              "ret = [%d], stdout = [%s], stderr = [%s]",
+                              command, self.sh_hostname,
+                              retval.cr_exit_status,
+                              retval.cr_stdout,
+                              retval.cr_stderr)
+                return -1
+        return 0
 
-        command = ("dd if=/dev/zero of=%s bs=1M count=5000 2>&1 | "
-                   "awk '/bytes/ {print $8\" \"$9 }'" % (fname))
+    def lh_benchmark_round(self, service, fname, config):
+        """
+        Write the benchmark file once from this client. Return a tuple of
+        written bytes and elapsed seconds, or None on failure.
+        """
+        # pylint: disable=unused-argument
+        block_count = config.bc_size_mb * 1024 / config.bc_block_size_kb
+        # Measure on the remote host to exclude the SSH overhead, and stop
+        # the writing when the duration is exceeded. The conv=fsync of dd
+        # is skipped if it is killed by timeout, so sync the file before
+        # taking the end time, otherwise the bytes still in the page cache
+        # would be counted.
+        command = ("start=$(date +%%s.%%N); "
+                   "timeout %d dd if=/dev/zero of=%s bs=%dk count=%d "
+                   "conv=fsync 2>/dev/null; "
+                   "sync %s; "
+                   "end=$(date +%%s.%%N); "
+                   "echo $(stat -c %%s %s) $start $end" %
+                   (int(math.ceil(config.bc_duration)), fname,
+                    config.bc_block_size_kb, block_count, fname, fname))
         retval = self.sh_run(command)
-        if retval.cr_exit_status != 0:
+        fields = retval.cr_stdout.split()
+        if retval.cr_exit_status != 0 or len(fields) != 3:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
                           command, self.sh_hostname,
                           retval.cr_exit_status,
                           retval.cr_stdout,
                           retval.cr_stderr)
-            return -1
-        retlist = retval.cr_stdout.split()
-        logging.debug(retlist)
-        #max_iops = 0
-        if retlist[1] == "GB/s" :
-            max_iops = float(retlist[0]) * 1000
-        elif retlist[1] == "MB/s" :
-            max_iops = float(retlist[0])
-        else :
-            logging.error("Unknown dd ouput [%s]!", retval.cr_stdout)
-            max_iops = 0
-
-        ret = self.lh_remove_files(service)
-        if ret:
-            return ret
-
-        return max_iops
+            return None
+        try:
+            written = int(fields[0])
+            elapsed = float(fields[2]) - float(fields[1])
+        except ValueError:
+            logging.error("unexpected benchmark output [%s] on host [%s]",
+                          retval.cr_stdout, self.sh_hostname)
+            return None
+        return written, elapsed
 
     def lh_remove_files(self, service):
         """
@@ -609,12 +1006,17 @@ class LustreHost(ssh_host.SSHHost):
             return -1
         return 0
 
-    def lh_mgs_get_filesystems(self):
+    def lh_mgs_get_filesystems(self, retval=None):
         """
-        This host is a MGS, get the filesystems on this MGS
+        This host is a MGS, get the filesystems on this MGS. If retval is
+        not None, it is the result of the command that has already run.
         """
-        command = "cat /proc/fs/lustre/mgs/MGS/filesystems"
-        retval = self.sh_run(command)
+        command = LUSTRE_MGS_FILESYSTEMS_COMMAND
+        if retval is None:
+            probe = self.lh_probe_host()
+            if probe is None:
+                return []
+            retval = probe["mgs_filesystems"]
         if retval.cr_exit_status != 0:
             logging.error("failed to run command [%s] on host [%s], "
                           "ret = [%d], stdout = [%s], stderr = [%s]",
@@ -645,10 +1047,16 @@ class LustreCluster(object):
         mgs_pattern = (r"^.+ UP mgs MGS MGS .+$")
         logging.debug("mgs_pattern: [%s]", mgs_pattern)
         self.lc_mgs_regular = re.compile(mgs_pattern)
+        # Classify the lines of "lctl dl" in a single pass
+        self.lc_device_classifier = utils.LineClassifier(
+            [(LustreService.TYPE_MDT, mdt_pattern),
+             (LustreService.TYPE_OST, ost_pattern),
+             (LustreService.TYPE_MGS, mgs_pattern)])
         client_pattern = (r"^.+:/%s (?P<mount_point>\S+) lustre .+$" %
                           self.lc_fsname)
-        self.lc_client_regular = re.compile(client_pattern)
+        self.lc_client_regular = re.compile(client_pattern, re.MULTILINE)
         logging.debug("client_pattern: [%s]", client_pattern)
+        # The hosts will be probed lazily, see lc_probe_hosts()
         for hostname in server_hostnames:
             host = LustreHost(self, hostname, identity_file=ssh_identity_file)
             self.lc_hosts.append(host)
@@ -659,6 +1067,33 @@ class LustreCluster(object):
         self.lc_client_number = 0
         self.lc_max_real_iops = 0
         self.lc_max_fake_iops = 0
+        # Key is whether fake I/O, value is ClusterBenchmark
+        self.lc_benchmarks = {}
+        # Key is job ID, value is WorkloadStats
+        self.lc_workload_stats = {}
+        self.lc_capacity = lustre_benchmark.CapacityMap()
+
+    def lc_probe_hosts(self):
+        """
+        Probe the hosts that have not been probed yet concurrently. Return
+        the number of hosts that are not probed successfully.
+        """
+        threads = []
+        for host in self.lc_hosts:
+            if host.lh_probed:
+                continue
+            threads.append(utils.thread_start(host.lh_probe, ()))
+        for thread in threads:
+            thread.join()
+
+        failures = 0
+        for host in self.lc_hosts:
+            if not host.lh_probed:
+                failures += 1
+        if failures:
+            logging.error("failed to probe [%d] hosts of cluster [%s]",
+                          failures, self.lc_fsname)
+        return failures
 
     def lc_detect_services(self):
         """
@@ -666,6 +1101,13 @@ class LustreCluster(object):
         """
         services = {}
         map_service_host = {}
+        # Run the probe script on all the hosts concurrently, the detection
+        # below parses the fresh output in the cache
+        threads = []
+        for host in self.lc_hosts:
+            threads.append(utils.thread_start(host.lh_probe_host, (True,)))
+        for thread in threads:
+            thread.join()
         for host in self.lc_hosts:
             ret = host.lh_detect_services(services, map_service_host)
             if ret:
@@ -855,6 +1297,139 @@ class LustreCluster(object):
             hosts.append(service.ls_host.sh_hostname)
         return 0
 
+    def lc_host_find(self, hostname):
+        """
+        Return the host with the hostname, None if not found. The short
+        hostname is also accepted.
+        """
+        for host in self.lc_hosts:
+            if host.sh_hostname == hostname:
+                return host
+        short_name = hostname.split(".")[0]
+        for host in self.lc_hosts:
+            if host.sh_hostname.split(".")[0] == short_name:
+                return host
+        return None
+
+    def lc_oss_hosts(self):
+        """
+        Return the hosts that run OSTs
+        """
+        hosts = []
+        for service in self.lc_services.values():
+            if service.ls_service_type != LustreService.TYPE_OST:
+                continue
+            if service.ls_host not in hosts:
+                hosts.append(service.ls_host)
+        return hosts
+
+    def lc_client_services(self):
+        """
+        Return the client services
+        """
+        return [service for service in self.lc_services.values()
+                if service.ls_service_type == LustreService.TYPE_CLIENT]
+
+    def lc_ost_services(self):
+        """
+        Return the OST services of each host, a dict whose key is hostname
+        and value is the list of the OST services
+        """
+        osts = {}
+        for service in self.lc_services.values():
+            if service.ls_service_type != LustreService.TYPE_OST:
+                continue
+            hostname = service.ls_host.sh_hostname
+            if hostname not in osts:
+                osts[hostname] = []
+            osts[hostname].append(service)
+        return osts
+
+    def lc_tbf_rules_poll(self):
+        """
+        Read the TBF rules on all OSSes concurrently. Return a dict, key is
+        hostname, value is the TBFRuleDiff since the last poll, None if
+        failed to read.
+        """
+        results = {}
+
+        def poll_thread(host):
+            """
+            Read the TBF rules of a host
+            """
+            results[host.sh_hostname] = host.lh_tbf_rules_read()
+
+        threads = []
+        for host in self.lc_oss_hosts():
+            threads.append(utils.thread_start(poll_thread, (host,)))
+        for thread in threads:
+            thread.join()
+        return results
+
+    def lc_tbf_rules_cleanup(self, keep_names=None, keep_func=None):
+        """
+        Stop the orphaned TBF rules on all OSSes concurrently
+        """
+        results = {}
+
+        def cleanup_thread(host):
+            """
+            Stop the orphaned TBF rules of a host
+            """
+            results[host.sh_hostname] = host.lh_tbf_rules_cleanup(keep_names,
+                                                                  keep_func)
+
+        threads = []
+        for host in self.lc_oss_hosts():
+            threads.append(utils.thread_start(cleanup_thread, (host,)))
+        for thread in threads:
+            thread.join()
+
+        ret = 0
+        for hostname, result in results.iteritems():
+            if result != 0:
+                logging.error("failed to cleanup TBF rules on host [%s]",
+                              hostname)
+                ret = -1
+        return ret
+
+    def lc_start_agents(self, proc_root=None):
+        """
+        Start the resident agents on OSSes concurrently. If proc_root is not
+        None, local agents run against fake proc roots under it instead.
+        """
+        results = {}
+
+        def agent_thread(host):
+            """
+            Start the agent of a host
+            """
+            host_root = None
+            if proc_root is not None:
+                host_root = os.path.join(proc_root, host.sh_hostname)
+            results[host.sh_hostname] = host.lh_agent_start(host_root)
+
+        threads = []
+        for host in self.lc_oss_hosts():
+            threads.append(utils.thread_start(agent_thread, (host,)))
+        for thread in threads:
+            thread.join()
+
+        ret = 0
+        for hostname, result in results.iteritems():
+            if result != 0:
+                logging.error("failed to start agent on host [%s], will use "
+                              "SSH instead", hostname)
+                ret = -1
+        return ret
+
+    def lc_stop_agents(self):
+        """
+        Stop the resident agents on OSSes
+        """
+        for host in self.lc_hosts:
+            host.lh_agent_stop()
+
     def lc_restart_collectd(self):
         """
         Restart collectd
@@ -872,52 +1447,60 @@ class LustreCluster(object):
             hosts.append(service.ls_host.sh_hostname)
         return 0
 
-    def lc_benchmark(self):
+    def lc_benchmark(self, config=None):
         """
         Benchmark the performance: fake I/O and real I/O
         """
-        stripe_count = None
-        if self.lc_ost_number != 0:
-            stripe_count = self.lc_ost_number
+        if config is None:
+            config = lustre_benchmark.BenchmarkConfig()
 
-        for service_name, service in self.lc_services.iteritems():
-            logging.debug("itering on service [%s]", service_name)
-            if service.ls_service_type != LustreService.TYPE_CLIENT:
-                continue
-            ret = self.lc_enable_fifo_for_ost_io()
-            if ret:
-                return -1
+        ret = self.lc_enable_fifo_for_ost_io()
+        if ret:
+            return -1
 
-            ret = self.lc_clear_loc_for_oss()
+        for fake_io in [False, True]:
+            if fake_io:
+                ret = self.lc_enable_fake_io_for_oss()
+            else:
+                ret = self.lc_clear_loc_for_oss()
             if ret:
                 return -1
 
-            ret = service.ls_host.lh_benchmark(service,
-                                              stripe_count=stripe_count)
-            if ret < 0:
-                logging.error("failed to benchmark real I/O on host [%s]",
-                              service.ls_host.sh_hostname)
-                return ret
-            self.lc_max_real_iops = ret
-
-            self.lc_enable_fake_io_for_oss()
-            ret = service.ls_host.lh_benchmark(service,
-                                               stripe_count=stripe_count)
-            if ret < 0:
-                logging.error("failed to benchmark fake I/O on host [%s]",
-                              service.ls_host.sh_hostname)
+            benchmark = lustre_benchmark.ClusterBenchmark(self, config,
+                                                          fake_io)
+            ret = benchmark.cb_run()
+            if ret:
+                logging.error("failed to benchmark cluster [%s], fake I/O "
+                              "[%s]", self.lc_fsname, fake_io)
                 return ret
-            self.lc_max_fake_iops = ret
-            break
-
-        logging.debug("Benchmark performce max_real_iops [%d] max_fake_iops [%d]",
-                      self.lc_max_real_iops, self.lc_max_fake_iops)
+            self.lc_benchmarks[fake_io] = benchmark
+            self.lc_capacity.cm_benchmark_load(benchmark)
+            capacity = benchmark.cb_aggregate.br_capacity()
+            if fake_io:
+                self.lc_max_fake_iops = capacity
+            else:
+                self.lc_max_real_iops = capacity
+
+        logging.info("benchmark performance max_real_iops [%d] "
+                     "max_fake_iops [%d]",
+                     self.lc_max_real_iops, self.lc_max_fake_iops)
+        return 0
 
+    def lc_workload_rate(self, job_id):
+        """
+        Return the bandwidth (MB/s) generated by the workload of a job,
+        None if unknown
+        """
+        stats = self.lc_workload_stats.get(job_id)
+        if stats is None:
+            return None
+        return stats.ws_rate()
 
-    def lc_start_io(self, jobs):
+    def lc_start_io(self, jobs, logdir="log"):
         """
-        Start IO
+        Start IO, one workload agent for each job on a client
         """
+        # pylint: disable=too-many-branches
         count = len(jobs)
         if count > self.lc_client_number:
             logging.error("not enough client [%d] for jobs [%d]",
@@ -955,9 +1538,19 @@ class LustreCluster(object):
             logging.debug("itering on service [%s]", service_name)
             if service.ls_service_type != LustreService.TYPE_CLIENT:
                 continue
+            workload = lustre_workload.workload_config_parse(
+                job.get("workload"))
+            if workload is None:
+                logging.error("invalid workload of job [%s]", job["job_id"])
+                return -1
+            stats = lustre_workload.WorkloadStats(job["job_id"],
+                                                  service.ls_host.sh_hostname)
+            self.lc_workload_stats[job["job_id"]] = stats
             ret = service.ls_host.lh_start_io(service, index,
                                               stripe_count=stripe_count,
-                                              login_name=login_name)
+                                              login_name=login_name,
+                                              workload=workload,
+                                              stats=stats, logdir=logdir)
             if ret:
                 logging.error("failed to start I/O on host [%s]",
                               service.ls_host.sh_hostname)
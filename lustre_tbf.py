@@ -0,0 +1,134 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Model of the TBF rules of ost_io on OSS, parsed from nrs_tbf_rule
+
+The content of nrs_tbf_rule looks like:
+
+regular_requests:
+CPT 0:
+dd_0 {dd.0} 10, ref 0
+default {*} 10000, ref 0
+high_priority_requests:
+CPT 0:
+...
+
+Since Lustre 2.8.54, the rules look like "dd_0 jobid={dd.0} rate=10, ref 0".
+"""
+
+import logging
+
+# local libs
+import utils
+
+# The rule that always exists and should never be stopped
+TBF_DEFAULT_RULE = "default"
+# The section of the requests that the rules of LIME apply to
+TBF_REGULAR_SECTION = "regular_requests"
+
+TBF_LINE_CLASSIFIER = utils.LineClassifier(
+    [("section", r"^(?P<section_name>\w+):$"),
+     ("cpt", r"^CPT (?P<cpt_index>\d+):$"),
+     ("rule", r"^(?P<rule_name>\S+) (?P<expression>.+) (?:rate=)?"
+      r"(?P<rate>\d+), ref -?\d+$")])
+
+
+def tbf_expression_normalize(expression):
+    """
+    Return the job ID expression without "jobid=" and braces, so that the
+    rules of both syntaxes could be compared
+    """
+    expression = expression.strip()
+    if expression.startswith("jobid="):
+        expression = expression[len("jobid="):]
+    if expression.startswith("{") and expression.endswith("}"):
+        expression = expression[1:-1]
+    return expression
+
+
+class TBFRule(object):
+    """
+    A TBF rule on an OSS
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name, expression, rate):
+        self.tr_name = name
+        self.tr_expression = tbf_expression_normalize(expression)
+        self.tr_rate = rate
+
+    def tr_equal(self, rule):
+        """
+        Whether the rule is the same with another one
+        """
+        return (self.tr_name == rule.tr_name and
+                self.tr_expression == rule.tr_expression and
+                self.tr_rate == rule.tr_rate)
+
+
+def tbf_rules_parse(data):
+    """
+    Parse the content of nrs_tbf_rule. Return a dict, key is the rule name,
+    value is TBFRule. Only the first CPT of the regular requests is parsed
+    since all CPTs have the same rules.
+    """
+    rules = {}
+    section = None
+    cpt_index = None
+    first_cpt = None
+    for line_class, match in TBF_LINE_CLASSIFIER.lcl_iterate(data):
+        if line_class == "section":
+            section = match.group("section_name")
+            cpt_index = None
+            first_cpt = None
+        elif line_class == "cpt":
+            cpt_index = match.group("cpt_index")
+            if first_cpt is None:
+                first_cpt = cpt_index
+        elif section == TBF_REGULAR_SECTION and cpt_index == first_cpt:
+            name = match.group("rule_name")
+            rules[name] = TBFRule(name, match.group("expression"),
+                                  int(match.group("rate")))
+    if section is None:
+        logging.error("unexpected content of nrs_tbf_rule: [%s]", data)
+        return None
+    return rules
+
+
+class TBFRuleDiff(object):
+    """
+    The difference between two polls of the TBF rules on an OSS
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.trd_added = []
+        self.trd_removed = []
+        # List of (old_rule, new_rule)
+        self.trd_changed = []
+
+    def trd_empty(self):
+        """
+        Whether nothing changed
+        """
+        return (len(self.trd_added) == 0 and len(self.trd_removed) == 0 and
+                len(self.trd_changed) == 0)
+
+
+def tbf_rules_diff(old_rules, new_rules):
+    """
+    Return the TBFRuleDiff from old rules to new rules, old rules could be
+    None if unknown
+    """
+    if old_rules is None:
+        old_rules = {}
+    diff = TBFRuleDiff()
+    for name, rule in new_rules.iteritems():
+        old_rule = old_rules.get(name)
+        if old_rule is None:
+            diff.trd_added.append(rule)
+        elif not old_rule.tr_equal(rule):
+            diff.trd_changed.append((old_rule, rule))
+    for name, rule in old_rules.iteritems():
+        if name not in new_rules:
+            diff.trd_removed.append(rule)
+    return diff
@@ -0,0 +1,140 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Synthetic workload generated by the agents on Lustre clients
+"""
+
+import logging
+import time
+
+# The agent script, which is sent to the clients
+WORKLOAD_AGENT = "lime_workload_agent.py"
+# Where the agent script is put on the clients
+WORKLOAD_AGENT_DEST = "/tmp/lime_workload_agent.py"
+# The interval that the agent reports the bandwidth
+WORKLOAD_REPORT_INTERVAL = 1
+# A bandwidth report older than this number of intervals is stale
+WORKLOAD_STALE_INTERVALS = 3
+
+PATTERNS = ["sequential", "random"]
+DIRECTIONS = ["read", "write"]
+
+
+class WorkloadConfig(object):
+    """
+    The pattern of a workload. The default pattern is the same with
+    "dd if=/dev/zero bs=1M".
+    """
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, pattern="sequential", direction="write",
+                 block_size_kb=1024, queue_depth=1, rate=0,
+                 file_size_mb=4096, procname="dd"):
+        # pylint: disable=too-many-arguments
+        self.wc_pattern = pattern
+        self.wc_direction = direction
+        self.wc_block_size_kb = block_size_kb
+        self.wc_queue_depth = queue_depth
+        # Target rate in MB/s, 0 means unlimited
+        self.wc_rate = rate
+        self.wc_file_size_mb = file_size_mb
+        # The process name is part of job ID if jobid_var is procname_uid
+        self.wc_procname = procname
+
+    def wc_agent_options(self):
+        """
+        Return the command line options of the agent
+        """
+        return ("--pattern %s --direction %s --block-size %d "
+                "--queue-depth %d --rate %f --file-size %d --procname %s "
+                "--report-interval %d" %
+                (self.wc_pattern, self.wc_direction, self.wc_block_size_kb,
+                 self.wc_queue_depth, self.wc_rate, self.wc_file_size_mb,
+                 self.wc_procname, WORKLOAD_REPORT_INTERVAL))
+
+
+def workload_config_parse(config):
+    """
+    Parse the "workload" section of a job, all the fields are optional.
+    Return None if the config is invalid.
+    """
+    if config is None:
+        config = {}
+    workload = WorkloadConfig()
+    pattern = config.get("pattern", workload.wc_pattern)
+    if pattern not in PATTERNS:
+        logging.error("invalid workload pattern [%s]", pattern)
+        return None
+    direction = config.get("direction", workload.wc_direction)
+    if direction not in DIRECTIONS:
+        logging.error("invalid workload direction [%s]", direction)
+        return None
+    workload.wc_pattern = pattern
+    workload.wc_direction = direction
+    workload.wc_block_size_kb = int(config.get("block_size_kb",
+                                               workload.wc_block_size_kb))
+    workload.wc_queue_depth = int(config.get("queue_depth",
+                                             workload.wc_queue_depth))
+    workload.wc_rate = float(config.get("rate", workload.wc_rate))
+    workload.wc_file_size_mb = int(config.get("file_size_mb",
+                                              workload.wc_file_size_mb))
+    workload.wc_procname = config.get("procname", workload.wc_procname)
+    return workload
+
+
+class WorkloadStats(object):
+    """
+    The bandwidth reported by the agent of a job
+    """
+    def __init__(self, job_id, hostname):
+        self.ws_job_id = job_id
+        self.ws_hostname = hostname
+        # Bytes per second
+        self.ws_bandwidth = None
+        # Operations per second
+        self.ws_ops = None
+        self.ws_time = None
+        # Partial line which has not been parsed
+        self.ws_buffer = ""
+
+    def ws_output(self, data):
+        """
+        Parse the output of the agent
+        """
+        lines = (self.ws_buffer + data).split("\n")
+        self.ws_buffer = lines[-1]
+        for line in lines[:-1]:
+            fields = line.split()
+            if len(fields) != 4 or fields[0] != "bandwidth":
+                logging.debug("unexpected output of workload agent of job "
+                              "[%s] on host [%s]: [%s]", self.ws_job_id,
+                              self.ws_hostname, line)
+                continue
+            try:
+                self.ws_bandwidth = float(fields[2])
+                self.ws_ops = float(fields[3])
+            except ValueError:
+                logging.debug("unexpected output of workload agent of job "
+                              "[%s] on host [%s]: [%s]", self.ws_job_id,
+                              self.ws_hostname, line)
+                continue
+            # Use local time to avoid clock difference between hosts
+            self.ws_time = time.time()
+
+    def ws_rate(self):
+        """
+        Return the achieved bandwidth in MB/s, None if unknown or stale
+        """
+        if self.ws_time is None:
+            return None
+        if (time.time() - self.ws_time >
+                WORKLOAD_REPORT_INTERVAL * WORKLOAD_STALE_INTERVALS):
+            return None
+        return self.ws_bandwidth / 1000000
+
+
+def workload_output(stats, data):
+    """
+    The callback when the agent outputs something
+    """
+    stats.ws_output(data)
@@ -0,0 +1,333 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Rate classes, which bound the number of TBF rules on each OSS
+
+Each watched job has its own TBF rule by default. The NRS TBF of OSS
+matches every RPC against the list of rules, so the matching cost grows
+with the number of jobs. With rate classes, the number of the rules that
+LIME starts on each OSS is bounded by max_rules:
+
+    - The static classes are configured with wildcard expressions, e.g.
+      "dd.* a.*", all the jobs that match one of them share its rule.
+    - The heaviest of the other jobs have their own rules, as many as the
+      rules left allow.
+    - The rest of the jobs share the pool rules, whose expressions list
+      the job IDs, e.g. "job.1 job.2". The expression of a pool is bounded
+      in bytes, so that the command fits in the write buffer of Lustre.
+      When all the pools are full, a new pool takes the rule of the
+      lightest job that has its own rule.
+
+The rate of the rule of a class on a host is the sum of the limits that the
+policies give to its jobs on the host, so the policies split the budget of
+a class between its jobs, but only the sum is enforced. The jobs are
+rebalanced between the own rules and the pools periodically by their rates.
+
+When the jobs of a pool change, its new expression is started under the
+other one of its two rule names before the old rule is stopped, so that the
+jobs always match a rule of the pool. So for a moment, one more rule than
+max_rules is active.
+"""
+
+import fnmatch
+import logging
+import re
+
+# local libs
+import lustre_tbf
+
+# The prefix of the names of the pool rules
+POOL_RULE_PREFIX = "lime_pool"
+# The default maximum number of the rules that LIME starts on each OSS
+RATE_CLASS_MAX_RULES = 64
+# The default number of the pool rules
+RATE_CLASS_POOLS = 4
+# The default interval of rebalancing the jobs between the rules in seconds
+RATE_CLASS_REBALANCE_INTERVAL = 30
+# A pooled job only takes the own rule of another job if its rate is higher
+# by this fraction, so that the jobs don't move back and forth
+RATE_CLASS_HYSTERESIS = 0.2
+# The valid name of a TBF rule
+RULE_NAME_PATTERN = re.compile(r"^\w+$")
+# The maximum length of the expression of a rule in bytes. The command is
+# written to nrs_tbf_rule whose buffer is 4KiB, so this leaves room for the
+# rule name and the rate.
+RATE_CLASS_EXPRESSION_MAX = 3584
+# The suffixes of the two rule names of a pool, which alternate when the
+# jobs of the pool change
+POOL_RULE_SUFFIXES = ("a", "b")
+
+
+class RateClass(object):
+    """
+    A TBF rule shared by a group of jobs
+    """
+    def __init__(self, name, patterns=None):
+        self.rc_name = name
+        # The wildcard patterns of a static class, None for a pool
+        self.rc_patterns = patterns
+        self.rc_job_ids = set()
+        # The name of the rule that is started, None if not started
+        self.rc_rule_name = None
+
+    def rc_match(self, job_id):
+        """
+        Whether the job matches the patterns of the static class
+        """
+        if self.rc_patterns is None:
+            return False
+        for pattern in self.rc_patterns:
+            if fnmatch.fnmatchcase(job_id, pattern):
+                return True
+        return False
+
+    def rc_expression(self, extra_job_ids=None):
+        """
+        Return the job ID expression of the TBF rule, the extra jobs are
+        added to the expression of a pool
+        """
+        if self.rc_patterns is not None:
+            return " ".join(self.rc_patterns)
+        job_ids = self.rc_job_ids
+        if extra_job_ids is not None:
+            job_ids = job_ids | extra_job_ids
+        return " ".join(sorted(job_ids))
+
+    def rc_rule_next_name(self):
+        """
+        Return the name of the rule to start after the jobs changed. A pool
+        alternates between its two rule names, so that the new rule could
+        be started before the old one is stopped.
+        """
+        if self.rc_patterns is not None:
+            return self.rc_name
+        names = ["%s_%s" % (self.rc_name, suffix)
+                 for suffix in POOL_RULE_SUFFIXES]
+        if self.rc_rule_name == names[0]:
+            return names[1]
+        return names[0]
+
+    def rc_fits(self, job_id):
+        """
+        Whether the expression of the pool is still short enough with the
+        job added
+        """
+        size = sum([len(pool_job_id) + 1 for pool_job_id in self.rc_job_ids])
+        return size + len(job_id) <= RATE_CLASS_EXPRESSION_MAX
+
+
+class RateClassMap(object):
+    """
+    The mapping from the jobs to the rate classes
+    """
+    def __init__(self, max_rules, pools, static_classes,
+                 pool_prefix=POOL_RULE_PREFIX):
+        self.rcm_max_rules = max_rules
+        self.rcm_static_classes = static_classes
+        self.rcm_pool_prefix = pool_prefix
+        # The number of the pools that are never removed
+        self.rcm_pools_min = pools
+        self.rcm_pools = []
+        # The number of the jobs that could have their own rules
+        self.rcm_own_slots = max_rules - len(static_classes)
+        for _ in range(pools):
+            self.rcm_pool_add()
+        # Key is job ID, value is the RateClass, None if the job has its
+        # own rule
+        self.rcm_job_classes = {}
+        # The rates of the jobs at the last rebalance, key is job ID
+        self.rcm_job_rates = {}
+
+    def rcm_own_jobs(self):
+        """
+        Return the IDs of the jobs that have their own rules
+        """
+        return [job_id for job_id, rate_class
+                in self.rcm_job_classes.iteritems() if rate_class is None]
+
+    def rcm_pool_add(self):
+        """
+        Add a pool that takes one of the own rules, return the pool
+        """
+        index = 0
+        names = [pool.rc_name for pool in self.rcm_pools]
+        while "%s_%d" % (self.rcm_pool_prefix, index) in names:
+            index += 1
+        pool = RateClass("%s_%d" % (self.rcm_pool_prefix, index))
+        self.rcm_pools.append(pool)
+        self.rcm_own_slots -= 1
+        return pool
+
+    def rcm_pool_discard(self, pool):
+        """
+        Remove an empty pool that was added for the overflow, and give its
+        rule back to the jobs
+        """
+        if (len(pool.rc_job_ids) > 0 or
+                len(self.rcm_pools) <= self.rcm_pools_min or
+                pool not in self.rcm_pools):
+            return
+        self.rcm_pools.remove(pool)
+        self.rcm_own_slots += 1
+
+    def rcm_pool_find(self, job_id, moves, job_rates=None):
+        """
+        Return the lightest pool that the job fits in. If all the pools are
+        full, a new pool is added, and the lightest job that has its own
+        rule is moved to it if there are not enough own rules left. The
+        move is appended to moves. Return None if no pool could be added.
+        """
+        pools = [pool for pool in self.rcm_pools if pool.rc_fits(job_id)]
+        if len(pools) > 0:
+            return self.rcm_pool_lightest(job_rates, pools)
+        if self.rcm_own_slots <= 0:
+            logging.error("all the [%d] pools are full, can't add job [%s]",
+                          len(self.rcm_pools), job_id)
+            return None
+        pool = self.rcm_pool_add()
+        logging.info("all the pools are full, added pool [%s]",
+                     pool.rc_name)
+        owners = [owner for owner in self.rcm_own_jobs() if owner != job_id]
+        if len(owners) > self.rcm_own_slots:
+            if job_rates is None:
+                job_rates = self.rcm_job_rates
+            lightest = min(owners,
+                           key=lambda owner: job_rates.get(owner, 0))
+            pool.rc_job_ids.add(lightest)
+            self.rcm_job_classes[lightest] = pool
+            moves.append((lightest, None, pool))
+        return pool
+
+    def rcm_pool_lightest(self, job_rates=None, pools=None):
+        """
+        Return the pool with the lowest sum of the rates of its jobs, or the
+        fewest jobs if the rates are not given
+        """
+        def pool_load(pool):
+            """
+            Return the load of a pool
+            """
+            if job_rates is None:
+                return len(pool.rc_job_ids)
+            return sum([job_rates.get(job_id, 0)
+                        for job_id in pool.rc_job_ids])
+        if pools is None:
+            pools = self.rcm_pools
+        return min(pools, key=pool_load)
+
+    def rcm_assign(self, job_id, moves):
+        """
+        Put a new job into a class, which is saved in rcm_job_classes, None
+        if the job has its own rule. The other jobs moved to make room are
+        appended to moves. Return 0 on success, -1 if there is no room.
+        """
+        for rate_class in self.rcm_static_classes:
+            if rate_class.rc_match(job_id):
+                break
+        else:
+            rate_class = None
+            if len(self.rcm_own_jobs()) >= self.rcm_own_slots:
+                rate_class = self.rcm_pool_find(job_id, moves)
+                if rate_class is None:
+                    return -1
+        if rate_class is not None:
+            rate_class.rc_job_ids.add(job_id)
+        self.rcm_job_classes[job_id] = rate_class
+        return 0
+
+    def rcm_remove(self, job_id):
+        """
+        Remove a job, return the class it was in, None if it had its own
+        rule
+        """
+        rate_class = self.rcm_job_classes.pop(job_id)
+        self.rcm_job_rates.pop(job_id, None)
+        if rate_class is not None:
+            rate_class.rc_job_ids.discard(job_id)
+            self.rcm_pool_discard(rate_class)
+        return rate_class
+
+    def rcm_rebalance(self, job_rates):
+        """
+        Give the own rules to the heaviest jobs and move the others to the
+        pools. The job_rates is a dict, key is job ID, value is the rate.
+        Return the list of moves, each move is (job ID, old class, new
+        class), a class of None means the own rule of the job.
+        """
+        self.rcm_job_rates = job_rates
+        owners = sorted(self.rcm_own_jobs(),
+                        key=lambda job_id: job_rates.get(job_id, 0))
+        pooled = sorted([job_id for job_id, rate_class
+                         in self.rcm_job_classes.iteritems()
+                         if rate_class in self.rcm_pools],
+                        key=lambda job_id: job_rates.get(job_id, 0),
+                        reverse=True)
+        promoted = []
+        demoted = []
+        while (len(pooled) > 0 and
+               len(owners) + len(promoted) < self.rcm_own_slots):
+            promoted.append(pooled.pop(0))
+        while len(pooled) > 0 and len(owners) > 0:
+            rate = job_rates.get(pooled[0], 0)
+            lightest_rate = job_rates.get(owners[0], 0)
+            if rate <= lightest_rate * (1 + RATE_CLASS_HYSTERESIS):
+                break
+            promoted.append(pooled.pop(0))
+            demoted.append(owners.pop(0))
+
+        # The demoted jobs are put into the pools before the promoted jobs
+        # leave, so that the pools fit both while the rules change
+        moves = []
+        for job_id in demoted:
+            if self.rcm_job_classes[job_id] is not None:
+                # Already moved to a pool added for the overflow
+                continue
+            rate_class = self.rcm_pool_find(job_id, moves, job_rates)
+            if rate_class is None:
+                continue
+            rate_class.rc_job_ids.add(job_id)
+            self.rcm_job_classes[job_id] = rate_class
+            moves.append((job_id, None, rate_class))
+        for job_id in promoted:
+            rate_class = self.rcm_job_classes[job_id]
+            rate_class.rc_job_ids.discard(job_id)
+            self.rcm_job_classes[job_id] = None
+            moves.append((job_id, rate_class, None))
+        for pool in list(self.rcm_pools):
+            self.rcm_pool_discard(pool)
+        return moves
+
+
+def rate_classes_parse(config, pool_prefix=POOL_RULE_PREFIX):
+    """
+    Parse the "rate_classes" section of the configuration, return
+    RateClassMap, None on failure
+    """
+    max_rules = config.get("max_rules", RATE_CLASS_MAX_RULES)
+    pools = config.get("pools", RATE_CLASS_POOLS)
+    static_classes = []
+    for class_config in config.get("classes", []):
+        name = class_config.get("name", "")
+        if not RULE_NAME_PATTERN.match(name):
+            logging.error("invalid name of rate class [%s]", name)
+            return None
+        expression = lustre_tbf.tbf_expression_normalize(
+            class_config.get("expression", ""))
+        if len(expression) == 0:
+            logging.error("no expression of rate class [%s]", name)
+            return None
+        if len(expression) > RATE_CLASS_EXPRESSION_MAX:
+            logging.error("expression of rate class [%s] is longer than "
+                          "[%d] bytes", name, RATE_CLASS_EXPRESSION_MAX)
+            return None
+        static_classes.append(RateClass(name, expression.split()))
+    if pools < 1:
+        logging.error("at least one pool is needed to bound the rules")
+        return None
+    if max_rules - len(static_classes) - pools < 0:
+        logging.error("max_rules [%d] is less than the [%d] static classes "
+                      "and [%d] pools", max_rules, len(static_classes),
+                      pools)
+        return None
+    return RateClassMap(max_rules, pools, static_classes, pool_prefix)
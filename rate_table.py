@@ -0,0 +1,172 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Table of the counters of jobs on OSTs in shared memory
+
+The ingestion workers write the counters that they parse from the posts of
+Collectd, and the controller process reads them. The table is split into
+one region per writer process, so each slot has only one writer and is
+protected by a seqlock: the writer makes the sequence number odd before
+updating the slot and even after, a reader retries if the sequence number
+is odd or changed during the read.
+
+Layout of a region: the number of used slots, followed by the slots. A
+writer appends new slots and never moves or frees them.
+"""
+
+import logging
+import mmap
+import struct
+
+# The number of slots of each region
+RATE_TABLE_SLOTS = 8192
+# The longest fsname that could be saved in the table
+RATE_TABLE_FSNAME_SIZE = 16
+# The longest hostname of the posting host that could be saved in the table
+RATE_TABLE_HOSTNAME_SIZE = 64
+# The longest job ID that could be saved in the table
+RATE_TABLE_JOB_ID_SIZE = 64
+# The longest service ID that could be saved in the table
+RATE_TABLE_SERVICE_ID_SIZE = 16
+# The longest metric name that could be saved in the table
+RATE_TABLE_METRIC_SIZE = 16
+# How many times a reader retries when the slot is being written
+RATE_TABLE_READ_RETRIES = 100
+# The header of a region, the number of used slots
+REGION_HEADER = struct.Struct("=Q")
+# Sequence number, timestamp, value, fsname, hostname, job ID, service ID
+# and metric
+SLOT_SEQUENCE = struct.Struct("=Q")
+SLOT_DATA = struct.Struct("=dd%ds%ds%ds%ds%ds" % (RATE_TABLE_FSNAME_SIZE,
+                                                RATE_TABLE_HOSTNAME_SIZE,
+                                                RATE_TABLE_JOB_ID_SIZE,
+                                                RATE_TABLE_SERVICE_ID_SIZE,
+                                                RATE_TABLE_METRIC_SIZE))
+SLOT_SIZE = SLOT_SEQUENCE.size + SLOT_DATA.size
+
+
+class SharedRateTable(object):
+    """
+    The table in anonymous shared memory, it should be created before the
+    writer processes are forked
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, regions, slots=RATE_TABLE_SLOTS):
+        self.srt_regions = regions
+        self.srt_slots = slots
+        self.srt_region_size = REGION_HEADER.size + slots * SLOT_SIZE
+        self.srt_mmap = mmap.mmap(-1, regions * self.srt_region_size)
+        # The region that this process writes, None if not a writer
+        self.srt_region = None
+        # Key is (fsname, job_id, service_id, metric), value is the slot
+        # index in the region of this writer
+        self.srt_slot_map = {}
+        # Key is (region, slot), value is the sequence number of last read
+        self.srt_seen = {}
+
+    def _srt_slot_offset(self, region, slot):
+        """
+        Return the offset of a slot
+        """
+        return (region * self.srt_region_size + REGION_HEADER.size +
+                slot * SLOT_SIZE)
+
+    def srt_used_slots(self, region):
+        """
+        Return the number of used slots of a region
+        """
+        return REGION_HEADER.unpack_from(self.srt_mmap,
+                                         region * self.srt_region_size)[0]
+
+    def srt_writer_attach(self, region):
+        """
+        Make this process the writer of a region
+        """
+        self.srt_region = region
+        self.srt_slot_map = {}
+
+    def srt_write(self, fsname, hostname, job_id, service_id, metric,
+                  timestamp, value):
+        """
+        Write the counter of a metric of a job on a service of a
+        filesystem, the fsname is empty if unknown. The hostname of the
+        posting host is saved so that a counter without fsname could be
+        routed by it, it is empty if unknown.
+        """
+        # pylint: disable=too-many-arguments
+        fsname = fsname.encode("utf-8")
+        hostname = hostname.encode("utf-8")
+        job_id = job_id.encode("utf-8")
+        service_id = service_id.encode("utf-8")
+        metric = metric.encode("utf-8")
+        if (len(fsname) > RATE_TABLE_FSNAME_SIZE or
+                len(hostname) > RATE_TABLE_HOSTNAME_SIZE or
+                len(job_id) > RATE_TABLE_JOB_ID_SIZE or
+                len(service_id) > RATE_TABLE_SERVICE_ID_SIZE or
+                len(metric) > RATE_TABLE_METRIC_SIZE):
+            logging.error("fsname [%s], hostname [%s], job ID [%s], service "
+                          "ID [%s] or metric [%s] is too long for rate table",
+                          fsname, hostname, job_id, service_id, metric)
+            return -1
+        region = self.srt_region
+        key = (fsname, job_id, service_id, metric)
+        slot = self.srt_slot_map.get(key)
+        new_slot = slot is None
+        if new_slot:
+            slot = self.srt_used_slots(region)
+            if slot >= self.srt_slots:
+                logging.error("rate table region [%d] is full, dropping "
+                              "counter of job [%s] on service [%s]",
+                              region, job_id, service_id)
+                return -1
+            self.srt_slot_map[key] = slot
+        offset = self._srt_slot_offset(region, slot)
+        sequence = SLOT_SEQUENCE.unpack_from(self.srt_mmap, offset)[0]
+        SLOT_SEQUENCE.pack_into(self.srt_mmap, offset, sequence + 1)
+        SLOT_DATA.pack_into(self.srt_mmap, offset + SLOT_SEQUENCE.size,
+                            timestamp, value, fsname, hostname, job_id,
+                            service_id, metric)
+        SLOT_SEQUENCE.pack_into(self.srt_mmap, offset, sequence + 2)
+        if new_slot:
+            # Publish the slot after it is complete
+            REGION_HEADER.pack_into(self.srt_mmap,
+                                    region * self.srt_region_size, slot + 1)
+        return 0
+
+    def srt_read(self, region, slot):
+        """
+        Read a slot consistently. Return (sequence, fsname, hostname,
+        job_id, service_id, metric, timestamp, value), None if the writer
+        keeps updating it.
+        """
+        offset = self._srt_slot_offset(region, slot)
+        for _ in range(RATE_TABLE_READ_RETRIES):
+            sequence = SLOT_SEQUENCE.unpack_from(self.srt_mmap, offset)[0]
+            if sequence % 2 == 1:
+                continue
+            (timestamp, value, fsname, hostname, job_id, service_id,
+             metric) = SLOT_DATA.unpack_from(self.srt_mmap,
+                                             offset + SLOT_SEQUENCE.size)
+            if SLOT_SEQUENCE.unpack_from(self.srt_mmap,
+                                         offset)[0] != sequence:
+                continue
+            return (sequence, fsname.rstrip("\0"), hostname.rstrip("\0"),
+                    job_id.rstrip("\0"), service_id.rstrip("\0"),
+                    metric.rstrip("\0"), timestamp, value)
+        return None
+
+    def srt_updates(self):
+        """
+        Yield (fsname, hostname, job_id, service_id, metric, timestamp,
+        value) of the slots updated since the last call
+        """
+        for region in range(self.srt_regions):
+            for slot in range(self.srt_used_slots(region)):
+                entry = self.srt_read(region, slot)
+                if entry is None:
+                    continue
+                if self.srt_seen.get((region, slot)) == entry[0]:
+                    continue
+                self.srt_seen[(region, slot)] = entry[0]
+                yield entry[1:]
@@ -10,9 +10,12 @@ import logging
 import os
 import glob
 import shutil
+import threading
 
 # local libs
 import utils
+import lime_metrics
+import lime_debug
 
 
 # OS distribution RHEL6/CentOS6
@@ -30,6 +33,10 @@ LONGEST_SIMPLE_COMMAND_TIME = 600
 LONGEST_TIME_YUM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
 # RPM install is slow, so use a larger timeout value
 LONGEST_TIME_RPM_INSTALL = LONGEST_SIMPLE_COMMAND_TIME * 2
+# The TTL of cached results which only change after reboot or RPM change
+CACHE_TTL_STATIC = 3600
+# The exit status of ssh when connection fails, the result is not cached
+SSH_ERROR_EXIT_STATUS = 255
 
 
 def sh_escape(command):
@@ -95,6 +102,19 @@ def ssh_command(hostname, command, login_name="root", identity_file=None):
     return full_command
 
 
+def ssh_argv(hostname, command, login_name="root", identity_file=None):
+    """
+    Return the argument list of the ssh command on a remote host, which
+    could be executed without a local shell
+    """
+    argv = ["ssh", hostname, "-l", login_name, "-o",
+            "StrictHostKeyChecking=no"]
+    if identity_file is not None:
+        argv += ["-i", identity_file]
+    argv.append(command)
+    return argv
+
+
 def ssh_run(hostname, command, login_name="root", timeout=None,
             stdout_tee=None, stderr_tee=None, stdin=None,
             return_stdout=True, return_stderr=True,
@@ -103,23 +123,42 @@ def ssh_run(hostname, command, login_name="root", timeout=None,
     Use ssh to run command on a remote host
     """
     # pylint: disable=too-many-arguments
-    full_command = ssh_command(hostname, command, login_name, identity_file)
+    full_command = ssh_argv(hostname, command, login_name, identity_file)
     return utils.run(full_command, timeout=timeout, stdout_tee=stdout_tee,
                      stderr_tee=stderr_tee, stdin=stdin,
                      return_stdout=return_stdout, return_stderr=return_stderr,
                      quit_func=quit_func)
 
 
+class CacheEntry(object):
+    """
+    The cached result of a command on a host
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.ce_result = None
+        self.ce_expire_time = None
+        # Set when the command in flight finishes
+        self.ce_event = threading.Event()
+
+
 class SSHHost(object):
     """
     Each SSH host has an object of SSHHost
     """
-    # pylint: disable=too-many-public-methods
+    # pylint: disable=too-many-public-methods,too-many-instance-attributes
     def __init__(self, hostname, identity_file=None):
         self.sh_hostname = hostname
         self.sh_never_up = True
         self.sh_distro_cache = None
         self.sh_identity_file = identity_file
+        # Key is (command, login_name), value is CacheEntry
+        self.sh_cache = {}
+        self.sh_cache_lock = threading.Lock()
+        self.sh_cache_hits = 0
+        self.sh_cache_misses = 0
+        # The callers that waited for the same command in flight
+        self.sh_cache_shared = 0
 
     def sh_is_up(self, timeout=60):
         """
@@ -344,6 +383,10 @@ class SSHHost(object):
                 ret = self.sh_umount(device)
                 if ret:
                     break
+        # The cached Lustre probes are stale after the umount, even if only
+        # some of the file systems were umounted. Invalidating before the
+        # umount would let a concurrent probe cache the mounted state again.
+        self.sh_cache_invalidate()
         return ret
 
     def sh_get_uptime(self):
@@ -707,12 +750,20 @@ class SSHHost(object):
         Run a command on the host
         """
         # pylint: disable=too-many-arguments
+        operation = lime_metrics.caller_operation()
+        start = time.time()
         ret = ssh_run(self.sh_hostname, command, login_name=login_name,
                       timeout=timeout,
                       stdout_tee=stdout_tee, stderr_tee=stderr_tee,
                       stdin=stdin, return_stdout=return_stdout,
                       return_stderr=return_stderr, quit_func=quit_func,
                       identity_file=self.sh_identity_file)
+        duration = lime_debug.TRACER.st_span(operation, "ssh", start,
+                                             {"host": self.sh_hostname,
+                                              "command": command})
+        lime_metrics.SSH_COMMAND_SECONDS.mh_observe(duration,
+                                                    (self.sh_hostname,
+                                                     operation))
         if not silent:
             logging.debug("ran [%s] on host [%s], ret = [%d], stdout = [%s], "
                           "stderr = [%s]",
@@ -720,11 +771,114 @@ class SSHHost(object):
                           ret.cr_stdout, ret.cr_stderr)
         return ret
 
+    def sh_run_cached(self, command, ttl, login_name="root",
+                      timeout=LONGEST_SIMPLE_COMMAND_TIME):
+        """
+        Run a command whose result seldom changes, e.g. reading a version.
+        The result is reused for ttl seconds. Concurrent callers of the same
+        command share one run. A result of ssh failure or timeout is not
+        cached.
+        """
+        key = (command, login_name)
+        self.sh_cache_lock.acquire()
+        entry = self.sh_cache.get(key)
+        if entry is not None:
+            if entry.ce_result is None:
+                self.sh_cache_shared += 1
+                self.sh_cache_lock.release()
+                entry.ce_event.wait()
+                if entry.ce_result is not None:
+                    return entry.ce_result
+                # The run failed, run it again
+                return self.sh_run(command, login_name=login_name,
+                                   timeout=timeout)
+            if time.time() < entry.ce_expire_time:
+                self.sh_cache_hits += 1
+                self.sh_cache_lock.release()
+                return entry.ce_result
+        self.sh_cache_misses += 1
+        entry = CacheEntry()
+        self.sh_cache[key] = entry
+        self.sh_cache_lock.release()
+
+        retval = None
+        try:
+            retval = self.sh_run(command, login_name=login_name,
+                                 timeout=timeout)
+        finally:
+            # Even if sh_run raised, the entry is dropped and the waiting
+            # callers are woken up, otherwise they would wait forever
+            self.sh_cache_lock.acquire()
+            if (retval is not None and retval.cr_exit_status >= 0 and
+                    retval.cr_exit_status != SSH_ERROR_EXIT_STATUS and
+                    self.sh_cache.get(key) is entry):
+                entry.ce_result = retval
+                entry.ce_expire_time = time.time() + ttl
+            elif self.sh_cache.get(key) is entry:
+                del self.sh_cache[key]
+            self.sh_cache_lock.release()
+            entry.ce_event.set()
+        return retval
+
+    def sh_cache_invalidate(self, command=None):
+        """
+        Drop the cached result of a command, or all the cached results if
+        command is None, e.g. after the modules are reloaded
+        """
+        self.sh_cache_lock.acquire()
+        if command is None:
+            self.sh_cache = {}
+        else:
+            for key in self.sh_cache.keys():
+                if key[0] == command:
+                    del self.sh_cache[key]
+        self.sh_cache_lock.release()
+
+    def sh_cache_stats(self):
+        """
+        Return the statistics of the result cache
+        """
+        return {"hits": self.sh_cache_hits,
+                "misses": self.sh_cache_misses,
+                "shared": self.sh_cache_shared,
+                "entries": len(self.sh_cache)}
+
+    def sh_run_async(self, command, silent=False, login_name="root",
+                     timeout=LONGEST_SIMPLE_COMMAND_TIME, stdin=None):
+        """
+        Run a command on the host asynchronously, return a CommandFuture
+        """
+        # pylint: disable=too-many-arguments
+        full_command = ssh_argv(self.sh_hostname, command,
+                                login_name=login_name,
+                                identity_file=self.sh_identity_file)
+        job = utils.CommandJob(full_command, timeout=timeout, stdin=stdin)
+        operation = lime_metrics.caller_operation()
+        start = time.time()
+
+        def finish_func(ret):
+            """
+            Log the result, the latency includes the time waiting for a slot
+            to run
+            """
+            duration = lime_debug.TRACER.st_span(operation, "ssh", start,
+                                                 {"host": self.sh_hostname,
+                                                  "command": command})
+            lime_metrics.SSH_COMMAND_SECONDS.mh_observe(duration,
+                                                        (self.sh_hostname,
+                                                         operation))
+            if not silent:
+                logging.debug("ran [%s] on host [%s], ret = [%d], "
+                              "stdout = [%s], stderr = [%s]",
+                              command, self.sh_hostname, ret.cr_exit_status,
+                              ret.cr_stdout, ret.cr_stderr)
+        return utils.command_job_async(job, finish_func=finish_func)
+
     def sh_get_kernel_ver(self):
         """
         Get the kernel version of the remote machine
         """
-        ret = self.sh_run("/bin/uname -r")
+        ret = self.sh_run_cached("/bin/uname -r", CACHE_TTL_STATIC)
         if ret.cr_exit_status != 0:
             return None
         return ret.cr_stdout.rstrip()
@@ -740,7 +894,7 @@ class SSHHost(object):
 
         rpm_name = "kernel-" + kernel_version
         command = "rpm -qi %s" % rpm_name
-        retval = self.sh_run(command)
+        retval = self.sh_run_cached(command, CACHE_TTL_STATIC)
         has_rpm = True
         if retval.cr_exit_status:
             has_rpm = False
@@ -757,6 +911,8 @@ class SSHHost(object):
                 logging.info("uninstalling RPM [%s] on host [%s]",
                              rpm, self.sh_hostname)
                 ret = self.sh_run("rpm -e %s --nodeps %s" % (rpm, option))
+                # The cached RPM queries are stale after the uninstall
+                self.sh_cache_invalidate()
                 if ret.cr_exit_status != 0:
                     logging.error("failed to uninstall RPM [%s] on host [%s], "
                                   "ret = %d, stdout = [%s], stderr = [%s]",
@@ -801,7 +957,8 @@ class SSHHost(object):
         Return the command job on a host
         """
         # pylint: disable=too-many-arguments
-        full_command = ssh_command(self.sh_hostname, command)
+        full_command = ssh_argv(self.sh_hostname, command,
+                                identity_file=self.sh_identity_file)
         job = utils.CommandJob(full_command, timeout, stdout_tee, stderr_tee,
                                stdin)
         return job
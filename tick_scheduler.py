@@ -0,0 +1,173 @@
+# Copyright (c) 2017 DataDirect Networks, Inc.
+# All Rights Reserved.
+# Author: lixi@ddn.com
+"""
+Scheduler of the ticks that compute the rates and tune the limits
+
+The ticks run on a fixed-rate clock aligned with the intervals of Collectd:
+the tick of interval k is due at the end of the interval, (k + 1) *
+interval, which never drifts no matter how long the ticks take. The
+scheduler tracks which services have reported a datapoint of each interval,
+the watermark. The tick fires as soon as all the services expected in the
+interval have reported, so the rates are computed from fresh datapoints of
+every OST, or when the deadline after the end of the interval passes. The
+services expected in an interval are the ones that reported in the former
+interval, so a lost service only delays one tick.
+"""
+
+import threading
+import time
+
+# The deadline of a tick after the end of its interval, in intervals
+TICK_DEADLINE = 0.5
+# The tick fired because all the expected services reported
+FIRE_WATERMARK = "watermark"
+# The tick fired because the deadline passed
+FIRE_DEADLINE = "deadline"
+
+
+class TickScheduler(object):
+    """
+    Decide when the tick of each interval fires
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, interval, deadline=TICK_DEADLINE):
+        self.tks_interval = interval
+        self.tks_deadline = deadline
+        # The index of the interval that the next tick is for
+        self.tks_index = int(time.time() // interval)
+        # Key is the index of an interval, value is the set of services
+        # that reported a datapoint of the interval
+        self.tks_reported = {}
+        self.tks_event = threading.Event()
+        self.tks_ticks = 0
+        self.tks_watermark_ticks = 0
+        self.tks_deadline_ticks = 0
+        # The ticks that started after the deadline of the next tick
+        self.tks_overruns = 0
+        # The intervals that got no tick because of the overruns
+        self.tks_skipped = 0
+        # Seconds between the end of the interval and the firing
+        self.tks_lateness_max = 0.0
+        self.tks_lateness_sum = 0.0
+
+    def tks_interval_set(self, interval, deadline=TICK_DEADLINE):
+        """
+        Change the interval, the ticks restart from the current interval
+        """
+        self.tks_interval = interval
+        self.tks_deadline = deadline
+        self.tks_index = self.tks_interval_index(time.time())
+        self.tks_reported = {}
+
+    def tks_interval_index(self, timestamp):
+        """
+        Return the index of the interval that the time is in
+        """
+        return int(timestamp // self.tks_interval)
+
+    def tks_expected(self, index):
+        """
+        Return the services expected to report in the interval
+        """
+        return self.tks_reported.get(index - 1, set())
+
+    def tks_complete(self, index):
+        """
+        Whether all the expected services reported in the interval
+        """
+        expected = self.tks_expected(index)
+        if len(expected) == 0:
+            return False
+        reported = self.tks_reported.get(index, set())
+        return expected.issubset(reported)
+
+    def tks_report(self, service_id, timestamp):
+        """
+        A datapoint of a service is received. The datapoints of the
+        intervals whose ticks have fired only count as the expectation.
+        """
+        index = self.tks_interval_index(timestamp)
+        if index < self.tks_index - 1:
+            return
+        reported = self.tks_reported.get(index)
+        if reported is None:
+            reported = set()
+            self.tks_reported[index] = reported
+        if service_id in reported:
+            return
+        reported.add(service_id)
+        if index == self.tks_index and self.tks_complete(index):
+            self.tks_event.set()
+
+    def tks_wait(self, poll_func=None, poll_interval=None):
+        """
+        Wait until the next tick should fire. If poll_func is given, it is
+        called every poll interval while waiting, e.g. to read the
+        datapoints from shared memory. Return (index, reason, lateness).
+        """
+        index = self.tks_index
+        due_time = (index + 1) * self.tks_interval
+        deadline = due_time + self.tks_deadline * self.tks_interval
+        while True:
+            if poll_func is not None:
+                poll_func()
+            now = time.time()
+            if self.tks_complete(index):
+                reason = FIRE_WATERMARK
+                break
+            if now >= deadline:
+                reason = FIRE_DEADLINE
+                break
+            timeout = deadline - now
+            if poll_func is not None:
+                timeout = min(timeout, poll_interval)
+            self.tks_event.wait(timeout)
+            self.tks_event.clear()
+
+        lateness = max(now - due_time, 0.0)
+        self.tks_ticks += 1
+        if reason == FIRE_WATERMARK:
+            self.tks_watermark_ticks += 1
+        else:
+            self.tks_deadline_ticks += 1
+        self.tks_lateness_max = max(self.tks_lateness_max, lateness)
+        self.tks_lateness_sum += lateness
+        return index, reason, lateness
+
+    def tks_done(self, index):
+        """
+        The tick of the interval finished. If it ran past the deadline of
+        the next tick, the intervals that can't be caught up are skipped.
+        Return the number of skipped intervals.
+        """
+        next_index = index + 1
+        latest = self.tks_interval_index(time.time() -
+                                         self.tks_deadline *
+                                         self.tks_interval) - 1
+        skipped = 0
+        if latest > next_index:
+            skipped = latest - next_index
+            self.tks_overruns += 1
+            self.tks_skipped += skipped
+            next_index = latest
+        self.tks_index = next_index
+        for old_index in self.tks_reported.keys():
+            if old_index < next_index - 1:
+                del self.tks_reported[old_index]
+        return skipped
+
+    def tks_stats(self):
+        """
+        Return the statistics of the ticks
+        """
+        lateness_average = 0.0
+        if self.tks_ticks > 0:
+            lateness_average = self.tks_lateness_sum / self.tks_ticks
+        return {"ticks": self.tks_ticks,
+                "watermark": self.tks_watermark_ticks,
+                "deadline": self.tks_deadline_ticks,
+                "overruns": self.tks_overruns,
+                "skipped": self.tks_skipped,
+                "lateness_max": self.tks_lateness_max,
+                "lateness_average": lateness_average}
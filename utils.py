@@ -6,11 +6,15 @@ Misc utility library
 """
 
 import os
+import re
+import sys
+import atexit
+import errno
+import collections
 import time
 import signal
 import subprocess
 import StringIO
-import select
 import logging
 import logging.handlers
 import flask
@@ -18,10 +22,43 @@ import datetime
 import dateutil.tz
 import threading
 import traceback
+import gevent
+import gevent.lock
 from gevent import monkey
+from gevent import os as gevent_os
 
 monkey.patch_all()
 
+# The size of each read from the pipes of a command
+COMMAND_READ_SIZE = 65536
+# The interval of checking the quit function of a command
+COMMAND_QUIT_CHECK_INTERVAL = 1
+# How long to wait for the output left in the pipes after a command exits
+COMMAND_DRAIN_TIMEOUT = 0.1
+# The maximum number of asynchronous commands running at the same time,
+# so as to avoid fork storms
+MAX_ASYNC_COMMANDS = 64
+ASYNC_COMMAND_SEMAPHORE = gevent.lock.BoundedSemaphore(MAX_ASYNC_COMMANDS)
+# The largest size of a log file before it is rotated
+LOG_MAX_BYTES = 100 * 1024 * 1024
+# The number of rotated files kept for each log file
+LOG_BACKUP_COUNT = 5
+# The most log records waiting to be written, newer records are dropped
+LOG_QUEUE_SIZE = 100000
+# The interval that the log writer checks the queue when it is empty
+LOG_WRITER_INTERVAL = 0.05
+# The shortest interval between two messages of the same rate limited log
+LOG_RATE_LIMIT_INTERVAL = 10
+# Key is (filename, line number) of a rate limited log, value is
+# [time of the last message, number of suppressed messages]
+LOG_RATE_LIMITS = {}
+# A command with any of these characters needs a shell to run
+SHELL_SPECIAL_CHARACTERS = "|&;<>()$`\\\"'*?[]{}~#!=\n"
+# The builtin commands of shell that can not be executed directly
+SHELL_BUILTIN_COMMANDS = ["cd", "export", "source", ".", "exec", "ulimit",
+                          "set", "unset", "alias", "eval", "exit", "umask",
+                          "wait", "read", "trap", "shift", "type", "test"]
+
 
 def read_one_line(filename):
     """
@@ -70,6 +107,23 @@ def signal_pid(pid, sig):
     return False
 
 
+def command_argv(command):
+    """
+    Return the argument list to execute the command directly if the command
+    needs no feature of shell, otherwise return None. A list is the
+    argument list already.
+    """
+    if isinstance(command, list):
+        return command
+    for char in command:
+        if char in SHELL_SPECIAL_CHARACTERS:
+            return None
+    argv = command.split()
+    if len(argv) == 0 or argv[0] in SHELL_BUILTIN_COMMANDS:
+        return None
+    return argv
+
+
 def nuke_subprocess(subproc):
     """
     Kill the subprocess
@@ -118,6 +172,12 @@ class CommandJob(object):
                  stderr_tee=None, stdin=None, return_stdout=True,
                  return_stderr=True, quit_func=None):
         # pylint: disable=too-many-arguments
+        # The command could be a string or a list of arguments. The shell
+        # is skipped if no shell feature is needed, which saves a fork and
+        # exec for each command.
+        self.cj_argv = command_argv(command)
+        if isinstance(command, list):
+            command = " ".join(command)
         self.cj_command = command
         self.cj_result = CommandResult()
         self.cj_timeout = timeout
@@ -138,6 +198,7 @@ class CommandJob(object):
             self.cj_stderr_file = StringIO.StringIO()
         self.cj_started = False
         self.cj_killed = False
+        self.cj_cancelled = False
         self.cj_start_time = None
         self.cj_stop_time = None
         self.cj_max_stop_time = None
@@ -156,11 +217,29 @@ class CommandJob(object):
         self.cj_start_time = time.time()
         if self.cj_timeout:
             self.cj_max_stop_time = self.cj_timeout + self.cj_start_time
-        self.cj_subprocess = subprocess.Popen(self.cj_command,
-                                              stdout=subprocess.PIPE,
-                                              stderr=subprocess.PIPE,
-                                              shell=True,
-                                              stdin=self.cj_stdin)
+        if self.cj_argv is None:
+            args = self.cj_command
+        else:
+            args = self.cj_argv
+        # Python3 closes all fds in the child by default, which is slow and
+        # prevents the fast spawn path, none of the fds matters here
+        try:
+            self.cj_subprocess = subprocess.Popen(args,
+                                                  stdout=subprocess.PIPE,
+                                                  stderr=subprocess.PIPE,
+                                                  shell=self.cj_argv is None,
+                                                  close_fds=False,
+                                                  stdin=self.cj_stdin)
+        except OSError as error:
+            self.cj_result.cr_stderr = str(error)
+            logging.error("failed to start command [%s]: %s",
+                          self.cj_command, error)
+            return -1
+        # The pipes are waited by the hub of gevent, never block on them
+        gevent_os.make_nonblocking(self.cj_subprocess.stdout.fileno())
+        gevent_os.make_nonblocking(self.cj_subprocess.stderr.fileno())
+        if self.cj_string_stdin is not None:
+            gevent_os.make_nonblocking(self.cj_subprocess.stdin.fileno())
         return 0
 
     def cj_run_stop(self):
@@ -213,6 +292,7 @@ class CommandJob(object):
                           self.cj_result.cr_exit_status,
                           self.cj_result.cr_stdout,
                           self.cj_result.cr_stderr)
+            return self.cj_result
 
         self.cj_wait_for_command()
         self.cj_post_exit()
@@ -220,7 +300,8 @@ class CommandJob(object):
 
     def cj_process_output(self, is_stdout=True, final_read=False):
         """
-        Process the stdout or stderr
+        Process the stdout or stderr, return the length of the data read.
+        A zero length means EOF, unless final_read is set.
         """
         buf = None
         if is_stdout:
@@ -235,20 +316,62 @@ class CommandJob(object):
             tee = self.cj_stderr_tee
 
         if final_read:
-            # read in all the data we can from pipe and then stop
+            # read in all the data left in the pipe without waiting
             data = []
-            while select.select([pipe], [], [], 0)[0]:
-                data.append(os.read(pipe.fileno(), 1024))
-                if len(data[-1]) == 0:
+            while True:
+                try:
+                    chunk = os.read(pipe.fileno(), COMMAND_READ_SIZE)
+                except OSError as error:
+                    if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if len(chunk) == 0:
                     break
+                data.append(chunk)
             data = "".join(data)
         else:
-            # perform a single read
-            data = os.read(pipe.fileno(), 1024)
+            # perform a single read, the greenlet sleeps in the hub until
+            # the pipe is readable
+            data = gevent_os.nb_read(pipe.fileno(), COMMAND_READ_SIZE)
+        if len(data) == 0:
+            return 0
         if buf is not None:
             buf.write(data)
         if tee:
             tee.write(data)
+        return len(data)
+
+    def cj_pipe_reader(self, is_stdout):
+        """
+        Read from stdout or stderr until EOF
+        """
+        while self.cj_process_output(is_stdout):
+            pass
+
+    def cj_stdin_writer(self):
+        """
+        Write the input string to stdin and close it
+        """
+        stdin = self.cj_subprocess.stdin
+        try:
+            while self.cj_string_stdin:
+                written = gevent_os.nb_write(stdin.fileno(),
+                                             self.cj_string_stdin)
+                self.cj_string_stdin = self.cj_string_stdin[written:]
+        except OSError as error:
+            # The command might exit without reading all the input
+            if error.errno != errno.EPIPE:
+                raise
+        stdin.close()
+
+    def cj_cancel(self):
+        """
+        Cancel the job that is running by cj_run() in another greenlet, the
+        cj_run() will return after the command is killed
+        """
+        self.cj_cancelled = True
+        if self.cj_subprocess is not None:
+            nuke_subprocess(self.cj_subprocess)
 
     def cj_kill(self):
         """
@@ -262,60 +385,37 @@ class CommandJob(object):
         """
         Wait until the command exits
         """
-        read_list = []
-        write_list = []
-        reverse_dict = {}
-
-        read_list.append(self.cj_subprocess.stdout)
-        read_list.append(self.cj_subprocess.stderr)
-        reverse_dict[self.cj_subprocess.stdout] = True
-        reverse_dict[self.cj_subprocess.stderr] = False
-
+        # Each pipe has a greenlet which is woken up by the hub of gevent
+        # when the pipe is ready, so no polling is needed
+        greenlets = [gevent.spawn(self.cj_pipe_reader, True),
+                     gevent.spawn(self.cj_pipe_reader, False)]
         if self.cj_string_stdin is not None:
-            write_list.append(self.cj_subprocess.stdin)
+            greenlets.append(gevent.spawn(self.cj_stdin_writer))
 
-        if self.cj_timeout:
-            time_left = self.cj_max_stop_time - time.time()
-        else:
-            time_left = None  # so that select never times out
-
-        while not self.cj_timeout or time_left > 0:
-            # select will return when we may write to stdin or when there is
-            # stdout/stderr output we can read (including when it is
-            # EOF, that is the process has terminated).
-            # To check for processes which terminate without producing any
-            # output, a 1 second timeout is used in select.
-            read_ready, write_ready, _ = select.select(read_list, write_list,
-                                                       [], 1)
-
-            # os.read() has to be used instead of
-            # subproc.stdout.read() which will otherwise block
-            for file_obj in read_ready:
-                is_stdout = reverse_dict[file_obj]
-                self.cj_process_output(is_stdout)
-
-            for file_obj in write_ready:
-                # we can write PIPE_BUF bytes without blocking
-                # POSIX requires PIPE_BUF is >= 512
-                file_obj.write(self.cj_string_stdin[:512])
-                self.cj_string_stdin = self.cj_string_stdin[512:]
-                # no more input data, close stdin, remove it from the select
-                # set
-                if not self.cj_string_stdin:
-                    file_obj.close()
-                    write_list.remove(file_obj)
-
-            self.cj_result.cr_exit_status = self.cj_subprocess.poll()
-            if self.cj_result.cr_exit_status is not None:
+        while True:
+            timeout = None
+            if self.cj_timeout:
+                timeout = max(self.cj_max_stop_time - time.time(), 0)
+            if self.cj_quit_func is not None:
+                if timeout is None or timeout > COMMAND_QUIT_CHECK_INTERVAL:
+                    timeout = COMMAND_QUIT_CHECK_INTERVAL
+
+            # The exit is notified by the child watcher of gevent
+            exit_status = self.cj_subprocess.wait(timeout=timeout)
+            if exit_status is not None:
+                self.cj_result.cr_exit_status = exit_status
+                gevent.joinall(greenlets, timeout=COMMAND_DRAIN_TIMEOUT)
+                gevent.killall(greenlets)
                 return
 
-            if self.cj_timeout:
-                time_left = self.cj_max_stop_time - time.time()
+            if self.cj_timeout and time.time() >= self.cj_max_stop_time:
+                break
 
             if self.cj_quit_func is not None and self.cj_quit_func():
                 break
 
         # Kill process if timeout
+        gevent.killall(greenlets)
         self.cj_kill()
         return
 
@@ -333,42 +433,357 @@ def run(command, timeout=None, stdout_tee=None, stderr_tee=None, stdin=None,
     return job.cj_run()
 
 
-def configure_logging(resultsdir):
+class CommandFuture(object):
+    """
+    The result of a command job that runs asynchronously
+    """
+    def __init__(self, job, finish_func=None):
+        self.cf_job = job
+        self.cf_finish_func = finish_func
+        self.cf_greenlet = gevent.spawn(self.cf_run)
+
+    def cf_run(self):
+        """
+        Run the command when the concurrency limit allows
+        """
+        # pylint: disable=broad-except
+        ASYNC_COMMAND_SEMAPHORE.acquire()
+        try:
+            if self.cf_job.cj_cancelled:
+                self.cf_job.cj_result.cr_exit_status = -1
+                result = self.cf_job.cj_result
+            else:
+                result = self.cf_job.cj_run()
+        except Exception as error:
+            # The callers of gather() expect a result for every command
+            logging.error("failed to run command [%s]: %s",
+                          self.cf_job.cj_command, error)
+            result = self.cf_job.cj_result
+            result.cr_exit_status = -1
+            result.cr_stderr = str(error)
+        finally:
+            ASYNC_COMMAND_SEMAPHORE.release()
+        if self.cf_finish_func is not None:
+            self.cf_finish_func(result)
+        return result
+
+    def cf_done(self):
+        """
+        Whether the command has finished
+        """
+        return self.cf_greenlet.ready()
+
+    def cf_result(self, timeout=None):
+        """
+        Wait until the command finishes and return the result. If timeout
+        expires, the command will be killed.
+        """
+        self.cf_greenlet.join(timeout=timeout)
+        if not self.cf_greenlet.ready():
+            logging.error("command [%s] timeout, killing it",
+                          self.cf_job.cj_command)
+            self.cf_job.cj_cancel()
+            self.cf_greenlet.join()
+        return self.cf_greenlet.value
+
+
+def command_job_async(job, finish_func=None):
     """
-    Configure the logging levels
+    Run a command job asynchronously, finish_func will be called with the
+    result when the command finishes
     """
+    return CommandFuture(job, finish_func=finish_func)
+
+
+def run_async(command, timeout=None, stdout_tee=None, stderr_tee=None,
+              stdin=None, return_stdout=True, return_stderr=True,
+              quit_func=None):
+    """
+    Run a command asynchronously, return a CommandFuture
+    """
+    # pylint: disable=too-many-arguments
+    job = CommandJob(command, timeout=timeout, stdout_tee=stdout_tee,
+                     stderr_tee=stderr_tee, stdin=stdin,
+                     return_stdout=return_stdout, return_stderr=return_stderr,
+                     quit_func=quit_func)
+    return command_job_async(job)
+
+
+def gather(futures, timeout=None):
+    """
+    Wait for the futures and return the list of results in the same order.
+    The commands that are not finished when timeout expires will be
+    killed.
+    """
+    gevent.joinall([future.cf_greenlet for future in futures],
+                   timeout=timeout)
+    return [future.cf_result(timeout=0) for future in futures]
+
+
+class LineClassifier(object):
+    """
+    Classify the lines of a text, e.g. a file under /proc, in a single pass.
+    The patterns of the classes are combined into one alternation regular
+    expression, the class of a matched line is the name of the group that
+    encloses the matched alternative. The named groups in the patterns
+    should be unique among all the patterns.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, patterns):
+        # List of (class_name, pattern), a pattern matches a whole line
+        self.lcl_patterns = patterns
+        alternatives = []
+        for name, pattern in patterns:
+            if pattern.startswith("^"):
+                pattern = pattern[1:]
+            if pattern.endswith("$"):
+                pattern = pattern[:-1]
+            alternatives.append("(?P<%s>%s)" % (name, pattern))
+        self.lcl_regular = re.compile("^(?:%s)$" % "|".join(alternatives),
+                                      re.MULTILINE)
+
+    def lcl_classify(self, line):
+        """
+        Return the class name and the match of a line, (None, None) if the
+        line matches none of the patterns
+        """
+        match = self.lcl_regular.match(line)
+        if match is None:
+            return None, None
+        return match.lastgroup, match
+
+    def lcl_iterate(self, text):
+        """
+        Iterate on the matched lines of a text, yield (class_name, match).
+        The lines that match none of the patterns are skipped.
+        """
+        for match in self.lcl_regular.finditer(text):
+            yield match.lastgroup, match
+
+
+class LogQueueHandler(logging.Handler):
+    """
+    Put the log records into a queue, and write them to the handlers in a
+    real OS thread, so that the formatting and the file I/O are off the
+    greenlets. The level of each module could be set separately, the
+    records of other modules use the default level.
+    """
+    def __init__(self, handlers, default_level=logging.DEBUG,
+                 module_levels=None):
+        super(LogQueueHandler, self).__init__()
+        self.lqh_handlers = handlers
+        self.lqh_default_level = default_level
+        if module_levels is None:
+            module_levels = {}
+        self.lqh_module_levels = module_levels
+        # Appending and popping a deque are atomic between OS threads
+        self.lqh_queue = collections.deque()
+        self.lqh_dropped = 0
+        self.lqh_running = False
+
+    def lqh_level(self):
+        """
+        Return the lowest level of any module
+        """
+        return min([self.lqh_default_level] +
+                   self.lqh_module_levels.values())
+
+    def filter(self, record):
+        """
+        Drop the records below the level of the module
+        """
+        level = self.lqh_module_levels.get(record.module,
+                                           self.lqh_default_level)
+        if record.levelno < level:
+            return 0
+        return logging.Handler.filter(self, record)
+
+    def emit(self, record):
+        """
+        Put the record into the queue. The message is merged with the
+        arguments now, since the arguments might change later.
+        """
+        if len(self.lqh_queue) >= LOG_QUEUE_SIZE:
+            self.lqh_dropped += 1
+            return
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.lqh_queue.append(record)
+
+    def lqh_flush(self):
+        """
+        Write all the records in the queue to the handlers
+        """
+        while True:
+            try:
+                record = self.lqh_queue.popleft()
+            except IndexError:
+                break
+            for handler in self.lqh_handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        if self.lqh_dropped > 0:
+            dropped = self.lqh_dropped
+            self.lqh_dropped -= dropped
+            record = logging.LogRecord(logging.root.name, logging.WARNING,
+                                       __file__, 0,
+                                       "dropped [%d] log messages because "
+                                       "the log queue is full", (dropped,),
+                                       None)
+            for handler in self.lqh_handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def lqh_writer(self):
+        """
+        Write the records until stopped
+        """
+        # The monkey patched sleep would switch greenlets instead of
+        # sleeping in this OS thread
+        real_sleep = monkey.get_original("time", "sleep")
+        while self.lqh_running:
+            if len(self.lqh_queue) == 0:
+                real_sleep(LOG_WRITER_INTERVAL)
+                continue
+            self.lqh_flush()
+
+    def lqh_start(self):
+        """
+        Start the writer in a new OS thread
+        """
+        start_new_thread = monkey.get_original("thread", "start_new_thread")
+        self.lqh_running = True
+        start_new_thread(self.lqh_writer, ())
+
+    def lqh_stop(self):
+        """
+        Stop the writer and write the records left in the queue
+        """
+        self.lqh_running = False
+        self.lqh_flush()
+
+
+def log_level_parse(name):
+    """
+    Return the level of a name like "INFO", None if the name is invalid
+    """
+    level = logging.getLevelName(str(name).upper())
+    if not isinstance(level, int):
+        logging.error("invalid log level [%s]", name)
+        return None
+    return level
+
+
+def configure_logging(resultsdir, config=None):
+    """
+    Configure the logging levels. The log files are rotated by size, or by
+    time if "when" is configured, see TimedRotatingFileHandler. The config
+    could be like {"max_bytes": 104857600, "backup_count": 5,
+    "when": "midnight", "levels": {"default": "DEBUG", "ssh_host": "INFO"}}
+    """
+    # pylint: disable=too-many-locals
+    if config is None:
+        config = {}
+    max_bytes = config.get("max_bytes", LOG_MAX_BYTES)
+    backup_count = config.get("backup_count", LOG_BACKUP_COUNT)
+    when = config.get("when")
     default_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] "
                                           "[%(filename)s:%(lineno)s] "
                                           "%(message)s",
                                           "%Y/%m/%d-%H:%M:%S")
 
-    debug_handler = logging.FileHandler(resultsdir + "/debug.log")
-    debug_handler.setLevel(logging.DEBUG)
-    debug_handler.setFormatter(default_formatter)
-
-    info_handler = logging.FileHandler(resultsdir + "/info.log")
-    info_handler.setLevel(logging.INFO)
-    info_handler.setFormatter(default_formatter)
-
-    warning_handler = logging.FileHandler(resultsdir + "/warning.log")
-    warning_handler.setLevel(logging.WARNING)
-    warning_handler.setFormatter(default_formatter)
-
-    error_handler = logging.FileHandler(resultsdir + "/error.log")
-    error_handler.setLevel(logging.ERROR)
-    error_handler.setFormatter(default_formatter)
+    handlers = []
+    for name, level in [("debug", logging.DEBUG), ("info", logging.INFO),
+                        ("warning", logging.WARNING),
+                        ("error", logging.ERROR)]:
+        fname = resultsdir + "/" + name + ".log"
+        if when is not None:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                fname, when=when, backupCount=backup_count)
+        else:
+            handler = logging.handlers.RotatingFileHandler(
+                fname, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setLevel(level)
+        handler.setFormatter(default_formatter)
+        handlers.append(handler)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(default_formatter)
+    handlers.append(console_handler)
+
+    default_level = logging.DEBUG
+    module_levels = {}
+    for module, name in config.get("levels", {}).iteritems():
+        level = log_level_parse(name)
+        if level is None:
+            continue
+        if module == "default":
+            default_level = level
+        else:
+            module_levels[module] = level
 
+    queue_handler = LogQueueHandler(handlers, default_level, module_levels)
+    for handler in logging.root.handlers:
+        if isinstance(handler, LogQueueHandler):
+            handler.lqh_stop()
     logging.root.handlers = []
-    logging.root.setLevel(logging.DEBUG)
-    logging.root.addHandler(debug_handler)
-    logging.root.addHandler(info_handler)
-    logging.root.addHandler(console_handler)
-    logging.root.addHandler(warning_handler)
-    logging.root.addHandler(error_handler)
+    # The records below all the levels are not even created
+    logging.root.setLevel(queue_handler.lqh_level())
+    logging.root.addHandler(queue_handler)
+    queue_handler.lqh_start()
+    atexit.register(queue_handler.lqh_stop)
+
+
+def log_restart_after_fork():
+    """
+    The writer thread is not inherited by a forked child, so start a new
+    one which only writes to the console, since the log files are rotated
+    by the parent
+    """
+    for handler in logging.root.handlers:
+        if not isinstance(handler, LogQueueHandler):
+            continue
+        handler.lqh_handlers = [output for output in handler.lqh_handlers
+                                if not isinstance(output,
+                                                  logging.FileHandler)]
+        handler.lqh_queue.clear()
+        handler.lqh_start()
+
+
+def log_limited(level, msg, *args):
+    """
+    Log a message unless the same call site logged within the rate limit
+    interval, e.g. for the messages per datapoint or per action. The number
+    of suppressed messages is appended to the next message.
+    """
+    if not logging.root.isEnabledFor(level):
+        return
+    # pylint: disable=protected-access
+    frame = sys._getframe(1)
+    key = (frame.f_code.co_filename, frame.f_lineno)
+    now = time.time()
+    limit = LOG_RATE_LIMITS.get(key)
+    if limit is None:
+        limit = [None, 0]
+        LOG_RATE_LIMITS[key] = limit
+    elif now - limit[0] < LOG_RATE_LIMIT_INTERVAL:
+        limit[1] += 1
+        return
+    if limit[1] > 0:
+        msg += ", suppressed [%d] similar messages"
+        args += (limit[1],)
+    limit[0] = now
+    limit[1] = 0
+    record = logging.root.makeRecord(logging.root.name, level,
+                                     frame.f_code.co_filename,
+                                     frame.f_lineno, msg, args, None,
+                                     frame.f_code.co_name)
+    logging.root.handle(record)
 
 
 def utcnow():